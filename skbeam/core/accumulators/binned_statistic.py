@@ -42,11 +42,23 @@ import numpy as np
 from ..utils import radial_grid, angle_grid, bin_edges_to_centers
 
 
+def _ravel_image_map(name, arr, expected_shape):
+    # validate a per-pixel map against the image shape and flatten it
+    if arr is None:
+        return None
+    arr = np.asarray(arr)
+    if arr.shape != expected_shape:
+        raise ValueError('"' + name + '" has incorrect shape. '
+                         ' Expected: ' + str(expected_shape) +
+                         ' Received: ' + str(arr.shape))
+    return arr.reshape(-1)
+
+
 class BinnedStatisticDD(object):
     std_ = ('mean', 'median', 'count', 'sum', 'std')
 
     def __init__(self, sample, statistic='mean',
-                 bins=10, range=None, mask=None):
+                 bins=10, range=None, mask=None, weights=None, dark=None):
         """
         Compute a multidimensional binned statistic for a set of data.
 
@@ -93,6 +105,15 @@ class BinnedStatisticDD(object):
         mask : array_like
             array of ones and zeros with total size N (see documentation
             for `sample`). Values with mask==0 will be ignored.
+        weights : array_like, optional
+            per-point multiplicative correction of total size N (for
+            example solid angle x polarization x flat field). The values
+            are corrected as ``(values - dark) * weights`` on every call,
+            fused into the binning so no corrected copy of the data needs
+            to be made beforehand.
+        dark : array_like, optional
+            per-point offset (e.g. dark current) of total size N which is
+            subtracted from the values before `weights` is applied.
 
         Note: If using numpy versions < 1.10.0, you may notice slow behavior of
         this constructor. This has to do with digitize, which was optimized
@@ -187,6 +208,28 @@ class BinnedStatisticDD(object):
         self._argsort_index = None
         self.statistic = statistic
 
+        # Precompute the correction. (values - dark) * weights is split into
+        # values * weights - dark * weights so that the binned sum of the
+        # constant offset term only has to be computed once.
+        self._weights = None
+        self._offset = None
+        self._offset_flatsum = None
+        if weights is not None:
+            self._weights = np.asarray(weights, dtype=float).reshape(-1)
+            if self._weights.size != N:
+                raise ValueError('"weights" has incorrect size. '
+                                 ' Expected: ' + str(N) +
+                                 ' Received: ' + str(self._weights.size))
+        if dark is not None:
+            self._offset = np.asarray(dark, dtype=float).reshape(-1)
+            if self._offset.size != N:
+                raise ValueError('"dark" has incorrect size. '
+                                 ' Expected: ' + str(N) +
+                                 ' Received: ' + str(self._offset.size))
+            if self._weights is not None:
+                self._offset = self._offset * self._weights
+            self._offset_flatsum = np.bincount(self.xy, self._offset)
+
     @property
     def binmap(self):
         ''' Return the map of the bins per dimension.
@@ -227,6 +270,24 @@ class BinnedStatisticDD(object):
             self._argsort_index = self.xy.argsort()
         return self._argsort_index
 
+    def _corrected(self, values):
+        # Apply the dark offset and weights, if any, in a single expression.
+        if self._weights is not None:
+            values = values * self._weights
+        if self._offset is not None:
+            values = values - self._offset
+        return values
+
+    def _flatsum(self, values):
+        # Binned sum of the corrected values. The offset contribution is
+        # precomputed, so the raw values are only read once.
+        if self._weights is not None:
+            values = values * self._weights
+        flatsum = np.bincount(self.xy, values)
+        if self._offset_flatsum is not None:
+            flatsum -= self._offset_flatsum
+        return flatsum
+
     @property
     def bin_edges(self):
         """
@@ -291,11 +352,12 @@ class BinnedStatisticDD(object):
         self.result = np.empty(self.nbin.prod(), float)
         if statistic == 'mean':
             self.result.fill(np.nan)
-            flatsum = np.bincount(self.xy, values)
+            flatsum = self._flatsum(values)
             a = self.flatcount.nonzero()
             self.result[a] = flatsum[a] / self.flatcount[a]
         elif statistic == 'std':
             self.result.fill(0)
+            values = self._corrected(values)
             flatsum = np.bincount(self.xy, values)
             flatsum2 = np.bincount(self.xy, values ** 2)
             a = self.flatcount.nonzero()
@@ -307,7 +369,7 @@ class BinnedStatisticDD(object):
             self.result[a] = self.flatcount
         elif statistic == 'sum':
             self.result.fill(0)
-            flatsum = np.bincount(self.xy, values)
+            flatsum = self._flatsum(values)
             a = np.arange(len(flatsum))
             self.result[a] = flatsum
         elif callable(statistic) or statistic == 'median':
@@ -326,7 +388,7 @@ class BinnedStatisticDD(object):
                 np.seterr(**old)
             self.result.fill(null)
 
-            vfs = values[self.argsort_index]
+            vfs = self._corrected(values)[self.argsort_index]
             i = 0
             for j, k in enumerate(self.flatcount):
                 if k > 0:
@@ -342,7 +404,7 @@ class BinnedStatisticDD(object):
             ni[i], ni[j] = ni[j], ni[i]
 
         # Remove outliers (indices 0 and -1 for each dimension).
-        core = self.D * [slice(1, -1)]
+        core = tuple(self.D * [slice(1, -1)])
         self.result = self.result[core]
 
         if (self.result.shape != self.nbin - 2).any():
@@ -353,7 +415,7 @@ class BinnedStatisticDD(object):
 
 class BinnedStatistic1D(BinnedStatisticDD):
     def __init__(self, x, statistic='mean',
-                 bins=10, range=None, mask=None):
+                 bins=10, range=None, mask=None, weights=None, dark=None):
         """
         A refactored version of scipy.stats.binned_statistic to improve
         performance for the case where binning doesn't need to be
@@ -401,6 +463,12 @@ class BinnedStatistic1D(BinnedStatisticDD):
         mask : array_like
             ones and zeros with the same shape as `x`.
             Values with mask==0 will be ignored.
+        weights : array_like, optional
+            multiplicative correction with the same shape as `x`, applied
+            as ``(values - dark) * weights``.
+        dark : array_like, optional
+            offset with the same shape as `x`, subtracted from the values
+            before `weights` is applied.
 
         See Also
         --------
@@ -427,7 +495,8 @@ class BinnedStatistic1D(BinnedStatisticDD):
 
         super(BinnedStatistic1D, self).__init__([x], statistic=statistic,
                                                 bins=bins, range=range,
-                                                mask=mask)
+                                                mask=mask, weights=weights,
+                                                dark=dark)
 
     @property
     def bin_edges(self):
@@ -495,6 +564,12 @@ class BinnedStatistic2D(BinnedStatisticDD):
     mask : array_like
         ones and zeros with the same shape as `x`.
         Values with mask==0 will be ignored.
+    weights : array_like, optional
+        multiplicative correction with the same shape as `x`, applied
+        as ``(values - dark) * weights``.
+    dark : array_like, optional
+        offset with the same shape as `x`, subtracted from the values
+        before `weights` is applied.
 
     See Also
     --------
@@ -503,7 +578,7 @@ class BinnedStatistic2D(BinnedStatisticDD):
     """
 
     def __init__(self, x, y, statistic='mean',
-                 bins=10, range=None, mask=None):
+                 bins=10, range=None, mask=None, weights=None, dark=None):
         # This code is based on np.histogram2d
         try:
             N = len(bins)
@@ -516,7 +591,8 @@ class BinnedStatistic2D(BinnedStatisticDD):
 
         super(BinnedStatistic2D, self).__init__([x, y], statistic=statistic,
                                                 bins=bins, range=range,
-                                                mask=mask)
+                                                mask=mask, weights=weights,
+                                                dark=dark)
 
     def __call__(self, values, statistic=None):
         """
@@ -560,7 +636,8 @@ class RPhiBinnedStatistic(BinnedStatistic2D):
     """
 
     def __init__(self, shape, bins=10, range=None,
-                 origin=None, mask=None, r_map=None, statistic='mean'):
+                 origin=None, mask=None, r_map=None, statistic='mean',
+                 weights=None, dark=None):
         """
         Parameters:
         -----------
@@ -607,6 +684,14 @@ class RPhiBinnedStatistic(BinnedStatistic2D):
                 values, and outputs a single numerical statistic. This function
                 will be called on the values in each bin.  Empty bins will be
                 represented by function([]), or NaN if this returns an error.
+        weights : 2-dimensional np.ndarray of floats, optional
+            per-pixel multiplicative correction with shape `shape`, e.g. the
+            product of solid angle, polarization and flat field corrections.
+            It is folded into the binning, so raw images can be passed in
+            directly and are read only once per call.
+        dark : 2-dimensional np.ndarray of floats, optional
+            per-pixel offset (e.g. dark current) with shape `shape`. Images
+            are corrected as ``(image - dark) * weights``.
         """
         if origin is None:
             origin = (shape[0] - 1) / 2., (shape[1] - 1) / 2.
@@ -617,19 +702,18 @@ class RPhiBinnedStatistic(BinnedStatistic2D):
         phi_map = angle_grid(origin, shape)
 
         self.expected_shape = tuple(shape)
-        if mask is not None:
-            if mask.shape != self.expected_shape:
-                raise ValueError('"mask" has incorrect shape. '
-                                 ' Expected: ' + str(self.expected_shape) +
-                                 ' Received: ' + str(mask.shape))
-            mask = mask.reshape(-1)
+        mask = _ravel_image_map('mask', mask, self.expected_shape)
+        weights = _ravel_image_map('weights', weights, self.expected_shape)
+        dark = _ravel_image_map('dark', dark, self.expected_shape)
 
         super(RPhiBinnedStatistic, self).__init__(r_map.reshape(-1),
                                                   phi_map.reshape(-1),
                                                   statistic,
                                                   bins=bins,
                                                   mask=mask,
-                                                  range=range)
+                                                  range=range,
+                                                  weights=weights,
+                                                  dark=dark)
 
     def __call__(self, values, statistic=None):
         """
@@ -679,7 +763,7 @@ class RadialBinnedStatistic(BinnedStatistic1D):
     """
 
     def __init__(self, shape, bins=10, range=None, origin=None, mask=None,
-                 r_map=None, statistic='mean'):
+                 r_map=None, statistic='mean', weights=None, dark=None):
         """
         Parameters:
         -----------
@@ -725,6 +809,14 @@ class RadialBinnedStatistic(BinnedStatistic1D):
                 values, and outputs a single numerical statistic. This function
                 will be called on the values in each bin.  Empty bins will be
                 represented by function([]), or NaN if this returns an error.
+        weights : 2-dimensional np.ndarray of floats, optional
+            per-pixel multiplicative correction with shape `shape`, e.g. the
+            product of solid angle, polarization and flat field corrections.
+            It is folded into the binning, so raw images can be passed in
+            directly and are read only once per call.
+        dark : 2-dimensional np.ndarray of floats, optional
+            per-pixel offset (e.g. dark current) with shape `shape`. Images
+            are corrected as ``(image - dark) * weights``.
         """
         if origin is None:
             origin = (shape[0] - 1) / 2, (shape[1] - 1) / 2
@@ -733,18 +825,17 @@ class RadialBinnedStatistic(BinnedStatistic1D):
             r_map = radial_grid(origin, shape)
 
         self.expected_shape = tuple(shape)
-        if mask is not None:
-            if mask.shape != self.expected_shape:
-                raise ValueError('"mask" has incorrect shape. '
-                                 ' Expected: ' + str(self.expected_shape) +
-                                 ' Received: ' + str(mask.shape))
-            mask = mask.reshape(-1)
+        mask = _ravel_image_map('mask', mask, self.expected_shape)
+        weights = _ravel_image_map('weights', weights, self.expected_shape)
+        dark = _ravel_image_map('dark', dark, self.expected_shape)
 
         super(RadialBinnedStatistic, self).__init__(r_map.reshape(-1),
                                                     statistic,
                                                     bins=bins,
                                                     mask=mask,
-                                                    range=range)
+                                                    range=range,
+                                                    weights=weights,
+                                                    dark=dark)
 
     def __call__(self, values, statistic=None):
         """
@@ -272,3 +272,36 @@ def test_binmap3d():
     assert_array_almost_equal(rbinmap1[0][::1000], np.array([1, 10,  9,  8, 7,
                                                              6,  5,  4,  3, 2,
                                                              1]))
+
+
+@pytest.mark.parametrize('stat', ['mean', 'sum', 'std', 'median'])
+def test_corrections(stat):
+    shape = (41, 53)
+    rng = np.random.RandomState(0)
+    image = rng.poisson(50, size=shape).astype(float)
+    weights = rng.uniform(0.5, 1.5, size=shape)
+    dark = rng.uniform(0, 5, size=shape)
+    mask = rng.randint(2, size=shape)
+
+    corrected = RadialBinnedStatistic(shape, 20, mask=mask, statistic=stat,
+                                      weights=weights, dark=dark)
+    plain = RadialBinnedStatistic(shape, 20, mask=mask, statistic=stat)
+    assert_array_almost_equal(corrected(image),
+                              plain((image - dark) * weights))
+
+    corrected = RPhiBinnedStatistic(shape, (10, 4), statistic=stat,
+                                    weights=weights, dark=dark)
+    plain = RPhiBinnedStatistic(shape, (10, 4), statistic=stat)
+    assert_array_almost_equal(corrected(image),
+                              plain((image - dark) * weights))
+
+    # weights alone
+    corrected = RadialBinnedStatistic(shape, 20, statistic=stat,
+                                      weights=weights)
+    plain = RadialBinnedStatistic(shape, 20, statistic=stat)
+    assert_array_almost_equal(corrected(image), plain(image * weights))
+
+    with assert_raises(ValueError):
+        RadialBinnedStatistic(shape, 20, weights=weights[:10])
+    with assert_raises(ValueError):
+        RadialBinnedStatistic(shape, 20, dark=dark[:, :10])
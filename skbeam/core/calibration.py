@@ -38,17 +38,17 @@ known sample.
 
 from __future__ import absolute_import, division, print_function
 
-from collections import deque
 from string import Template
 
 import numpy as np
 import scipy.signal
+import six
 
 from .constants import calibration_standards
 from .feature import (filter_peak_height, peak_refinement,
+                      batch_filter_peak_height, batch_peak_refinement,
                       refine_log_quadratic)
-from .utils import (angle_grid, radial_grid,
-                    pairwise, bin_edges_to_centers, bin_1D)
+from .utils import bin_edges_to_centers
 
 
 def estimate_d_blind(name, wavelength, bin_centers, ring_average,
@@ -111,8 +111,6 @@ def estimate_d_blind(name, wavelength, bin_centers, ring_average,
         The standard deviation of d computed from the peaks used.
     """
 
-    # get the calibration standard
-    cal = calibration_standards[name]
     # find the local maximums
     cands = scipy.signal.argrelmax(ring_average, order=window_size)[0]
     # filter local maximums by size
@@ -124,7 +122,7 @@ def estimate_d_blind(name, wavelength, bin_centers, ring_average,
     peaks_x, peaks_y = peak_refinement(bin_centers, ring_average, cands,
                                        window_size, refine_log_quadratic)
     # compute tan(2theta) for the expected peaks
-    tan2theta = np.tan(cal.convert_2theta(wavelength))
+    tan2theta = _tan2theta(name, wavelength)
     # figure out how many peaks we can look at
     slc = slice(0, np.min([len(tan2theta), len(peaks_x), max_peak_count]))
     # estimate the sample-detector distance for each of the peaks
@@ -139,6 +137,126 @@ if estimate_d_blind.__doc__ is not None:
         name_ops=repr(sorted(estimate_d_blind.name)))
 
 
+# tan(2theta) of the reflections of a standard, per (name, wavelength)
+_tan2theta_cache = {}
+
+
+def _tan2theta(name, wavelength):
+    """Cached tan(2theta) of the reflections of a calibration standard"""
+    key = (name, float(wavelength))
+    try:
+        return _tan2theta_cache[key]
+    except KeyError:
+        pass
+    tan2theta = np.tan(calibration_standards[name].convert_2theta(
+        wavelength))
+    tan2theta.flags.writeable = False
+    _tan2theta_cache[key] = tan2theta
+    return tan2theta
+
+
+def estimate_d_blind_batch(name, wavelength, bin_centers, ring_averages,
+                           window_size, max_peak_count, thresh):
+    """
+    Estimate the sample-detector distance for a stack of ring averages
+
+    This is `estimate_d_blind` applied to every row of `ring_averages`,
+    e.g. for the images of a detector distance scan. The candidate peaks of
+    all the patterns are found and refined together (see
+    `skbeam.core.feature.batch_peak_refinement`), and tan(2theta) of the
+    standards is computed once per (standard, wavelength).
+
+    Parameters
+    ----------
+    name : str or list of str
+        The name of the calibration standard, or one name per pattern.
+
+        Valid options: $name_ops
+
+    wavelength : float or array
+        The wavelength of scattered x-ray in nm, or one per pattern
+
+    bin_centers : array
+        The distance from the calibrated center to the center of
+        the ring's annulus in mm. Either shared by all the patterns, or
+        with the shape of `ring_averages`
+
+    ring_averages : array
+        The azimuthally integrated powder patterns, one per row.  In counts
+        [arb]
+
+    window_size : int
+        The number of elements on either side of a local maximum to
+        use for locating and refining peaks.  Candidates are identified
+        as a relative maximum in a window sized (2*window_size + 1) and
+        the same window is used for fitting the peaks to refine the location.
+
+    max_peak_count : int
+        Use at most this many peaks
+
+    thresh : float
+        Fraction of maximum peak height
+
+    Returns
+    -------
+    dist_sample : array
+        The detector-sample distance in mm of each pattern.  This is the mean
+        of the estimate from all of the peaks used.
+
+    std_dist_sample : array
+        The standard deviation of d computed from the peaks used.
+    """
+    ring_averages = np.atleast_2d(np.asarray(ring_averages, dtype=float))
+    num_patterns, num_bins = ring_averages.shape
+    bin_centers = np.broadcast_to(bin_centers, ring_averages.shape)
+    names = ([name] * num_patterns if isinstance(name, six.string_types)
+             else list(name))
+    wavelengths = np.broadcast_to(wavelength, (num_patterns, ))
+    if len(names) != num_patterns:
+        raise ValueError("Expected {} standard names, got "
+                         "{}".format(num_patterns, len(names)))
+
+    # find the local maximums and filter them by size
+    rows, cands = _row_peaks(ring_averages,
+                             np.full(num_patterns, num_bins), thresh,
+                             window_size)
+    # refine the locations of all the peaks at once
+    rows, peaks_x, _ = batch_peak_refinement(bin_centers, ring_averages,
+                                             (rows, cands), window_size,
+                                             refine_log_quadratic)
+
+    # the expected tan(2theta) of the rank-th peak of each pattern
+    tan2theta = [_tan2theta(n, wl) for n, wl in zip(names, wavelengths)]
+    num_reflections = np.array([len(t) for t in tan2theta])
+    expected = np.full((num_patterns, max(num_reflections.max(), 1)),
+                       np.nan)
+    for i, t in enumerate(tan2theta):
+        expected[i, :len(t)] = t
+    first = np.searchsorted(rows, np.arange(num_patterns))
+    rank = np.arange(len(rows)) - first[rows]
+    num_peaks = np.bincount(rows, minlength=num_patterns)
+    num_used = np.minimum(np.minimum(num_reflections, num_peaks),
+                          max_peak_count)
+    used = rank < num_used[rows]
+    rows, rank = rows[used], rank[used]
+    d_array = peaks_x[used] / expected[rows, rank]
+
+    # mean and standard deviation of d per pattern
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.bincount(rows, d_array, minlength=num_patterns) / num_used
+        dev = d_array - mean[rows]
+        std = np.sqrt(np.bincount(rows, dev * dev, minlength=num_patterns) /
+                      num_used)
+    return mean, std
+
+
+estimate_d_blind_batch.name = estimate_d_blind.name
+if estimate_d_blind_batch.__doc__ is not None:
+    estimate_d_blind_batch.__doc__ = Template(
+        estimate_d_blind_batch.__doc__).substitute(
+            name_ops=repr(sorted(estimate_d_blind_batch.name)))
+
+
 def refine_center(image, calibrated_center, pixel_size, phi_steps, max_peaks,
                   thresh, window_size,
                   nx=None, min_x=None, max_x=None):
@@ -174,60 +292,266 @@ def refine_center(image, calibrated_center, pixel_size, phi_steps, max_peaks,
         Number of bins to use for radial binning
 
     min_x : float, optional
-        The minimum radius to use for radial binning
+        The minimum radius to use for radial binning. Defaults to the
+        smallest radius in the whole image, shared by all the wedges
+        rather than taken per wedge
 
     max_x : float, optional
-        The maximum radius to use for radial binning
+        The maximum radius to use for radial binning. Defaults to the
+        largest radius in the whole image, shared by all the wedges
+        rather than taken per wedge
 
     Returns
     -------
     calibrated_center : tuple
         The refined calibrated center.
+
+    See Also
+    --------
+    CenterRefiner : keeps the binning for repeated refinement iterations
+    """
+    refiner = CenterRefiner(image.shape, pixel_size, phi_steps,
+                            nx=nx, min_x=min_x, max_x=max_x)
+    return refiner(image, calibrated_center, max_peaks, thresh, window_size)
+
+
+class CenterRefiner(object):
+    """
+    Refine the center of the beam from the rings of a powder pattern
+
+    The image is binned in radius and in `phi_steps` - 1 angular wedges in
+    a single pass, the rings are located in all the wedges at once and the
+    center is shifted by the first Fourier term of the variation of the
+    ring radii with angle. As in the wedge by wedge formulation, the
+    radial bins are ``[start, end)`` (the last one closed) and the wedges
+    are ``(start, end]``.
+
+    The pixel offsets, the wedge edges and, when `min_x` and `max_x` are
+    given, the radial edges are computed once. A new center only assigns
+    the pixels to bins again; the assignment and the bin counts are kept
+    for the most recent center, so each further image at that center is
+    binned with a single ``np.bincount``.
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of the images
+
+    pixel_size : tuple
+        (pixel_height, pixel_width)
+
+    phi_steps : int
+        How many regions to split the ring into, should be >10
+
+    nx : int, optional
+        Number of bins to use for radial binning
+
+    min_x : float, optional
+        The minimum radius to use for radial binning. Defaults to the
+        smallest radius in the whole image, shared by all the wedges
+        rather than taken per wedge
+
+    max_x : float, optional
+        The maximum radius to use for radial binning. Defaults to the
+        largest radius in the whole image, shared by all the wedges
+        rather than taken per wedge
+
+    mask : array, optional
+        Pixels where the mask is zero are ignored
+
+    Examples
+    --------
+    >>> refiner = CenterRefiner(image.shape, (1, 1), phi_steps=20)
+    >>> for i in range(10):
+    ...     center = refiner(image, center, max_peaks=4, thresh=0,
+    ...                      window_size=5)
+    """
+    def __init__(self, shape, pixel_size, phi_steps, nx=None, min_x=None,
+                 max_x=None, mask=None):
+        if nx is None:
+            nx = int(np.mean(shape) * 2)
+        self.shape = tuple(shape)
+        self.pixel_size = tuple(pixel_size)
+        self.nx = nx
+        self.min_x = min_x
+        self.max_x = max_x
+        self.mask = mask
+        self.phi_edges = np.linspace(-np.pi, np.pi, phi_steps, endpoint=True)
+        self.phi_centers = bin_edges_to_centers(self.phi_edges)
+        self._rows = np.arange(self.shape[0])
+        self._cols = np.arange(self.shape[1])
+        self._r_edges = None
+        if min_x is not None and max_x is not None:
+            self._r_edges = np.linspace(min_x, max_x, nx + 1, endpoint=True)
+        self._center = None
+        self._bins = None
+
+    def _pixel_bins(self, calibrated_center):
+        """
+        The (wedge, radius) bins of the pixels for `calibrated_center`
+
+        Returns
+        -------
+        index : array
+            The flat indices of the pixels which fall in a bin
+        bins : array
+            The flat ``wedge * nx + radius`` bin of each of those pixels
+        count : array
+            The number of pixels in each bin, shape (number of wedges, nx)
+        r_edges : array
+            The radial bin edges
+        """
+        center = tuple(float(c) for c in calibrated_center)
+        if center == self._center:
+            return self._bins
+        # the same arithmetic as radial_grid and angle_grid, broadcast from
+        # the row and column offsets instead of full meshgrids
+        x = self.pixel_size[1] * (self._cols - center[1])
+        y = self.pixel_size[0] * (self._rows - center[0])
+        r = np.sqrt(x * x + (y * y)[:, np.newaxis]).ravel()
+        phi = np.arctan2(y[:, np.newaxis], x).ravel()
+        r_edges = self._r_edges
+        if r_edges is None:
+            min_x = np.min(r) if self.min_x is None else self.min_x
+            max_x = np.max(r) if self.max_x is None else self.max_x
+            r_edges = np.linspace(min_x, max_x, self.nx + 1, endpoint=True)
+        # radii are binned like np.histogram, with the last edge included
+        radius = np.searchsorted(r_edges, r, side='right') - 1
+        radius[r == r_edges[-1]] = self.nx - 1
+        # wedges include their upper edge and exclude the lower one
+        wedge = np.searchsorted(self.phi_edges, phi, side='left') - 1
+        num_wedges = len(self.phi_edges) - 1
+        valid = ((radius >= 0) & (radius < self.nx) &
+                 (wedge >= 0) & (wedge < num_wedges))
+        if self.mask is not None:
+            valid &= np.asarray(self.mask).ravel() != 0
+        index = np.flatnonzero(valid)
+        bins = wedge[index] * self.nx + radius[index]
+        count = np.bincount(bins, minlength=num_wedges * self.nx)
+        self._bins = (index, bins, count.reshape(num_wedges, self.nx),
+                      r_edges)
+        self._center = center
+        return self._bins
+
+    def ring_trace(self, image, calibrated_center, max_peaks, thresh,
+                   window_size):
+        """
+        The radius of the rings in each wedge
+
+        Returns
+        -------
+        ring_trace : array
+            The radii of the first rings found in every wedge, with shape
+            (number of rings, number of wedges)
+        """
+        index, bins, count, r_edges = self._pixel_bins(calibrated_center)
+        b_sum = np.bincount(bins, weights=np.ravel(image)[index],
+                            minlength=count.size).reshape(count.shape)
+        bin_centers = bin_edges_to_centers(r_edges)
+
+        # the bins with little intensity are dropped from each wedge; pack
+        # the remaining bins of each wedge at the start of its row
+        valid = b_sum > 10
+        num_valid = valid.sum(axis=1)
+        rows = np.arange(len(valid))[:, np.newaxis]
+        order = np.argsort(~valid, axis=1, kind='mergesort')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            avg = (b_sum / count)[rows, order]
+        peaks = _row_peaks(avg, num_valid, thresh, window_size)
+        wedge, pos = peaks
+        # keep the first max_peaks rings of each wedge
+        first = np.searchsorted(wedge, np.arange(len(valid)))
+        rank = np.arange(len(wedge)) - first[wedge]
+        keep = rank < max_peaks
+        wedge, pos, rank = wedge[keep], pos[keep], rank[keep]
+
+        num_rings = np.bincount(wedge, minlength=len(valid)).min()
+        in_trace = rank < num_rings
+        ring_trace = np.empty((num_rings, len(valid)))
+        ring_trace[rank[in_trace], wedge[in_trace]] = bin_centers[
+            order[wedge[in_trace], pos[in_trace]]]
+        return ring_trace
+
+    def __call__(self, image, calibrated_center, max_peaks, thresh,
+                 window_size):
+        """
+        Refines the location of the center of the beam.
+
+        Parameters
+        ----------
+        image : ndarray
+            The image
+
+        calibrated_center : tuple
+            (row, column) the estimated center
+
+        max_peaks : int
+            Number of rings to look it
+
+        thresh : float
+            Fraction of maximum peak height
+
+        window_size : int, optional
+            The window size to use (in bins) to use when refining peaks
+
+        Returns
+        -------
+        calibrated_center : tuple
+            The refined calibrated center.
+        """
+        ring_trace = self.ring_trace(image, calibrated_center, max_peaks,
+                                     thresh, window_size)
+
+        mean_dr = np.mean(ring_trace -
+                          np.mean(ring_trace, axis=1, keepdims=True),
+                          axis=0)
+
+        phi_centers = self.phi_centers
+        pixel_size = self.pixel_size
+
+        delta = np.mean(np.diff(phi_centers))
+        # this is doing just one term of a Fourier series
+        # note that we have to convert _back_ to pixels from real units
+        # TODO do this with better integration/handle repeat better
+        col_shift = (np.sum(np.sin(phi_centers) * mean_dr) *
+                     delta / (np.pi * pixel_size[1]))
+        row_shift = (np.sum(np.cos(phi_centers) * mean_dr) *
+                     delta / (np.pi * pixel_size[0]))
+
+        return tuple(np.array(calibrated_center) +
+                     np.array([row_shift, col_shift]))
+
+
+def _row_peaks(avg, num_valid, thresh, window_size):
+    """
+    Local maxima of the rows of `avg` which are high enough
+
+    Both the candidate search and the height filter are done for all the
+    rows at once.
+
+    Only the first ``num_valid[i]`` values of row ``i`` are used. The
+    result is that of ``scipy.signal.argrelmax`` and `filter_peak_height`
+    applied to each row, with ``thresh * max(row)`` as height threshold.
+
+    Returns
+    -------
+    rows, positions : array
+        The row and position of each peak, sorted by row then position
     """
-    if nx is None:
-        nx = int(np.mean(image.shape) * 2)
-
-    phi = angle_grid(calibrated_center, image.shape, pixel_size).ravel()
-    r = radial_grid(calibrated_center, image.shape, pixel_size).ravel()
-    I = image.ravel()
-
-    phi_steps = np.linspace(-np.pi, np.pi, phi_steps, endpoint=True)
-    out = deque()
-    for phi_start, phi_end in pairwise(phi_steps):
-        mask = (phi <= phi_end) * (phi > phi_start)
-        out.append(bin_1D(r[mask], I[mask],
-                          nx=nx, min_x=min_x, max_x=max_x))
-    out = list(out)
-
-    ring_trace = []
-    for bins, b_sum, b_count in out:
-        mask = b_sum > 10
-        avg = b_sum[mask] / b_count[mask]
-        bin_centers = bin_edges_to_centers(bins)[mask]
-
-        cands = scipy.signal.argrelmax(avg, order=window_size)[0]
-        # filter local maximums by size
-        cands = filter_peak_height(avg, cands, thresh*np.max(avg),
-                                   window=window_size)
-        ring_trace.append(bin_centers[cands[:max_peaks]])
-
-    tr_len = [len(rt) for rt in ring_trace]
-    mm = np.min(tr_len)
-    ring_trace = np.vstack([rt[:mm] for rt in ring_trace]).T
-
-    mean_dr = np.mean(ring_trace - np.mean(ring_trace, axis=1, keepdims=True),
-                      axis=0)
-
-    phi_centers = bin_edges_to_centers(phi_steps)
-
-    delta = np.mean(np.diff(phi_centers))
-    # this is doing just one term of a Fourier series
-    # note that we have to convert _back_ to pixels from real units
-    # TODO do this with better integration/handle repeat better
-    col_shift = (np.sum(np.sin(phi_centers) * mean_dr) *
-                 delta / (np.pi * pixel_size[1]))
-    row_shift = (np.sum(np.cos(phi_centers) * mean_dr) *
-                 delta / (np.pi * pixel_size[0]))
-
-    return tuple(np.array(calibrated_center) +
-                 np.array([row_shift, col_shift]))
+    num_rows, num_bins = avg.shape
+    if num_bins == 0:
+        return np.zeros((2, 0), dtype=np.intp)
+    # repeat the last valid value of each row over the rest of the row.
+    # argrelmax clips its comparisons at the end of the data, and the
+    # padding then compares in the same way, so no peaks are found in it
+    last = avg[np.arange(num_rows), np.maximum(num_valid - 1, 0)]
+    padding = np.arange(num_bins) >= num_valid[:, np.newaxis]
+    avg = np.where(padding, last[:, np.newaxis], avg)
+    avg[num_valid == 0] = 0
+
+    rows, pos = scipy.signal.argrelmax(avg, axis=1, order=window_size)
+    indptr = np.searchsorted(rows, np.arange(num_rows + 1))
+    indptr, pos = batch_filter_peak_height(avg, (indptr, pos),
+                                           thresh * avg.max(axis=1),
+                                           window=window_size)
+    return np.repeat(np.arange(num_rows), np.diff(indptr)), pos
@@ -40,7 +40,8 @@
 '''
 from .basic import BasicElement
 from .xrs import calibration_standards
-from .xrf import XrfElement, emission_line_search
+from .xrf import (XrfElement, XrfTable, emission_line_search,
+                  get_xrf_table)
 
 import logging
 logger = logging.getLogger(__name__)
@@ -42,6 +42,7 @@ from skbeam.core.constants.basic import BasicElement
 from skbeam.core.constants.xrs import calibration_standards
 from skbeam.core.constants.xrf import XrfElement
 from skbeam.core.constants.xrf import emission_line_search
+from skbeam.core.constants.xrf import XrfTable, get_xrf_table
 
 if __name__ == '__main__':
     import nose
@@ -36,14 +36,20 @@
 # POSSIBILITY OF SUCH DAMAGE.                                          #
 ########################################################################
 from __future__ import absolute_import, division, print_function
+import os
+import shutil
+import tempfile
+
 import six
 import numpy as np
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
                            assert_raises)
 from nose.tools import assert_equal, assert_not_equal
 
+from skbeam.core.constants import xrf
 from skbeam.core.constants.xrf import (XrfElement, emission_line_search,
-                                       XrayLibWrap, XrayLibWrap_Energy)
+                                       XrayLibWrap, XrayLibWrap_Energy,
+                                       XrfTable, get_xrf_table)
 from skbeam.core.utils import NotInstalledError
 from skbeam.core.constants.basic import basic
 
@@ -79,6 +85,25 @@ def test_element_finder():
     return
 
 
+def test_element_finder_batch():
+    energies = [2.3, 8, 12.6]
+    out = emission_line_search(energies, 0.05, 15)
+    assert_equal(len(out), len(energies))
+    for eng, found in zip(energies, out):
+        assert_equal(found, emission_line_search(eng, 0.05, 15))
+        # same result as looking at each element separately
+        expected = dict()
+        for Z in range(1, 101):
+            e = XrfElement(Z)
+            lines = e.line_near(eng, 0.05, 15)
+            if lines:
+                expected[e.sym] = lines
+        assert_equal(found, expected)
+
+    out = emission_line_search(8, 0.05, 10, element_list=['cu', 29, 'Fe'])
+    assert_equal(list(out), ['Cu'])
+
+
 def test_XrayLibWrap_notpresent():
     from skbeam.core.constants import xrf
     # stash the original xraylib object
@@ -132,6 +157,83 @@ def test_cs_different_units():
         assert_array_almost_equal(cs1, cs2, decimal=10)
 
 
+def test_xrf_table():
+    table = XrfTable.build(max_z=30, energy_grid=np.linspace(5, 20, 61))
+    assert_equal(table.cs_table.shape[:2], (31, len(table.lines)))
+    for elm in ['Ar', 'Fe', 'Zn']:
+        e = XrfElement(elm)
+        te = table.element(elm)
+        assert_equal(te.Z, e.Z)
+        assert_equal(te.emission_line.all, list(e.emission_line.all))
+        for eng in [9.6, 10, 12.3]:
+            # rows for a given incident energy are exact
+            assert_equal(te.cs(eng).all, list(e.cs(eng).all))
+            assert_equal(te.csb(eng)['ka1'], e.csb(eng)['ka1'])
+            # interpolated values are close, and zero where xraylib is zero
+            cs = table.cs(elm, table.lines, eng)
+            expected = np.array([v for k, v in e.cs(eng).all])
+            assert_array_almost_equal(cs / expected.max(),
+                                      expected / expected.max(), decimal=3)
+            assert_array_equal(cs == 0, expected == 0)
+
+    # Zn K edge lies at 9.66 keV
+    assert_equal(table.cs('Zn', 'ka1', 9.6), 0)
+    assert_not_equal(table.cs('Zn', 'ka1', 9.7), 0)
+    assert_raises(KeyError, table.line_index, 'xx1')
+
+    tmp = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmp, 'table.npz')
+        table.save(fname)
+        loaded = XrfTable.load(fname)
+        assert_array_equal(loaded.cs_table, table.cs_table)
+        assert_array_equal(loaded.line_energy, table.line_energy)
+        assert_equal(list(loaded.lines), list(table.lines))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_get_xrf_table():
+    tmp = tempfile.mkdtemp()
+    old_env = dict((k, os.environ.get(k)) for k in ('SKBEAM_CACHE_DIR',
+                                                    'HOME'))
+    old_table = xrf._xrf_table
+    try:
+        # without a cache directory nothing is written to disk
+        os.environ.pop('SKBEAM_CACHE_DIR', None)
+        os.environ['HOME'] = tmp
+        xrf._xrf_table = None
+        table = get_xrf_table()
+        assert table is get_xrf_table()
+        assert_equal(table.element('Cu').emission_line['ka1'],
+                     XrfElement('Cu').emission_line['ka1'])
+        assert_equal(os.listdir(tmp), [])
+
+        # the cache directory gets the table, and loses the tables of
+        # other xraylib versions
+        cache_dir = os.path.join(tmp, 'cache')
+        os.makedirs(cache_dir)
+        stale = os.path.join(cache_dir, 'xrf_table_v1_xraylib-0.0.npz')
+        open(stale, 'w').close()
+        os.environ['SKBEAM_CACHE_DIR'] = cache_dir
+        xrf._xrf_table = None
+        table = get_xrf_table()
+        cached = os.listdir(cache_dir)
+        assert_equal(len(cached), 1)
+        assert_not_equal(cached[0], os.path.basename(stale))
+        loaded = get_xrf_table(cache_dir=cache_dir)
+        assert loaded is not table
+        assert_array_equal(loaded.cs_table, table.cs_table)
+    finally:
+        xrf._xrf_table = old_table
+        for key, value in old_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        shutil.rmtree(tmp)
+
+
 def smoke_test_element_creation():
     prev_element = None
     elements = [elm for abbrev, elm in six.iteritems(basic)
@@ -37,14 +37,17 @@
 # POSSIBILITY OF SUCH DAMAGE.                                          #
 ########################################################################
 from __future__ import absolute_import, division, print_function
-from collections import Mapping
+from collections import Mapping, OrderedDict
+import glob
 import logging
+import os
 
 import numpy as np
 import six
 
 from ..utils import NotInstalledError
-from ..constants.basic import (BasicElement, doc_params, doc_attrs, doc_ex)
+from ..constants.basic import (BasicElement, doc_params, doc_attrs, doc_ex,
+                               basic)
 from ..utils import verbosedict
 
 logger = logging.getLogger(__name__)
@@ -119,6 +122,19 @@ else:
         })
 
 
+def _xraylib_value(func, *args):
+    """Call an xraylib function, returning 0 for quantities that are not
+    valid.
+
+    Older versions of xraylib return 0 in that case, newer ones raise
+    ValueError.
+    """
+    try:
+        return func(*args)
+    except ValueError:
+        return 0.0
+
+
 class XrayLibWrap(Mapping):
     """High-level interface to xraylib.
 
@@ -205,8 +221,8 @@ class XrayLibWrap(Mapping):
             Define which physics quantity to calculate.
         """
 
-        return self._func(self._element,
-                          self._map[key.lower()])
+        return _xraylib_value(self._func, self._element,
+                              self._map[key.lower()])
 
     def __iter__(self):
         return iter(self._keys)
@@ -292,9 +308,9 @@ class XrayLibWrap_Energy(XrayLibWrap):
         key : str
             defines which physics quantity to calculate
         """
-        return self._func(self._element,
-                          self._map[key.lower()],
-                          self._incident_energy)
+        return _xraylib_value(self._func, self._element,
+                              self._map[key.lower()],
+                              self._incident_energy)
 
 # redefine the doc_title for xrf elements
 doc_title = """
@@ -542,23 +558,554 @@ def emission_line_search(line_e, delta_e, incident_energy,
     Returns
     -------
     lines_dict : dict
-        element and associate emission lines
+        element and associate emission lines. When `line_e` is an array,
+        a list with one dict per energy is returned.
+
+    Notes
+    -----
+    The search is done in the arrays of `get_xrf_table`, so that many
+    energies can be looked up at once with `XrfTable.search_lines`.
 
     """
     if xraylib is None:
         raise XraylibNotInstalledError(__name__)
 
-    if element_list is None:
-        element_list = range(1, 101)
+    table = get_xrf_table()
+    query, Z, line, energy = table.search_lines(
+        line_e, delta_e, incident_energy, element_list=element_list)
+
+    out = [dict() for _ in range(np.size(line_e))]
+    for q, z, index, v in zip(query.tolist(), Z.tolist(), line.tolist(),
+                              energy.tolist()):
+        out[q].setdefault(basic[z].sym, {})[table.lines[index]] = v
+
+    if np.ndim(line_e) == 0:
+        return out[0]
+    return out
+
+
+# version of the layout of the arrays saved by XrfTable
+_XRF_TABLE_VERSION = 1
+
+
+class XrfTable(object):
+    """Array-backed table of x-ray fluorescence constants.
+
+    Line energies, binding energies, jump factors and fluorescence yields
+    of every element are held in arrays indexed by (Z, line) or
+    (Z, shell), so looking them up does not call into xraylib.
+
+    Fluorescence cross sections are tabulated on an energy grid and
+    interpolated log-log in between. Each element gets its own grid: the
+    common energies, both sides of every absorption edge of the element
+    and extra points just above the edges where the cross sections change
+    quickly. `cs_at` gives exact values at a single incident energy when
+    xraylib is available.
+
+    Tables are created with `XrfTable.build` and stored with `save` and
+    `load`; `get_xrf_table` shares one table, optionally kept in an
+    on-disk cache.
+
+    Parameters
+    ----------
+    data : dict
+        the arrays of a table, as written by `save`
+
+    Attributes
+    ----------
+    lines : list
+        emission line names, such as 'ka1', in column order
+    shells : list
+        shell names, such as 'k' or 'l1', in column order
+    line_energy : array
+        emission line energies in keV, shape (max_z + 1, len(lines)).
+        Rows are indexed by atomic number, row 0 is unused.
+    binding_energy : array
+        binding energies in keV, shape (max_z + 1, len(shells))
+    jump_factor : array
+        absorption jump factors, shape (max_z + 1, len(shells))
+    fluor_yield : array
+        fluorescence yields, shape (max_z + 1, len(shells))
+    energy : array
+        incident energies in keV of the cross section tables, one row per
+        element, shape (max_z + 1, N)
+    cs_table : array
+        cross sections in cm2/g at ``energy``, shape
+        (max_z + 1, len(lines), N)
+    csb_factor : array
+        conversion factor from cm2/g to barns/atom for each element
+
+    Examples
+    --------
+    >>> table = get_xrf_table()
+    >>> table.line_energy[30, table.line_index('ka1')]
+    8.6389
+    >>> table.cs('Zn', 'ka1', [10, 12])  # interpolated
+    array([ 57.05839686,  35.88900906])
+    """
+    _array_names = ['line_energy', 'binding_energy', 'jump_factor',
+                    'fluor_yield', 'energy', 'cs_table', 'csb_factor']
+
+    def __init__(self, data):
+        self.lines = [str(name) for name in data['lines']]
+        self.shells = [str(s) for s in data['shells']]
+        for name in self._array_names:
+            setattr(self, name, np.asarray(data[name]))
+        self.max_z = len(self.line_energy) - 1
+        self._line_index = dict((name, i)
+                                for i, name in enumerate(self.lines))
+
+        # search all element grids at once: offset each row of
+        # log(energy) so that the rows are sorted one after the other
+        self._log_energy = np.log(self.energy[1:])
+        self._row_offset = (self._log_energy.max() -
+                            self._log_energy.min() + 1)
+        self._keys = (self._log_energy + self._row_offset *
+                      np.arange(self.max_z)[:, np.newaxis]).ravel()
+        self._cs_rows = OrderedDict()
+
+        # every (Z, line) of the table sorted by line energy, for searches
+        Z, line = np.nonzero(np.ones(self.line_energy.shape, dtype=bool))
+        Z, line = Z[Z > 0], line[Z > 0]
+        order = np.argsort(self.line_energy[Z, line], kind='mergesort')
+        self._search_z = Z[order]
+        self._search_line = line[order]
+        self._search_energy = self.line_energy[Z, line][order]
+
+    @classmethod
+    def build(cls, max_z=100, energy_grid=None, edge_points=32):
+        """Compute a table with xraylib.
+
+        Parameters
+        ----------
+        max_z : int, optional
+            largest atomic number in the table
+        energy_grid : array, optional
+            common incident energies in keV of the cross section tables,
+            default is 300 log-spaced energies from 0.5 to 100 keV
+        edge_points : int, optional
+            number of extra energies above each absorption edge
+
+        Returns
+        -------
+        XrfTable
+        """
+        if xraylib is None:
+            raise XraylibNotInstalledError(cls)
+        if energy_grid is None:
+            energy_grid = np.logspace(np.log10(0.5), 2, 300)
+        energy_grid = np.unique(np.asarray(energy_grid, dtype=float))
+        lines = sorted(line_dict)
+        shells = sorted(shell_dict)
+        num_z = max_z + 1
+
+        def table(names, codes, func):
+            out = np.zeros((num_z, len(names)))
+            for Z in range(1, num_z):
+                for i, name in enumerate(names):
+                    out[Z, i] = _xraylib_value(func, Z, codes[name])
+            return out
+
+        data = {'lines': lines, 'shells': shells,
+                'line_energy': table(lines, line_dict, xraylib.LineEnergy),
+                'binding_energy': table(shells, shell_dict,
+                                        xraylib.EdgeEnergy),
+                'jump_factor': table(shells, shell_dict,
+                                     xraylib.JumpFactor),
+                'fluor_yield': table(shells, shell_dict,
+                                     xraylib.FluorYield)}
+        data['csb_factor'] = np.array(
+            [0] + [xraylib.AtomicWeight(Z) / xraylib.AVOGNUM
+                   for Z in range(1, num_z)])
+
+        low, high = energy_grid[0], energy_grid[-1]
+        above = 1 + np.logspace(-5, np.log10(0.2), edge_points)
+        grids = []
+        for Z in range(1, num_z):
+            edges = np.unique(data['binding_energy'][Z])
+            edges = edges[(edges > low) & (edges < high)]
+            near = (edges[:, np.newaxis] * above).ravel()
+            near = near[near < high]
+            # each edge appears twice, evaluated just below and just above
+            energy = np.concatenate([energy_grid, near, edges, edges])
+            evaluate = np.concatenate([energy_grid, near,
+                                       edges * (1 - 1e-9),
+                                       edges * (1 + 1e-9)])
+            order = np.lexsort((evaluate, energy))
+            grids.append((energy[order], evaluate[order]))
+
+        num_energy = max(len(energy) for energy, _ in grids)
+        data['energy'] = np.empty((num_z, num_energy))
+        data['energy'][0] = energy_grid[-1]
+        data['cs_table'] = np.zeros((num_z, len(lines), num_energy))
+        for Z, (energy, evaluate) in enumerate(grids, 1):
+            # pad by repeating the last energy
+            data['energy'][Z] = energy[-1]
+            data['energy'][Z, :len(energy)] = energy
+            for i, line in enumerate(lines):
+                cs = [_xraylib_value(xraylib.CS_FluorLine_Kissel, Z,
+                                     line_dict[line], e) for e in evaluate]
+                data['cs_table'][Z, i, :len(cs)] = cs
+                data['cs_table'][Z, i, len(cs):] = cs[-1]
+        return cls(data)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a table written by `save`."""
+        with np.load(filename) as f:
+            if int(f['version']) != _XRF_TABLE_VERSION:
+                raise ValueError("{} holds a table of an unsupported "
+                                 "version".format(filename))
+            return cls(dict((k, f[k]) for k in f.files))
+
+    def save(self, filename):
+        """Write the table to an ``.npz`` file."""
+        data = dict((name, getattr(self, name))
+                    for name in self._array_names)
+        np.savez(filename, version=_XRF_TABLE_VERSION,
+                 lines=self.lines, shells=self.shells, **data)
+
+    def z(self, element):
+        """Atomic number(s) of element symbol(s), names or numbers."""
+        if isinstance(element, six.string_types):
+            return basic[element.lower()].Z
+        element = np.asarray(element)
+        if element.dtype.kind in 'iu':
+            return int(element) if element.ndim == 0 else element
+        return np.array([self.z(e) for e in element.ravel()],
+                        dtype=int).reshape(element.shape)
+
+    def line_index(self, line):
+        """Column index of emission line name(s), such as 'Ka1'."""
+        if isinstance(line, six.string_types):
+            return self._line_index[line.lower()]
+        line = np.asarray(line)
+        if line.dtype.kind in 'iu':
+            return line
+        return np.array([self._line_index[name.lower()]
+                         for name in line.ravel()],
+                        dtype=int).reshape(line.shape)
+
+    def element(self, element):
+        """Table-backed stand-in for `XrfElement`.
+
+        Parameters
+        ----------
+        element : str or int
+            element symbol, name or atomic number
+
+        Returns
+        -------
+        XrfTableElement
+        """
+        return XrfTableElement(self, element)
+
+    def emission_lines(self, element):
+        """Line energies of an element.
+
+        Parameters
+        ----------
+        element : str or int
+            element symbol, name or atomic number
+
+        Returns
+        -------
+        OrderedDict
+            emission line name to energy in keV, in the same order as
+            ``XrfElement(element).emission_line.all``
+        """
+        return OrderedDict(zip(self.lines,
+                               self.line_energy[self.z(element)].tolist()))
+
+    def cs(self, element, line, incident_energy, unit='cs'):
+        """Interpolated fluorescence cross sections.
+
+        ``element``, ``line`` and ``incident_energy`` are broadcast
+        against each other.
+
+        Parameters
+        ----------
+        element : str, int or array
+            element symbols, names or atomic numbers
+        line : str, int or array
+            emission line names or column indices
+        incident_energy : float or array
+            incident x-ray energy in keV
+        unit : {'cs', 'csb'}, optional
+            cm2/g or barns/atom
+
+        Returns
+        -------
+        array
+            cross sections
+        """
+        Z, line, energy = np.broadcast_arrays(self.z(element),
+                                              self.line_index(line),
+                                              np.asarray(incident_energy,
+                                                         dtype=float))
+        row = Z - 1
+        if np.any((Z < 1) | (Z > self.max_z)):
+            raise ValueError("atomic numbers must be between 1 and "
+                             "{}".format(self.max_z))
+        if np.any((energy < self.energy[Z, 0]) |
+                  (energy > self.energy[Z, -1])):
+            raise ValueError("incident energy outside of the tabulated "
+                             "range {} to {} keV".format(
+                                 self.energy[1:, 0].max(),
+                                 self.energy[1:, -1].min()))
+        log_energy = np.log(energy)
+        num_energy = self.energy.shape[1]
+        j = np.searchsorted(self._keys, log_energy + self._row_offset * row,
+                            side='right') - 1 - row * num_energy
+        j = np.clip(j, 0, num_energy - 2)
+
+        x0 = self._log_energy[row, j]
+        dx = self._log_energy[row, j + 1] - x0
+        t = np.where(dx > 0, (log_energy - x0) / np.where(dx > 0, dx, 1), 0)
+        y0 = self.cs_table[Z, line, j]
+        y1 = self.cs_table[Z, line, j + 1]
+        positive = (y0 > 0) & (y1 > 0)
+        log_y0 = np.log(np.where(positive, y0, 1))
+        log_y1 = np.log(np.where(positive, y1, 1))
+        out = np.where(positive, np.exp(log_y0 + t * (log_y1 - log_y0)),
+                       y0 + t * (y1 - y0))
+        if unit == 'csb':
+            out = out * self.csb_factor[Z]
+        elif unit != 'cs':
+            raise ValueError("unit must be 'cs' or 'csb', not "
+                             "{!r}".format(unit))
+        return out
+
+    def cs_at(self, incident_energy, unit='cs'):
+        """Cross sections of all elements and lines at one energy.
+
+        Values are computed with xraylib when it is installed, otherwise
+        interpolated with `cs`. The last few energies asked for are kept
+        in memory.
+
+        Parameters
+        ----------
+        incident_energy : float
+            incident x-ray energy in keV
+        unit : {'cs', 'csb'}, optional
+            cm2/g or barns/atom
+
+        Returns
+        -------
+        array
+            read-only cross sections of shape (max_z + 1, len(lines)),
+            indexed like `line_energy`
+        """
+        incident_energy = float(incident_energy)
+        key = (incident_energy, unit)
+        if key in self._cs_rows:
+            cs = self._cs_rows.pop(key)
+        elif xraylib is not None:
+            func = {'cs': xraylib.CS_FluorLine_Kissel,
+                    'csb': xraylib.CSb_FluorLine_Kissel}[unit]
+            cs = np.zeros(self.line_energy.shape)
+            for Z in range(1, self.max_z + 1):
+                for i, line in enumerate(self.lines):
+                    cs[Z, i] = _xraylib_value(func, Z, line_dict[line],
+                                              incident_energy)
+            cs.flags.writeable = False
+        else:
+            cs = np.zeros(self.line_energy.shape)
+            cs[1:] = self.cs(np.arange(1, self.max_z + 1)[:, np.newaxis],
+                             np.arange(len(self.lines)), incident_energy,
+                             unit=unit)
+            cs.flags.writeable = False
+        self._cs_rows[key] = cs
+        while len(self._cs_rows) > 8:
+            self._cs_rows.popitem(last=False)
+        return cs
+
+    def search_lines(self, line_e, delta_e, incident_energy,
+                     element_list=None):
+        """Find the emission lines near one or more energies.
+
+        A line matches an energy ``e`` when ``abs(line_energy - e) <
+        delta_e`` and its cross section at `incident_energy` is not zero.
+        The candidates of all queries are found with a binary search in
+        the lines sorted by energy.
+
+        Parameters
+        ----------
+        line_e : float or array
+            energies to search for in keV
+        delta_e : float or array
+            half-width of the search windows in keV
+        incident_energy : float
+            incident x-ray energy in keV
+        element_list : list, optional
+            elements to restrict the search to, default is all elements
 
-    search_list = [XrfElement(item) for item in element_list]
+        Returns
+        -------
+        query : array
+            index into the flattened `line_e` of each match
+        Z : array
+            atomic number of each match
+        line : array
+            column in `lines` of each match
+        energy : array
+            line energy in keV of each match
+        """
+        line_e = np.ravel(line_e).astype(float)
+        delta_e = np.broadcast_to(np.asarray(delta_e, dtype=float),
+                                  line_e.shape)
+        energy = self._search_energy
+        # the windows are widened a little here, the exact test follows
+        pad = np.abs(delta_e) * 1e-12 + 1e-12
+        lo = np.searchsorted(energy, line_e - delta_e - pad, side='left')
+        hi = np.searchsorted(energy, line_e + delta_e + pad, side='right')
+        counts = np.maximum(hi - lo, 0)
+        query = np.repeat(np.arange(len(line_e)), counts)
+        # the positions lo[i] ... hi[i] - 1 of every query, back to back
+        idx = (np.arange(counts.sum()) +
+               np.repeat(lo - np.cumsum(counts) + counts, counts))
+
+        keep = np.abs(energy[idx] - line_e[query]) < delta_e[query]
+        cs = self.cs_at(incident_energy)
+        keep &= cs[self._search_z[idx], self._search_line[idx]] != 0
+        if element_list is not None:
+            keep &= np.in1d(self._search_z[idx],
+                            [self.z(e) for e in element_list])
+        query, idx = query[keep], idx[keep]
+        return (query, self._search_z[idx], self._search_line[idx],
+                energy[idx])
+
+
+class _TableRow(Mapping):
+    """Read-only, case-insensitive mapping of names to table values."""
+
+    def __init__(self, index, names, values):
+        self._index = index
+        self._names = names
+        self._values = values
 
-    cand_lines = [e.line_near(line_e, delta_e, incident_energy)
-                  for e in search_list]
+    def __getitem__(self, key):
+        return self._values[self._index[key.lower()]]
 
-    out_dict = dict()
-    for e, lines in zip(search_list, cand_lines):
-        if lines:
-            out_dict[e.sym] = lines
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    @property
+    def all(self):
+        """List all the names and values, like `XrayLibWrap.all`."""
+        return list(zip(self._names, self._values))
 
-    return out_dict
+
+class XrfTableElement(object):
+    """Fluorescence data of one element, read from an `XrfTable`.
+
+    It offers the lookups of `XrfElement` that are used while setting up
+    fitting models, without calls into xraylib.
+
+    Parameters
+    ----------
+    table : XrfTable
+        table holding the data
+    element : str or int
+        element symbol, name or atomic number
+    """
+    def __init__(self, table, element):
+        self._table = table
+        self.Z = table.z(element)
+        self.sym = basic[self.Z].sym
+        self.emission_line = _TableRow(table._line_index, table.lines,
+                                       table.line_energy[self.Z].tolist())
+
+    def cs(self, incident_energy):
+        """Fluorescence cross sections in cm2/g at an incident energy"""
+        return _TableRow(self._table._line_index, self._table.lines,
+                         self._table.cs_at(incident_energy)[self.Z].tolist())
+
+    def csb(self, incident_energy):
+        """Fluorescence cross sections in barns/atom at an incident energy"""
+        return _TableRow(self._table._line_index, self._table.lines,
+                         self._table.cs_at(incident_energy,
+                                           unit='csb')[self.Z].tolist())
+
+
+_xrf_table = None
+
+
+def _xrf_cache_dir():
+    return os.environ.get('SKBEAM_CACHE_DIR')
+
+
+def _prune_xrf_cache(cache_dir, keep):
+    """Remove the cached tables other than ``keep``, which are of other
+    xraylib or table versions and would never be read again."""
+    for filename in glob.glob(os.path.join(cache_dir, 'xrf_table_v*.npz')):
+        if filename != keep and '.tmp.' not in filename:
+            try:
+                os.remove(filename)
+            except OSError as err:
+                logger.warning('could not remove %s: %s', filename, err)
+
+
+def get_xrf_table(cache_dir=None):
+    """Return the shared `XrfTable`.
+
+    The table is built with xraylib the first time it is needed, which
+    takes a few seconds, and kept for the rest of the process. It is
+    only kept on disk if a cache directory is given, or named by the
+    ``SKBEAM_CACHE_DIR`` environment variable: it is then loaded from
+    there when it has been computed before, and the tables of other
+    xraylib versions are removed from the directory when it is saved.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        directory of the on-disk cache. Defaults to the
+        ``SKBEAM_CACHE_DIR`` environment variable; without either the
+        table is not written to disk.
+
+    Returns
+    -------
+    XrfTable
+    """
+    global _xrf_table
+    if _xrf_table is not None and cache_dir is None:
+        return _xrf_table
+    if cache_dir is None:
+        cache_dir = _xrf_cache_dir()
+    if cache_dir is None:
+        _xrf_table = XrfTable.build()
+        return _xrf_table
+    if xraylib is None:
+        version = '*'
+    else:
+        version = getattr(xraylib, '__version__', 'unknown')
+    pattern = os.path.join(cache_dir, 'xrf_table_v{}_xraylib-{}.npz'.format(
+        _XRF_TABLE_VERSION, version))
+
+    table = None
+    for filename in sorted(glob.glob(pattern), reverse=True):
+        try:
+            table = XrfTable.load(filename)
+            break
+        except (IOError, OSError, ValueError, KeyError) as err:
+            logger.warning('could not read %s: %s', filename, err)
+    if table is None:
+        table = XrfTable.build()
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # write to a temporary name so that readers never see a
+            # partial file
+            temp = pattern + '.{}.tmp.npz'.format(os.getpid())
+            table.save(temp)
+            os.rename(temp, pattern)
+        except (IOError, OSError) as err:
+            logger.warning('could not cache the xrf table in %s: %s',
+                           cache_dir, err)
+        else:
+            _prune_xrf_cache(cache_dir, keep=pattern)
+    _xrf_table = table
+    return table
@@ -45,6 +45,7 @@ This module is for functions specific to time correlation
 from __future__ import absolute_import, division, print_function
 from .utils import multi_tau_lags
 from .roi import extract_label_indices
+from .mask import roi_frame
 from collections import namedtuple
 import numpy as np
 from scipy.signal import fftconvolve
@@ -62,7 +63,7 @@ logger = logging.getLogger(__name__)
 
 def _one_time_process(buf, G, past_intensity_norm, future_intensity_norm,
                       label_array, num_bufs, num_pixels, img_per_level,
-                      level, buf_no, norm, lev_len):
+                      level, buf_no, norm, lev_len, buf_bad=None):
     """Reference implementation of the inner loop of multi-tau one time
     correlation
 
@@ -98,6 +99,9 @@ def _one_time_process(buf, G, past_intensity_norm, future_intensity_norm,
         to track bad images
     lev_len : array
         length of each level
+    buf_bad : array, optional
+        flags of the bad images in `buf`, shape (num_levels, num_bufs).
+        If not given, bad images are found by scanning `buf` for np.nan
 
     Notes
     -----
@@ -127,8 +131,12 @@ def _one_time_process(buf, G, past_intensity_norm, future_intensity_norm,
         normalize = img_per_level[level] - i - norm[level+1][ind]
 
         # take out the past_ing and future_img created using bad images
-        # (bad images are converted to np.nan array)
-        if np.isnan(past_img).any() or np.isnan(future_img).any():
+        # (bad images are flagged, or converted to np.nan array)
+        if buf_bad is not None:
+            is_bad = buf_bad[level, delay_no] or buf_bad[level, buf_no]
+        else:
+            is_bad = np.isnan(past_img).any() or np.isnan(future_img).any()
+        if is_bad:
             norm[level + 1][ind] += 1
         else:
             for w, arr in zip([past_img*future_img, past_img, future_img],
@@ -158,7 +166,8 @@ _internal_state = namedtuple(
      'num_pixels',
      'lag_steps',
      'norm',
-     'lev_len']
+     'lev_len',
+     'buf_bad']
 )
 
 _two_time_internal_state = namedtuple(
@@ -210,6 +219,8 @@ def _init_state_one_time(num_levels, num_bufs, labels):
     past_intensity = np.zeros_like(G)
     # matrix for normalizing G into g2
     future_intensity = np.zeros_like(G)
+    # flags of the bad images in the ring buffer
+    buf_bad = np.zeros(buf.shape[:2], dtype=bool)
 
     return _internal_state(
         buf,
@@ -225,6 +236,7 @@ def _init_state_one_time(num_levels, num_bufs, labels):
         lag_steps,
         norm,
         lev_len,
+        buf_bad,
     )
 
 
@@ -238,6 +250,9 @@ def lazy_one_time(image_iterable, num_levels, num_bufs, labels,
     Parameters
     ----------
     image_iterable : iterable of 2D arrays
+        The images may also be given as `skbeam.core.mask.roi_frame` objects
+        (see `skbeam.core.mask.roi_pixel_gen`) holding the already extracted
+        ROI pixels and an explicit bad image flag
     num_levels : int
         how many generations of downsampling to perform, i.e., the depth of
         the binomial tree of averaged frames
@@ -307,15 +322,23 @@ def lazy_one_time(image_iterable, num_levels, num_bufs, labels,
         s.cur[0] = (1 + s.cur[0]) % num_bufs
 
         # Put the ROI pixels into the ring buffer.
-        s.buf[0, s.cur[0] - 1] = np.ravel(image)[s.pixel_list]
         buf_no = s.cur[0] - 1
+        if isinstance(image, roi_frame):
+            s.buf_bad[0, buf_no] = image.bad
+            if not image.bad:
+                s.buf[0, buf_no] = image.pixels
+        else:
+            s.buf[0, buf_no] = np.ravel(image)[s.pixel_list]
+            # bad images are converted to np.nan array by bad_to_nan_gen
+            s.buf_bad[0, buf_no] = np.isnan(s.buf[0, buf_no]).any()
         # Compute the correlations between the first level
         # (undownsampled) frames. This modifies G,
         # past_intensity, future_intensity,
         # and img_per_level in place!
         _one_time_process(s.buf, s.G, s.past_intensity, s.future_intensity,
                           s.label_array, num_bufs, s.num_pixels,
-                          s.img_per_level, level, buf_no, s.norm, s.lev_len)
+                          s.img_per_level, level, buf_no, s.norm, s.lev_len,
+                          s.buf_bad)
 
         # check whether the number of levels is one, otherwise
         # continue processing the next level
@@ -334,6 +357,9 @@ def lazy_one_time(image_iterable, num_levels, num_bufs, labels,
                 s.buf[level, s.cur[level] - 1] = ((
                         s.buf[level - 1, prev - 1] +
                         s.buf[level - 1, s.cur[level - 1] - 1]) / 2)
+                s.buf_bad[level, s.cur[level] - 1] = (
+                    s.buf_bad[level - 1, prev - 1] or
+                    s.buf_bad[level - 1, s.cur[level - 1] - 1])
 
                 # make the track_level zero once that level is processed
                 s.track_level[level] = False
@@ -345,7 +371,7 @@ def lazy_one_time(image_iterable, num_levels, num_bufs, labels,
                 _one_time_process(s.buf, s.G, s.past_intensity,
                                   s.future_intensity, s.label_array, num_bufs,
                                   s.num_pixels, s.img_per_level, level, buf_no,
-                                  s.norm, s.lev_len)
+                                  s.norm, s.lev_len, s.buf_bad)
                 level += 1
 
                 # Checking whether there is next level for processing
@@ -475,7 +501,9 @@ def lazy_two_time(labels, images, num_frames, num_bufs, num_levels=1,
         labeled array of the same shape as the image stack;
         each ROI is represented by a distinct label (i.e., integer)
     images : iterable of 2D arrays
-        dimensions are: (rr, cc), iterable of 2D arrays
+        dimensions are: (rr, cc), iterable of 2D arrays. The images may also
+        be given as `skbeam.core.mask.roi_frame` objects (see
+        `skbeam.core.mask.roi_pixel_gen`)
     num_frames : int
         number of images to use
         default is number of images
@@ -541,7 +569,13 @@ def lazy_two_time(labels, images, num_frames, num_bufs, num_levels=1,
         s = s._replace(current_img_time=(s.current_img_time + 1))
 
         # Put the image into the ring buffer.
-        s.buf[0, s.cur[0] - 1] = (np.ravel(img))[s.pixel_list]
+        if isinstance(img, roi_frame):
+            if img.bad:
+                s.buf[0, s.cur[0] - 1] = np.nan
+            else:
+                s.buf[0, s.cur[0] - 1] = img.pixels
+        else:
+            s.buf[0, s.cur[0] - 1] = (np.ravel(img))[s.pixel_list]
 
         # Compute the two time correlations between the first level
         # (undownsampled) frames. two_time and img_per_level in place!
@@ -755,7 +789,7 @@ def _validate_and_transform_inputs(num_bufs, num_levels, labels):
     ----------
     num_bufs : int
     num_levels : int
-    labels : array
+    labels : array or skbeam.core.roi.ROIIndex
         labeled array of the same shape as the image stack;
         each ROI is represented by a distinct label (i.e., integer)
 
@@ -792,14 +826,12 @@ def _validate_and_transform_inputs(num_bufs, num_levels, labels):
     label_array, pixel_list = extract_label_indices(labels)
 
     # map the indices onto a sequential list of integers starting at 1
-    label_mapping = {label: n+1
-                     for n, label in enumerate(np.unique(label_array))}
-    # remap the label array to go from 1 -> max(_labels)
-    for label, n in label_mapping.items():
-        label_array[label_array == label] = n
+    # i.e. remap the label array to go from 1 -> max(_labels)
+    unique_labels, label_array = np.unique(label_array, return_inverse=True)
+    label_array += 1
 
     # number of ROI's
-    num_rois = len(label_mapping)
+    num_rois = len(unique_labels)
 
     # stash the number of pixels in the mask
     num_pixels = np.bincount(label_array)[1:]
@@ -39,6 +39,7 @@ from __future__ import absolute_import, division, print_function
 from six.moves import zip
 import numpy as np
 from collections import deque
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
 from .fitting import fit_quad_to_peak
 import logging
 logger = logging.getLogger(__name__)
@@ -77,7 +78,11 @@ def peak_refinement(x, y, cands, window, refine_function, refine_args=None):
             center, height = refine_func(x, y, **kwargs)
 
         This function may raise `PeakRejection` to indicate no suitable
-        peak was found
+        peak was found.
+
+        If the function has a ``batch`` attribute, e.g. `refine_quadratic`
+        and `refine_log_quadratic`, all the candidates are refined at once
+        with it instead, see `batch_peak_refinement`.
 
     window : int
         How many samples to extract on either side of the
@@ -116,6 +121,11 @@ def peak_refinement(x, y, cands, window, refine_function, refine_args=None):
     window = int(window)
     if refine_args is None:
         refine_args = dict()
+    if hasattr(refine_function, 'batch') and window > 0 and len(x) > 2:
+        _, locations, heights = batch_peak_refinement(
+            x, y[np.newaxis], (np.zeros_like(cands), cands), window,
+            refine_function, refine_args)
+        return locations, heights
     # local working variables
     out_tmp = deque()
     max_ind = len(x)
@@ -135,6 +145,93 @@ def peak_refinement(x, y, cands, window, refine_function, refine_args=None):
     return tuple([np.array(_) for _ in zip(*out_tmp)])
 
 
+def batch_peak_refinement(x, y, cands, window, refine_function,
+                          refine_args=None):
+    """Refine candidate locations in many curves at once
+
+    The windows around all the candidates are gathered into a
+    (number of candidates, 2 * window + 1) array. If `refine_function` has
+    a ``batch`` attribute, as `refine_quadratic` and `refine_log_quadratic`
+    do, it fits all the windows at once and rejects peaks with a mask;
+    otherwise `refine_function` is called on each window.
+
+    Parameters
+    ----------
+    x : array
+        The independent variable, either shared by all the curves or with
+        the shape of `y`.
+
+    y : array
+        The dependent variable, one curve per row.
+
+    cands : tuple of arrays
+        The row and the index in the row of each candidate peak, e.g. as
+        returned by ``scipy.signal.argrelmax(y, axis=1)``.
+
+    window : int
+        How many samples to extract on either side of the candidate
+        locations. The window is truncated near the ends of the curves.
+
+    refine_function : function
+        The function refining each peak, see `peak_refinement`. Its
+        ``batch`` attribute, if any, must have the signature::
+
+            centers, heights, accepted = refine_func.batch(x, y, valid,
+                                                           **kwargs)
+
+        where `x` and `y` are the windows, one per row, `valid` flags the
+        samples of the windows which are within the data and `accepted`
+        is False for the rejected peaks.
+
+    refine_args : dict, optional
+        The passed to the refine_function
+
+    Returns
+    -------
+    rows : array
+        The row of each refined peak
+
+    peak_locations : array
+        The locations of the peaks
+
+    peak_heights : array
+        The heights of the peaks
+    """
+    y = np.atleast_2d(y)
+    x = np.broadcast_to(x, y.shape)
+    rows, cands = (np.asarray(c, dtype=int) for c in cands)
+    window = int(window)
+    if refine_args is None:
+        refine_args = dict()
+    max_ind = y.shape[1]
+
+    batch = getattr(refine_function, 'batch', None)
+    if batch is not None:
+        index = cands[:, np.newaxis] + np.arange(-window, window + 1)
+        valid = (index >= 0) & (index < max_ind)
+        index = np.clip(index, 0, max_ind - 1)
+        x_win = x[rows[:, np.newaxis], index]
+        y_win = y[rows[:, np.newaxis], index]
+        locations, heights, accepted = batch(x_win, y_win, valid,
+                                             **refine_args)
+        return rows[accepted], locations[accepted], heights[accepted]
+
+    out_tmp = deque()
+    for row, ind in zip(rows, cands):
+        slc = slice(np.max([0, ind-window]),
+                    np.min([max_ind, ind + window + 1]))
+        try:
+            ret = refine_function(x[row, slc], y[row, slc], **refine_args)
+        except PeakRejection:
+            continue
+        else:
+            out_tmp.append((row, ) + tuple(ret))
+    if not out_tmp:
+        return np.zeros(0, dtype=int), np.zeros(0), np.zeros(0)
+    rows, locations, heights = (np.array(_) for _ in zip(*out_tmp))
+    return rows, locations, heights
+
+
 def refine_quadratic(x, y, Rval_thresh=None):
     """
     Attempts to refine the peaks by fitting to
@@ -213,6 +310,88 @@ def refine_log_quadratic(x, y, Rval_thresh=None):
     return beta[1], np.exp(beta[2])
 
 
+def _fit_quad_windows(x, y, valid=None):
+    """
+    Closed form least squares fits of a quadratic to many windows at once
+
+    Each row of `x` and `y` is fit, as in `fit_quad_to_peak`, to
+    ``y = b[0](x-b[1])**2 + b[2]``. The normal equations are solved in
+    coordinates relative to the middle sample of each row, which keeps them
+    well conditioned.
+
+    Parameters
+    ----------
+    x, y : array
+        The windows, shape (number of windows, window length)
+    valid : array, optional
+        Boolean array of the same shape; samples where it is False (e.g.
+        past the ends of the data) are left out of the fit
+
+    Returns
+    -------
+    beta : array
+        The coefficients of each fit, shape (3, number of windows)
+    R2 : array
+        The R2 value of each fit
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if valid is None:
+        valid = np.ones(x.shape, dtype=bool)
+    w = valid.astype(float)
+    x0 = x[:, x.shape[1] // 2]
+    u = np.where(valid, x - x0[:, np.newaxis], 0)
+    y = np.where(valid, y, 0)
+    # moments of u, and of u against y
+    u_pow = [w, u, u * u, u ** 3, u ** 4]
+    S = [np.sum(p, axis=1) for p in u_pow]
+    T = [np.sum(u_pow[k] * y, axis=1) for k in range(3)]
+    # y = c[0] u**2 + c[1] u + c[2]
+    A = np.array([[S[4], S[3], S[2]],
+                  [S[3], S[2], S[1]],
+                  [S[2], S[1], S[0]]]).transpose(2, 0, 1)
+    b = np.array([T[2], T[1], T[0]]).T
+    c = np.linalg.solve(A, b[..., np.newaxis])[..., 0].T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fit = c[0][:, np.newaxis] * u * u + c[1][:, np.newaxis] * u + \
+            c[2][:, np.newaxis]
+        SSerr = np.sum(w * (fit - y) ** 2, axis=1)
+        mean = T[0] / S[0]
+        SStot = np.sum(w * (y - mean[:, np.newaxis]) ** 2, axis=1)
+        shift = -c[1] / (2 * c[0])
+        beta = np.array([c[0], x0 + shift, c[2] - c[0] * shift ** 2])
+        return beta, 1 - SSerr / SStot
+
+
+def _batch_refine_quadratic(x, y, valid, Rval_thresh=None):
+    """`refine_quadratic` of every row of `x` and `y` at once"""
+    beta, R2 = _fit_quad_windows(x, y, valid)
+    accepted = _accept_fits(R2, valid, Rval_thresh)
+    return beta[1], beta[2], accepted
+
+
+def _batch_refine_log_quadratic(x, y, valid, Rval_thresh=None):
+    """`refine_log_quadratic` of every row of `x` and `y` at once"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta, R2 = _fit_quad_windows(x, np.log(y), valid)
+    accepted = _accept_fits(R2, valid, Rval_thresh)
+    return beta[1], np.exp(beta[2]), accepted
+
+
+def _accept_fits(R2, valid, Rval_thresh):
+    """The fits which refine_quadratic would not reject"""
+    if np.any(np.sum(valid, axis=1) < 3):
+        raise ValueError('insufficient points handed in')
+    if Rval_thresh is None:
+        return np.ones(len(R2), dtype=bool)
+    # like `R2 < Rval_thresh`, nan is not rejected
+    return ~(R2 < Rval_thresh)
+
+
+refine_quadratic.batch = _batch_refine_quadratic
+refine_log_quadratic.batch = _batch_refine_log_quadratic
+
+
 def filter_n_largest(y, cands, N):
     """Filters the N largest candidate peaks
 
@@ -279,16 +458,118 @@ def filter_peak_height(y, cands, thresh, window=5):
 
     """
     y = np.asarray(y)
-    out_tmp = deque()
-    max_ind = len(y)
-    for ind in cands:
-        slc = slice(np.max([0, ind-window]),
-                    np.min([max_ind, ind + window + 1]))
-        pk_hght = np.ptp(y[slc])
-        if pk_hght > thresh:
-            out_tmp.append(ind)
+    cands = np.asarray(cands, dtype=int)
+    _, cands = batch_filter_peak_height(y[np.newaxis],
+                                        ([0, len(cands)], cands),
+                                        thresh, window=window)
+    return cands
+
+
+def batch_filter_peak_height(y, cands, thresh, window=5):
+    """
+    `filter_peak_height` for the candidate peaks of many curves at once
+
+    The peak-to-peak height in the window around each candidate is taken
+    from sliding window maxima and minima (or, for few candidates, from
+    the gathered windows), without a loop over the candidates.
+
+    Parameters
+    ----------
+    y : array
+        The curves, one per row
+
+    cands : tuple of arrays
+        The candidates of all the rows in CSR form ``(indptr, indices)``:
+        the candidates of row ``i`` are ``indices[indptr[i]:indptr[i+1]]``
+
+    thresh : float or array
+        The minimum peak-to-peak size of the candidate peak to be accepted,
+        or one threshold per row
+
+    window : int, optional
+        The size of the window around the peak to consider
+
+    Returns
+    -------
+    cands : tuple of arrays
+        The candidates which pass the filter, in CSR form
+        ``(indptr, indices)``
+    """
+    y = np.atleast_2d(y)
+    indptr, indices = (np.asarray(c, dtype=int) for c in cands)
+    num_rows, max_ind = y.shape
+    rows = np.repeat(np.arange(num_rows), np.diff(indptr))
+    thresh = np.broadcast_to(thresh, (num_rows, ))
+    window = int(window)
+    size = 2 * window + 1
+    if len(indices) * size > y.size:
+        # the window is clipped to the curve, and so is the nearest mode
+        pk_hght = (maximum_filter1d(y, size, axis=1, mode='nearest') -
+                   minimum_filter1d(y, size, axis=1, mode='nearest'))
+        pk_hght = pk_hght[rows, indices]
+        # the filters skip over NaN; the windows holding one get a NaN
+        # height instead, as np.ptp and the gathered windows give
+        nan_count = np.zeros((num_rows, max_ind + 1), dtype=int)
+        np.cumsum(np.isnan(y), axis=1, out=nan_count[:, 1:])
+        lo = np.clip(indices - window, 0, max_ind)
+        hi = np.clip(indices + window + 1, 0, max_ind)
+        has_nan = nan_count[rows, hi] > nan_count[rows, lo]
+        pk_hght[has_nan] = np.nan
+    else:
+        # repeating the end values does not change the window extrema
+        index = np.clip(indices[:, np.newaxis] + np.arange(-window,
+                                                           window + 1),
+                        0, max_ind - 1)
+        windows = y[rows[:, np.newaxis], index]
+        pk_hght = windows.max(axis=1) - windows.min(axis=1)
+    keep = pk_hght > thresh[rows]
+    return _csr(rows[keep], num_rows), indices[keep]
+
+
+def batch_filter_n_largest(y, cands, N):
+    """
+    `filter_n_largest` for the candidate peaks of many curves at once
+
+    Parameters
+    ----------
+    y : array
+        The curves, one per row
+
+    cands : tuple of arrays
+        The candidates of all the rows in CSR form ``(indptr, indices)``
+
+    N : int
+        The maximum number of peaks to return per row, sorted by size.
+        Must be positive
+
+    Returns
+    -------
+    cands : tuple of arrays
+        In CSR form, up to the N largest candidates of each row in
+        descending order
+    """
+    y = np.atleast_2d(y)
+    indptr, indices = (np.asarray(c, dtype=int) for c in cands)
+    N = int(N)
+    if N <= 0:
+        raise ValueError("The maximum number of peaks to return must "
+                         "be positive not {}".format(N))
+    num_rows = y.shape[0]
+    rows = np.repeat(np.arange(num_rows), np.diff(indptr))
+    # by row, then by descending height
+    order = np.lexsort((-y[rows, indices], rows))
+    rows, indices = rows[order], indices[order]
+    rank = np.arange(len(rows)) - indptr[rows]
+    keep = rank < N
+    return _csr(rows[keep], num_rows), indices[keep]
+
+
+def _csr(rows, num_rows):
+    """The CSR indptr of entries in the (sorted) `rows`"""
+    indptr = np.zeros(num_rows + 1, dtype=int)
+    np.cumsum(np.bincount(rows, minlength=num_rows), out=indptr[1:])
+    return indptr
 
-    return np.array(out_tmp)
 
 # add our refinement functions as an attribute on peak_refinement
 # ta make auto-wrapping for vistrials easier.
@@ -39,7 +39,7 @@ from __future__ import absolute_import, division, print_function
 
 import logging
 logger = logging.getLogger(__name__)
-from .background import snip_method
+from .background import snip_method, snip_method_batch
 from .models import (Lorentzian2Model, ComptonModel, ElasticModel)
 
 from .lineshapes import (gaussian, lorentzian, lorentzian2, voigt, pvoigt,
@@ -116,7 +116,85 @@ def snip_method(spectrum,
            geoscience applications", Nuclear Instruments and Methods in
            Physics Research Section B, vol. 34, 1998.
     """
-    # clean input a bit
+    con_val, iter_num = _snip_defaults(spectral_binning, con_val, iter_num)
+
+    background = np.array(spectrum)
+    n_background = background.size
+
+    # smooth the background
+    s = scipy.signal.boxcar(con_val)
+
+    # For background remove, we only care about the central parts
+    # where there are peaks. On the boundary part, we don't care
+    # the accuracy so much. But we need to pay attention to edge
+    # effects in general convolution.
+    A = s.sum()
+    background = scipy.signal.convolve(background, s, mode='same')/A
+
+    windows = _snip_windows(n_background, e_off, e_lin, e_quad, xmin, xmax,
+                            epsilon, width, decrease_factor,
+                            spectral_binning, iter_num, width_threshold)
+    return _snip_clip(background, windows)
+
+
+def snip_method_batch(spectra,
+                      e_off, e_lin, e_quad,
+                      xmin=0, xmax=4096, epsilon=2.96,
+                      width=0.5, decrease_factor=np.sqrt(2),
+                      spectral_binning=None,
+                      con_val=None,
+                      iter_num=None,
+                      width_threshold=0.5,
+                      chunk_size=None):
+    """
+    use snip algorithm to obtain the background of many spectra
+
+    All spectra share the energy calibration, so the clipping windows
+    are computed once and every iteration is applied to a whole block of
+    spectra at a time. The result is the same as calling `snip_method`
+    on each spectrum.
+
+    Parameters
+    ----------
+    spectra : array
+        intensity spectra, shape (N, channels)
+    e_off, e_lin, e_quad, xmin, xmax, epsilon, width, decrease_factor,
+    spectral_binning, con_val, iter_num, width_threshold
+        see `snip_method`
+    chunk_size : int, optional
+        number of spectra processed together, which bounds the
+        temporary memory. By default blocks hold about 2**18 values.
+
+    Returns
+    -------
+    background : array
+        output results with peak removed, shape (N, channels)
+    """
+    spectra = np.asarray(spectra)
+    if spectra.ndim != 2:
+        raise ValueError("spectra must be 2D (N, channels), not "
+                         "{}D".format(spectra.ndim))
+    con_val, iter_num = _snip_defaults(spectral_binning, con_val, iter_num)
+    num_spectra, n_background = spectra.shape
+    if chunk_size is None:
+        chunk_size = max(1, 2**18 // max(1, n_background))
+
+    s = scipy.signal.boxcar(con_val)[np.newaxis, :]
+    A = s.sum()
+    windows = _snip_windows(n_background, e_off, e_lin, e_quad, xmin, xmax,
+                            epsilon, width, decrease_factor,
+                            spectral_binning, iter_num, width_threshold)
+
+    result = np.empty(spectra.shape, dtype=float)
+    for start in range(0, num_spectra, chunk_size):
+        chunk = np.array(spectra[start:start + chunk_size], dtype=float)
+        chunk = scipy.signal.convolve(chunk, s, mode='same')/A
+        result[start:start + chunk_size] = _snip_clip(chunk, windows)
+    return result
+
+
+def _snip_defaults(spectral_binning, con_val, iter_num):
+    """Fill in the default boxcar size and number of iterations."""
     if con_val is None:
         if spectral_binning is None:
             con_val = _defaults['con_val_no_bin']
@@ -128,11 +206,19 @@ def snip_method(spectrum,
             iter_num = _defaults['iter_num_no_bin']
         else:
             iter_num = _defaults['iter_num_bin']
+    return con_val, iter_num
 
-    background = np.array(spectrum)
-    n_background = background.size
 
-    energy = np.arange(n_background, dtype=np.float)
+def _snip_windows(n_background, e_off, e_lin, e_quad, xmin, xmax, epsilon,
+                  width, decrease_factor, spectral_binning, iter_num,
+                  width_threshold):
+    """
+    Return the (lo_index, hi_index) pairs of every snip iteration.
+
+    They depend only on the energy calibration and the number of
+    channels, not on the spectrum.
+    """
+    energy = np.arange(n_background, dtype=float)
 
     if spectral_binning is not None:
         energy = energy * spectral_binning
@@ -145,59 +231,45 @@ def snip_method(spectrum,
     tmp[tmp < 0] = 0
     fwhm = std_fwhm * np.sqrt(tmp)
 
-    # smooth the background
-    s = scipy.signal.boxcar(con_val)
-
-    # For background remove, we only care about the central parts
-    # where there are peaks. On the boundary part, we don't care
-    # the accuracy so much. But we need to pay attention to edge
-    # effects in general convolution.
-    A = s.sum()
-    background = scipy.signal.convolve(background, s, mode='same')/A
-
     window_p = width * fwhm / e_lin
     if spectral_binning is not None and spectral_binning > 0:
         window_p = window_p/2.
 
-    background = np.log(np.log(background + 1) + 1)
-
     index = np.arange(n_background)
+    low = np.max([xmin, 0])
+    high = np.min([xmax, n_background - 1])
 
-    # FIRST SNIPPING
-    for j in range(iter_num):
-        lo_index = np.clip(index - window_p,
-                           np.max([xmin, 0]),
-                           np.min([xmax, n_background - 1]))
-        hi_index = np.clip(index + window_p,
-                           np.max([xmin, 0]),
-                           np.min([xmax, n_background - 1]))
-
-        temp = (background[lo_index.astype(np.int)] +
-                background[hi_index.astype(np.int)]) / 2.
+    def clip_indices(current_width):
+        return (np.clip(index - current_width, low, high).astype(int),
+                np.clip(index + current_width, low, high).astype(int))
 
-        bg_index = background > temp
-        background[bg_index] = temp[bg_index]
+    # FIRST SNIPPING
+    windows = [clip_indices(window_p)] * iter_num
 
     current_width = window_p
     max_current_width = np.amax(current_width)
 
     while max_current_width >= width_threshold:
-        lo_index = np.clip(index - current_width,
-                           np.max([xmin, 0]),
-                           np.min([xmax, n_background - 1]))
-        hi_index = np.clip(index + current_width,
-                           np.max([xmin, 0]),
-                           np.min([xmax, n_background - 1]))
-
-        temp = (background[lo_index.astype(np.int)] +
-                background[hi_index.astype(np.int)]) / 2.
-
-        bg_index = background > temp
-        background[bg_index] = temp[bg_index]
+        windows.append(clip_indices(current_width))
 
         # decrease the width and repeat
         current_width = current_width / decrease_factor
         max_current_width = np.amax(current_width)
+    return windows
+
+
+def _snip_clip(background, windows):
+    """
+    Run the snip clipping on smoothed spectra along their last axis.
+    """
+    background = np.log(np.log(background + 1) + 1)
+
+    for lo_index, hi_index in windows:
+        temp = np.take(background, lo_index, axis=-1)
+        temp += np.take(background, hi_index, axis=-1)
+        temp /= 2.
+
+        background = np.where(background > temp, temp, background)
 
     background = np.exp(np.exp(background) - 1) - 1
 
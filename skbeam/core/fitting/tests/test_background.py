@@ -38,8 +38,9 @@
 from __future__ import absolute_import, division, print_function
 import numpy as np
 from numpy.testing import assert_allclose
+from nose.tools import assert_raises
 
-from skbeam.core.fitting import snip_method
+from skbeam.core.fitting import snip_method, snip_method_batch
 
 
 def test_snip_method():
@@ -77,6 +78,23 @@ def test_snip_method():
     assert_allclose(bg_true_part, bg_cal_part, rtol=1e-3, atol=1e-1)
 
 
+def test_snip_method_batch():
+    xval = np.arange(1000)
+    rs = np.random.RandomState(0)
+    centers = rs.uniform(0, 1000, size=(7, 1))
+    spectra = (rs.poisson(20 * np.exp(-xval / 300.), size=(7, 1000)) +
+               500 * np.exp(-0.5 * ((xval - centers) / 5.)**2))
+    for kwargs in [{}, {'spectral_binning': 2},
+                   {'xmin': 50, 'xmax': 800, 'width': 2}]:
+        expected = np.array([snip_method(y, 0.01, 0.01, 0., **kwargs)
+                             for y in spectra])
+        for chunk_size in [None, 3]:
+            bg = snip_method_batch(spectra, 0.01, 0.01, 0.,
+                                   chunk_size=chunk_size, **kwargs)
+            assert_allclose(bg, expected, rtol=1e-10, atol=1e-10)
+    assert_raises(ValueError, snip_method_batch, spectra[0], 0.01, 0.01, 0.)
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=['-s', '--with-doctest'], exit=False)
@@ -1,6 +1,8 @@
 from __future__ import absolute_import, division, print_function
 import copy
 import logging
+import os
+import tempfile
 
 import six
 import numpy as np
@@ -14,7 +16,10 @@ from skbeam.core.fitting.xrf_model import (
     construct_linear_model, trim, define_range, extract_strategy,
     sum_area, compute_escape_peak,
     register_strategy,  update_parameter_dict, _set_parameter_hint,
-    fit_pixel_multiprocess_nnls, _STRATEGY_REGISTRY, calculate_area
+    fit_pixel_multiprocess_nnls, _STRATEGY_REGISTRY, calculate_area,
+    fit_per_line_nnls, nnls_fit, nnls_fit_batch, cached_linear_model,
+    fit_pixel_multiprocess_nonlinear, _SpectrumFunction, bin_spectra,
+    unbin_map, fit_binned_nnls, fit_pixel_stream_nnls
 )
 
 logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s',
@@ -267,3 +272,360 @@ def test_pixel_fit_multiprocess():
             continue
         # compare with default value 1e5, and get difference < 1%
         assert_true(abs(v[0, 0] * 0.01 - default_area) / default_area < 1e-2)
+
+
+def _gaussian_design(num_channels, centers, sigma=8.):
+    x = np.arange(num_channels)
+    return np.exp(-0.5 * ((x[:, None] - np.asarray(centers)) / sigma)**2)
+
+
+def test_pixel_fit_multiprocess_shared():
+    param = get_para()
+    matv = _gaussian_design(300, [60, 140, 210])
+    rs = np.random.RandomState(5)
+    weights = rs.uniform(0, 50, size=(5, 3, 3))
+    exp_data = np.dot(weights, matv.T) + 10 + rs.uniform(size=(5, 3, 300))
+
+    for use_snip in [True, False]:
+        expected = np.array([fit_per_line_nnls(row, matv, param, use_snip)
+                             for row in exp_data])
+        for chunk_rows in [None, 2]:
+            for solver in ['nnls', 'batch']:
+                results = fit_pixel_multiprocess_nnls(exp_data, matv, param,
+                                                      use_snip=use_snip,
+                                                      num_processes=2,
+                                                      chunk_rows=chunk_rows,
+                                                      solver=solver)
+                assert_array_almost_equal(results, expected)
+    assert_raises(ValueError, fit_per_line_nnls, exp_data[0], matv, param,
+                  False, 'lbfgs')
+
+    # memmapped input is used in place and results land in a memmap output
+    tmpdir = tempfile.mkdtemp()
+    try:
+        data_file = os.path.join(tmpdir, 'data.dat')
+        out_file = os.path.join(tmpdir, 'out.dat')
+        data = np.memmap(data_file, dtype=np.float32, mode='w+',
+                         shape=exp_data.shape)
+        data[...] = exp_data
+        data.flush()
+        out = np.memmap(out_file, dtype=np.float64, mode='w+',
+                        shape=(5, 3, 5))
+        results = fit_pixel_multiprocess_nnls(data, matv, param,
+                                              use_snip=True,
+                                              num_processes=2, out=out)
+        assert_true(results is out)
+        expected = np.array([fit_per_line_nnls(row, matv, param, True)
+                             for row in data])
+        assert_array_almost_equal(out, expected)
+        assert_raises(ValueError, fit_pixel_multiprocess_nnls, data, matv,
+                      param, out=np.zeros((5, 3, 4)))
+        del data, out, results
+    finally:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
+
+
+def test_nnls_fit_batch():
+    rs = np.random.RandomState(0)
+    matv = _gaussian_design(400, rs.uniform(0, 400, 12),
+                            sigma=rs.uniform(5, 30, 12))
+    # negative true weights force the active-set iterations to work
+    spectra = (np.dot(rs.uniform(-20, 100, size=(200, 12)), matv.T) +
+               rs.normal(0, 2, size=(200, 400)))
+    weights = rs.uniform(0.5, 2, 400)
+    for w in [None, weights]:
+        results, res = nnls_fit_batch(spectra, matv, weights=w)
+        assert_true(np.all(results >= 0))
+        for y, r, e in zip(spectra, results, res):
+            expected, expected_res = nnls_fit(y, matv, weights=w)
+            assert_array_almost_equal(r, expected, decimal=6)
+            assert_array_almost_equal(e, expected_res)
+
+    results, res = nnls_fit_batch(spectra[0], matv)
+    assert_equal(results.shape, (1, 12))
+    results, res = nnls_fit_batch(np.zeros((3, 400)), matv)
+    assert_array_equal(results, 0)
+
+
+def test_cached_linear_model():
+    param = get_para()
+    x = np.arange(1000)
+    lines = ['Pt_M', 'Si_Ka1-Si_Ka1', 'user_peak1']
+    expected = construct_linear_model(x, param, lines)
+
+    elist, matv, area = cached_linear_model(x, param, lines)
+    assert_equal(elist, expected[0])
+    assert_array_equal(matv, expected[1])
+    assert_equal(area, expected[2])
+    assert_true(not matv.flags.writeable)
+    # the same inputs hit the cache, changed parameters do not
+    assert_true(cached_linear_model(x, copy.deepcopy(param), lines)[1]
+                is matv)
+    param2 = copy.deepcopy(param)
+    param2['e_linear']['value'] *= 1.01
+    assert_true(cached_linear_model(x, param2, lines)[1] is not matv)
+    assert_true(cached_linear_model(x[:-1], param, lines)[1] is not matv)
+
+    y = np.dot(expected[1], [2., 1., 3., 1., 1.]) + 1
+    x_energy, result_dict, area_dict = linear_spectrum_fitting(
+        x, y, param, elemental_lines=lines)
+    prebuilt = linear_spectrum_fitting(x, y, param, linear_model=expected)
+    assert_array_almost_equal(x_energy, prebuilt[0])
+    assert_equal(list(area_dict), list(prebuilt[2]))
+    for k in area_dict:
+        assert_array_almost_equal(area_dict[k], prebuilt[2][k])
+        assert_array_almost_equal(result_dict[k], prebuilt[1][k])
+
+
+def test_construct_linear_model_numpy():
+    param = get_para()
+    x = np.arange(2000)
+    lines = ['Pt_M', 'Au_M', 'Si_Ka1-Si_Ka1', 'user_peak1']
+    # per-line settings, some of them out of their bounds
+    adjusted = copy.deepcopy(param)
+    adjusted['Pt_ma1_area'] = {'value': 30., 'bound_type': 'lohi',
+                               'min': 0, 'max': 20}
+    adjusted['Pt_mb_delta_center'] = {'value': 0.01, 'bound_type': 'fixed',
+                                      'min': 0, 'max': 1}
+    adjusted['Au_ma1_ratio_adjust'] = {'value': 1.3, 'bound_type': 'hi',
+                                       'min': 0, 'max': 1.2}
+    adjusted['user_peak1_delta_sigma'] = {'value': 0.02,
+                                          'bound_type': 'none',
+                                          'min': 0, 'max': 1}
+    adjusted['pileup_Si_Ka1_Si_Ka1_area'] = {'value': -5.,
+                                             'bound_type': 'none',
+                                             'min': 0, 'max': 1}
+    for p in [param, adjusted]:
+        for default_area in [100, 1e5]:
+            expected = construct_linear_model(x, p, lines, default_area)
+            elist, matv, area = construct_linear_model(x, p, lines,
+                                                       default_area,
+                                                       method='numpy')
+            assert_equal(elist, expected[0])
+            assert_equal(area, expected[2])
+            assert_array_equal(matv, expected[1])
+    assert_raises(ValueError, construct_linear_model, x, param, lines,
+                  method='asteval')
+
+
+def test_spectrum_function_jacobian():
+    param = get_para()
+    elemental_lines = ['Ar_K', 'Fe_K', 'Ce_L', 'Pt_M', 'Si_Ka1-Si_Ka1']
+    MS = ModelSpectrum(param, elemental_lines)
+    MS.assemble_models()
+    spectrum_fn = _SpectrumFunction(MS.mod)
+    x = np.arange(100, 1300)
+
+    y = spectrum_fn.eval(x, spectrum_fn.p0)
+    assert_array_almost_equal(y, MS.mod.eval(MS.mod.make_params(), x=x))
+
+    rs = np.random.RandomState(3)
+    p = spectrum_fn.p0 * (1 + 0.05 * rs.randn(len(spectrum_fn.p0)))
+    jac = spectrum_fn.jacobian(x, p)
+    for k in range(len(p)):
+        step = 1e-6 * abs(p[k]) if p[k] else 1e-10
+        hi, lo = p.copy(), p.copy()
+        hi[k] += step
+        lo[k] -= step
+        expected = (spectrum_fn.eval(x, hi) -
+                    spectrum_fn.eval(x, lo)) / (2 * step)
+        assert_true(np.abs(jac[:, k] - expected).max() <
+                    1e-5 * np.abs(expected).max())
+
+
+def test_pixel_fit_multiprocess_nonlinear():
+    param = get_para()
+    elemental_lines = ['Ar_K', 'Fe_K', 'Ce_L', 'Pt_M']
+    MS = ModelSpectrum(param, elemental_lines)
+    MS.assemble_models()
+    spectrum_fn = _SpectrumFunction(MS.mod)
+    x = np.arange(100, 1300)
+    areas = [i for i, name in enumerate(spectrum_fn.param_names)
+             if 'area' in name or 'amplitude' in name]
+
+    # areas change smoothly over a 3 x 4 map
+    expected = np.empty((3, 4, len(spectrum_fn.p0)))
+    exp_data = np.empty((3, 4, len(x)))
+    for i in range(3):
+        for j in range(4):
+            p = spectrum_fn.p0.copy()
+            p[areas] *= 1 + 0.1 * i + 0.05 * j
+            expected[i, j] = p
+            exp_data[i, j] = spectrum_fn.eval(x, p)
+
+    for warm_start in [True, False]:
+        names, values, stats = fit_pixel_multiprocess_nonlinear(
+            exp_data, x, param, elemental_lines, warm_start=warm_start,
+            num_processes=2, chunk_pixels=5)
+        assert_equal(names, spectrum_fn.param_names)
+        assert_equal(values.shape, expected.shape)
+        assert_array_almost_equal(values[..., areas] / expected[..., areas],
+                                  np.ones((3, 4, len(areas))))
+        assert_true(stats['success'].all())
+        assert_true((stats['nfev'] > 0).all())
+        assert_true((stats['time'] > 0).all())
+        assert_equal(stats['chisqr'].shape, (3, 4))
+
+    # a stack of spectra works the same as a map
+    names, stacked, stats = fit_pixel_multiprocess_nonlinear(
+        exp_data.reshape(12, -1), x, param, elemental_lines,
+        num_processes=2)
+    assert_array_almost_equal(
+        stacked[:, areas] / expected[..., areas].reshape(12, -1),
+        np.ones((12, len(areas))))
+    assert_raises(ValueError, fit_pixel_multiprocess_nonlinear, exp_data,
+                  x[1:], param, elemental_lines)
+
+
+def test_bin_spectra():
+    rs = np.random.RandomState(0)
+    exp_data = rs.poisson(5, size=(7, 5, 11)).astype(np.float32)
+
+    for bin_size in [1, 2, (2, 3), (8, 8)]:
+        kx, ky = np.broadcast_to(bin_size, (2,))
+        expected = np.zeros((-(-7 // kx), -(-5 // ky), 11))
+        expected_counts = np.zeros(expected.shape[:2])
+        for i in range(7):
+            for j in range(5):
+                expected[i // kx, j // ky] += exp_data[i, j]
+                expected_counts[i // kx, j // ky] += 1
+        for chunk_rows in [None, 1, 3]:
+            binned, counts = bin_spectra(exp_data, bin_size=bin_size,
+                                         chunk_rows=chunk_rows)
+            assert_array_almost_equal(binned, expected)
+            assert_array_equal(counts, expected_counts)
+        pixels = unbin_map(binned, (7, 5), bin_size=bin_size)
+        assert_equal(pixels.shape, exp_data.shape)
+        assert_array_almost_equal(pixels[6, 4], expected[6 // kx, 4 // ky])
+
+    labels = rs.randint(0, 4, size=(7, 5))
+    binned, counts = bin_spectra(exp_data, labels=labels, chunk_rows=2)
+    for label in range(1, 4):
+        assert_array_almost_equal(binned[label - 1],
+                                  exp_data[labels == label].sum(axis=0))
+        assert_equal(counts[label - 1], np.sum(labels == label))
+    pixels = unbin_map(binned, (7, 5), labels=labels, fill_value=np.nan)
+    assert_true(np.isnan(pixels[labels == 0]).all())
+    assert_array_almost_equal(pixels[labels == 2],
+                              np.tile(binned[1], (np.sum(labels == 2), 1)))
+
+    assert_raises(ValueError, bin_spectra, exp_data)
+    assert_raises(ValueError, bin_spectra, exp_data, 2, labels)
+    assert_raises(ValueError, bin_spectra, exp_data, None, labels[:3])
+
+
+def test_fit_binned_nnls():
+    param = get_para()
+    matv = _gaussian_design(300, [60, 140, 210])
+    rs = np.random.RandomState(2)
+    # every 2 x 2 block holds the same spectrum
+    weights = np.repeat(np.repeat(rs.uniform(1, 50, size=(3, 2, 3)), 2,
+                                  axis=0), 2, axis=1)[:5, :3]
+    exp_data = np.dot(weights, matv.T) + 1
+    expected = fit_pixel_multiprocess_nnls(exp_data, matv, param,
+                                           num_processes=2)
+    results = fit_binned_nnls(exp_data, matv, param, bin_size=2,
+                              num_processes=2)
+    # r-squared is that of the summed spectra, compare areas and background
+    assert_array_almost_equal(results[..., :-1], expected[..., :-1])
+
+    labels = np.zeros((5, 3), dtype=int)
+    labels[:2, :2] = 1
+    labels[2:4, 2:] = 2
+    results = fit_binned_nnls(exp_data, matv, param, labels=labels,
+                              num_processes=2)
+    assert_true(np.isnan(results[labels == 0]).all())
+    assert_array_almost_equal(results[labels > 0][:, :-1],
+                              expected[labels > 0][:, :-1])
+
+
+def test_pixel_fit_stream():
+    param = get_para()
+    matv = _gaussian_design(300, [60, 140, 210])
+    rs = np.random.RandomState(4)
+    weights = rs.uniform(0, 50, size=(8, 3, 3))
+    exp_data = np.dot(weights, matv.T) + 10 + rs.uniform(size=(8, 3, 300))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        data = np.memmap(os.path.join(tmpdir, 'data.dat'), dtype=np.float32,
+                         mode='w+', shape=exp_data.shape)
+        data[...] = exp_data
+        data.flush()
+        expected = np.array([fit_per_line_nnls(row, matv, param, True)
+                             for row in data])
+
+        reports = []
+        out_file = os.path.join(tmpdir, 'out.dat')
+        out = fit_pixel_stream_nnls(data, matv, param, out_file,
+                                    use_snip=True, num_processes=2,
+                                    block_rows=3,
+                                    progress=lambda *a: reports.append(a))
+        assert_array_almost_equal(out, expected)
+        assert_equal(reports[-1], (8, 8))
+        assert_equal(len(reports), 3)
+
+        # a reader that fails half-way leaves the fitted rows on disk
+        rows = np.array(data)
+        read = []
+
+        def failing_reader(start, stop):
+            if start >= 4:
+                raise IOError('detector file went away')
+            read.append((start, stop))
+            return rows[start:stop]
+
+        out_file = os.path.join(tmpdir, 'resumed.dat')
+        assert_raises(IOError, fit_pixel_stream_nnls, failing_reader, matv,
+                      param, out_file, shape=data.shape, use_snip=True,
+                      num_processes=2, block_rows=2)
+        # the blocks still being fitted are not waited for, whatever was
+        # finished is recorded
+        done = np.fromfile(out_file + '.done', dtype=np.uint8)[-8:]
+        assert not done[4:].any()
+        unfinished = [(start, start + 2) for start in range(0, 8, 2)
+                      if not done[start]]
+
+        del read[:]
+
+        def reader(start, stop):
+            read.append((start, stop))
+            return rows[start:stop]
+
+        out = fit_pixel_stream_nnls(reader, matv, param, out_file,
+                                    shape=data.shape, use_snip=True,
+                                    num_processes=2, block_rows=2)
+        assert_equal(read, unfinished)
+        assert_array_almost_equal(out, expected)
+
+        del read[:]
+        out = fit_pixel_stream_nnls(reader, matv, param, out_file,
+                                    shape=data.shape, use_snip=True,
+                                    num_processes=2, block_rows=2,
+                                    resume=False)
+        assert_equal(len(read), 4)
+        assert_array_almost_equal(out, expected)
+
+        assert_raises(ValueError, fit_pixel_stream_nnls, reader, matv,
+                      param, out_file)
+
+        # the record of another fit is not resumed: a different design
+        # matrix is refused, and a new output starts from scratch
+        assert_raises(ValueError, fit_pixel_stream_nnls, reader, 2 * matv,
+                      param, out_file, shape=data.shape, use_snip=True)
+        del out
+        os.remove(out_file)
+        other = rows[::-1]
+        out = fit_pixel_stream_nnls(other, matv, param, out_file,
+                                    use_snip=True, num_processes=2,
+                                    block_rows=2)
+        assert_array_almost_equal(out, expected[::-1])
+        assert_raises(ValueError, fit_pixel_stream_nnls, data, matv,
+                      param, np.zeros((8, 3, 5)))
+        del data, out
+    finally:
+        for name in os.listdir(tmpdir):
+            os.remove(os.path.join(tmpdir, name))
+        os.rmdir(tmpdir)
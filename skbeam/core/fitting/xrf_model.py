@@ -42,23 +42,30 @@
 # POSSIBILITY OF SUCH DAMAGE.                                          #
 ########################################################################
 from __future__ import absolute_import, division, print_function
+import atexit
 import copy
-from collections import OrderedDict
+import hashlib
+import json
+from collections import OrderedDict, deque, namedtuple
 import logging
+import mmap
+import os
+import tempfile
+import time
 
 import numpy as np
 
-from scipy.optimize import nnls
+from scipy.optimize import least_squares, nnls
 import six
 from lmfit import Model
 import multiprocessing
 
-from ..constants import XrfElement as Element
-from ..fitting.lineshapes import gaussian
+from ..constants.xrf import get_xrf_table
+from ..fitting.lineshapes import gaussian, compton, elastic, s2pi
 from ..fitting.models import (ComptonModel, ElasticModel,
                                         _gen_class_docs)
 from .base import parameter_data as sfb_pd
-from .background import snip_method
+from .background import snip_method, snip_method_batch
 
 logger = logging.getLogger(__name__)
 
@@ -95,6 +102,12 @@ TRANSITIONS_LOOKUP = {'K': K_TRANSITIONS, 'L': L_TRANSITIONS,
                       'M': M_TRANSITIONS}
 
 
+def _table_element(element):
+    """Element data from the shared `XrfTable`, with the interface of
+    `XrfElement`."""
+    return get_xrf_table().element(element)
+
+
 def element_peak_xrf(x, area, center,
                      delta_center, delta_sigma,
                      ratio, ratio_adjust,
@@ -605,7 +618,7 @@ class ModelSpectrum(object):
 
         if elemental_line in K_LINE:
             element = elemental_line.split('_')[0]
-            e = Element(element)
+            e = _table_element(element)
             if e.cs(incident_energy)['ka1'] == 0:
                 logger.debug('%s Ka emission line is not activated '
                              'at this energy %f', element, incident_energy)
@@ -690,7 +703,7 @@ class ModelSpectrum(object):
 
         elif elemental_line in L_LINE:
             element = elemental_line.split('_')[0]
-            e = Element(element)
+            e = _table_element(element)
             if e.cs(incident_energy)['la1'] == 0:
                 logger.debug('{0} La1 emission line is not activated '
                              'at this energy {1}'.format(element, incident_energy))
@@ -762,7 +775,7 @@ class ModelSpectrum(object):
 
         elif elemental_line in M_LINE:
             element = elemental_line.split('_')[0]
-            e = Element(element)
+            e = _table_element(element)
             if e.cs(incident_energy)['ma1'] == 0:
                 logger.debug('{0} ma1 emission line is not activated '
                              'at this energy {1}'.format(element, incident_energy))
@@ -996,7 +1009,7 @@ def get_line_energy(elemental_line):
     """
     name, line = elemental_line.split('_')
     line = line.lower()
-    e = Element(name)
+    e = _table_element(name)
     if 'k' in line:
         e_cen = e.emission_line[line]
     elif 'l' in line:
@@ -1120,9 +1133,167 @@ def compute_escape_peak(spectrum, ratio, params,
     return result
 
 
+def _hint_value(value, input_dict=None, min_=None, max_=None):
+    """
+    Value of a model parameter hinted with ``value``, ``min_`` and ``max_``
+    and then, if ``input_dict`` is given, updated by `_set_parameter_hint`.
+
+    This mirrors what lmfit hands to the model function: hint values are
+    used as they are, clipped to the bounds, and ``expr`` is not
+    evaluated.
+    """
+    if input_dict is not None:
+        value = input_dict['value']
+        bound_type = input_dict['bound_type']
+        if bound_type not in ('none', 'fixed', 'lohi', 'lo', 'hi'):
+            raise ValueError("unknown bound type {0}".format(bound_type))
+        if bound_type in ('lohi', 'lo'):
+            min_ = input_dict['min']
+        if bound_type in ('lohi', 'hi'):
+            max_ = input_dict['max']
+    if min_ is None:
+        min_ = -np.inf
+    if max_ is None:
+        max_ = np.inf
+    if max_ < min_:
+        min_, max_ = max_, min_
+    if min_ > -np.inf:
+        value = max(min_, value)
+    if max_ < np.inf:
+        value = min(max_, value)
+    return value
+
+
+def _line_hints(params, pre_name, center, ratio, area, area_min=None):
+    """
+    Parameters of one element line, mirroring the hints that
+    `ModelSpectrum.setup_element_model` puts on its ElementModel.
+
+    Returns the line as (center, area, delta_center, delta_sigma,
+    ratio, ratio_adjust).
+    """
+    hints = [center,
+             _hint_value(area, params.get(pre_name + 'area'), min_=area_min)]
+    for name, default in (('delta_center', 0), ('delta_sigma', 0)):
+        hints.append(_hint_value(default, params.get(pre_name + name)))
+    hints.append(ratio)
+    hints.append(_hint_value(1, params.get(pre_name + 'ratio_adjust')))
+    return tuple(hints)
+
+
+def _element_lines(params, elemental_line, default_area):
+    """
+    List the lines of an elemental line as set up by
+    `ModelSpectrum.setup_element_model`, or None if it is not activated
+    at the incident energy.
+    """
+    if elemental_line in K_LINE + L_LINE + M_LINE:
+        element, shell = elemental_line.split('_')
+        first_line = {'K': 'ka1', 'L': 'la1', 'M': 'ma1'}[shell]
+        e = _table_element(element)
+        cs = e.cs(params['coherent_sct_energy']['value'])
+        first_cs = cs[first_line]
+        if first_cs == 0:
+            return None
+        lines = []
+        for line_name, val in e.emission_line.all:
+            if shell.lower() not in line_name:
+                continue
+            line_cs = cs[line_name]
+            if line_cs == 0:
+                continue
+            pre_name = str(element) + '_' + str(line_name) + '_'
+            if pre_name + 'area' in params:
+                default_area = params[pre_name + 'area']['value']
+            area_min = 0 if line_name == 'ka1' else None
+            lines.append(_line_hints(params, pre_name, val,
+                                     line_cs / first_cs, default_area,
+                                     area_min))
+        return lines
+
+    if 'user' in elemental_line.lower():
+        # user peak is set 5 keV every time, this value is not important
+        return [_line_hints(params, elemental_line + '_', 5, 1.0,
+                            default_area, 0)]
+
+    element_line1, element_line2 = elemental_line.split('-')
+    center = get_line_energy(element_line1) + get_line_energy(element_line2)
+    pre_name = 'pileup_' + elemental_line.replace('-', '_') + '_'
+    return [_line_hints(params, pre_name, center, 1.0, default_area, 0)]
+
+
+def _construct_linear_model_numpy(channel_number, params, elemental_lines,
+                                  default_area=100):
+    """
+    `construct_linear_model` without lmfit.
+
+    All element lines are evaluated with `element_peak_xrf` in one
+    broadcast over a (lines x channels) grid and summed per elemental
+    line; compton and elastic are evaluated with their lineshapes
+    directly.
+    """
+    def value(name):
+        return _hint_value(None, params[name])
+
+    epsilon = params['non_fitting_values']['epsilon']
+    calibration = dict((name, value(name)) for name in
+                       ['e_offset', 'e_linear', 'e_quadratic',
+                        'fwhm_offset', 'fwhm_fanoprime'])
+
+    selected_elements = []
+    element_area = {}
+    lines = []
+    starts = []
+    for elemental_line in elemental_lines:
+        element_lines = _element_lines(params, elemental_line, default_area)
+        if not element_lines:
+            continue
+        starts.append(len(lines))
+        lines.extend(element_lines)
+        selected_elements.append(elemental_line)
+        element_area[elemental_line] = element_lines[-1][1]
+
+    matv = []
+    if lines:
+        (center, area, delta_center, delta_sigma,
+         ratio, ratio_adjust) = [np.array(v, dtype=float)[:, np.newaxis]
+                                 for v in zip(*lines)]
+        profiles = element_peak_xrf(np.asarray(channel_number)[np.newaxis],
+                                    area, center, delta_center, delta_sigma,
+                                    ratio, ratio_adjust, epsilon=epsilon,
+                                    **calibration)
+        # add up the lines of each element in order, as lmfit does
+        for start, stop in zip(starts, starts[1:] + [len(lines)]):
+            column = profiles[start]
+            for row in profiles[start + 1:stop]:
+                column += row
+            matv.append(column)
+
+    compton_names = ['coherent_sct_energy', 'compton_amplitude',
+                     'compton_angle', 'compton_gamma', 'compton_f_tail',
+                     'compton_f_step', 'compton_fwhm_corr',
+                     'compton_hi_gamma', 'compton_hi_f_tail']
+    compton_values = dict((name, value(name)) for name in compton_names)
+    compton_values.update(calibration)
+    matv.append(compton(channel_number, epsilon=epsilon, **compton_values))
+    element_area['compton'] = compton_values['compton_amplitude']
+    selected_elements.append('compton')
+
+    elastic_values = dict(calibration)
+    for name in ['coherent_sct_energy', 'coherent_sct_amplitude']:
+        elastic_values[name] = value(name)
+    matv.append(elastic(channel_number, epsilon=epsilon, **elastic_values))
+    element_area['elastic'] = elastic_values['coherent_sct_amplitude']
+    selected_elements.append('elastic')
+
+    matv = np.array(matv)
+    matv = matv.transpose()
+    return selected_elements, matv, element_area
+
+
 def construct_linear_model(channel_number, params,
                            elemental_lines,
-                           default_area=100):
+                           default_area=100, method='lmfit'):
     """
     Create spectrum with parameters given from params.
 
@@ -1138,6 +1309,11 @@ def construct_linear_model(channel_number, params,
             lines of Platinum
     default_area : float
         value for the initial area of a given element
+    method : {'lmfit', 'numpy'}, optional
+        'lmfit' evaluates the models of `ModelSpectrum`. 'numpy' computes
+        the same spectra directly from the line parameters, evaluating
+        all element lines at once, which is much faster for long element
+        lists.
 
     Returns
     -------
@@ -1148,6 +1324,12 @@ def construct_linear_model(channel_number, params,
     element_area : dict
         area of the given elements
     """
+    if method == 'numpy':
+        return _construct_linear_model_numpy(channel_number, params,
+                                             elemental_lines, default_area)
+    elif method != 'lmfit':
+        raise ValueError("method must be 'lmfit' or 'numpy', "
+                         "not {!r}".format(method))
     MS = ModelSpectrum(params, elemental_lines)
 
     selected_elements = []
@@ -1184,6 +1366,84 @@ def construct_linear_model(channel_number, params,
     return selected_elements, matv, element_area
 
 
+# design matrices built by cached_linear_model, least recently used first
+_linear_model_cache = OrderedDict()
+_LINEAR_MODEL_CACHE_SIZE = 8
+
+
+def _freeze(value):
+    """Turn nested parameter containers into a hashable cache key."""
+    if isinstance(value, dict):
+        return tuple(sorted(((k, _freeze(v)) for k, v in six.iteritems(value)),
+                            key=lambda item: str(item[0])))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return (value.dtype.str, value.shape, value.tobytes())
+    return value
+
+
+def cached_linear_model(channel_number, params, elemental_lines,
+                        default_area=100, method='numpy'):
+    """
+    Memoized version of `construct_linear_model`.
+
+    Design matrices are kept in a small least-recently-used cache keyed by
+    the channel axis, the parameter values and the elemental lines, so
+    fitting many spectra with the same parameters builds the models only
+    once.
+
+    Parameters
+    ----------
+    channel_number : array
+        N.B. This is the raw independent variable, not energy.
+    params : dict
+        fitting parameters
+    elemental_lines : list
+            e.g., ['Na_K', Mg_K', 'Pt_M'] refers to the
+            K lines of Sodium, the K lines of Magnesium, and the M
+            lines of Platinum
+    default_area : float
+        value for the initial area of a given element
+    method : {'numpy', 'lmfit'}, optional
+        how the matrix is built, see `construct_linear_model`
+
+    Returns
+    -------
+    selected_elements : list
+        selected elements for given energy
+    matv : array
+        matrix for linear fitting. It is shared between calls and
+        read-only.
+    element_area : dict
+        area of the given elements
+    """
+    key = (_freeze(np.asarray(channel_number)), _freeze(params),
+           tuple(elemental_lines), default_area, method)
+    try:
+        hash(key)
+    except TypeError:
+        # parameters we cannot key on; build without caching
+        return construct_linear_model(channel_number, params,
+                                      elemental_lines, default_area,
+                                      method=method)
+
+    if key in _linear_model_cache:
+        model = _linear_model_cache.pop(key)
+    else:
+        selected_elements, matv, element_area = construct_linear_model(
+            channel_number, params, elemental_lines, default_area,
+            method=method)
+        matv.flags.writeable = False
+        model = (tuple(selected_elements), matv, element_area)
+    _linear_model_cache[key] = model
+    while len(_linear_model_cache) > _LINEAR_MODEL_CACHE_SIZE:
+        _linear_model_cache.popitem(last=False)
+
+    selected_elements, matv, element_area = model
+    return list(selected_elements), matv, dict(element_area)
+
+
 def nnls_fit(spectrum, expected_matrix, weights=None):
     """
     Non-negative least squares fitting.
@@ -1213,9 +1473,133 @@ def nnls_fit(spectrum, expected_matrix, weights=None):
     return nnls(expected_matrix, spectrum)
 
 
+def nnls_fit_batch(spectra, expected_matrix, weights=None, max_iter=None):
+    """
+    Non-negative least squares fitting of many spectra at once.
+
+    Every row of ``spectra`` is fitted to the same ``expected_matrix``,
+    giving the same result as calling `nnls_fit` on each of them. The
+    normal equations are formed for all spectra with one matrix product
+    and the active-set iterations run on all spectra together; spectra
+    that share a passive set are solved with a single factorization
+    (fast combinatorial NNLS, Van Benthem and Keenan, J. Chemometrics 18,
+    441 (2004)).
+
+    Parameters
+    ----------
+    spectra : array
+        2D array of experiment spectra, one spectrum per row
+    expected_matrix : array
+        2D matrix of activated element spectrum
+    weights : array, optional
+        for weighted nnls fitting. Setting weights as None means fitting
+        without weights.
+    max_iter : int, optional
+        maximum number of iterations of either active-set loop, defaults
+        to three times the number of columns of ``expected_matrix``
+
+    Returns
+    -------
+    results : array
+        weights of different element, one row per spectrum
+    residue : array
+        error of each spectrum
+    """
+    spectra = np.atleast_2d(np.asarray(spectra, dtype=float))
+    expected_matrix = np.asarray(expected_matrix, dtype=float)
+    if weights is not None:
+        weights = np.sqrt(weights)
+        expected_matrix = expected_matrix * weights[:, np.newaxis]
+        spectra = spectra * weights
+    num_var = expected_matrix.shape[1]
+    if max_iter is None:
+        max_iter = 3 * num_var
+
+    AtA = np.dot(expected_matrix.T, expected_matrix)
+    AtY = np.dot(expected_matrix.T, spectra.T)
+    tol = 10 * np.finfo(float).eps * num_var * np.abs(AtY).max(axis=0,
+                                                              initial=0)
+
+    # start from the unconstrained solution, keeping its positive part
+    K = _solve_passive(AtA, AtY)
+    P = K > 0
+    K[~P] = 0
+    D = K.copy()
+    F = np.flatnonzero(~np.all(P, axis=0))
+    outer = 0
+    while F.size:
+        outer += 1
+        if outer > max_iter:
+            raise RuntimeError("too many iterations")
+        K[:, F] = _solve_passive(AtA, AtY[:, F], P[:, F])
+
+        # move infeasible solutions back towards the feasible region,
+        # dropping one variable per spectrum per step
+        H = F[np.any(K[:, F] < 0, axis=0)]
+        inner = 0
+        while H.size:
+            inner += 1
+            if inner > max_iter:
+                raise RuntimeError("too many iterations")
+            cols = np.arange(H.size)
+            Kh, Dh, Ph = K[:, H], D[:, H], P[:, H]
+            neg = Ph & (Kh < 0)
+            alpha = np.full(Kh.shape, np.inf)
+            alpha[neg] = Dh[neg] / (Dh[neg] - Kh[neg])
+            drop = np.argmin(alpha, axis=0)
+            Dh -= alpha[drop, cols] * (Dh - Kh)
+            Dh[drop, cols] = 0
+            Ph[drop, cols] = False
+            D[:, H], P[:, H] = Dh, Ph
+            K[:, H] = _solve_passive(AtA, AtY[:, H], Ph)
+            H = H[np.any(K[:, H] < 0, axis=0)]
+
+        # Kuhn-Tucker check, then activate the most promising variable
+        W = AtY[:, F] - np.dot(AtA, K[:, F])
+        W[P[:, F]] = -np.inf
+        optimal = np.all(W <= tol[F], axis=0)
+        F, W = F[~optimal], W[:, ~optimal]
+        P[np.argmax(W, axis=0), F] = True
+        D[:, F] = K[:, F]
+
+    results = K.T
+    residue = np.sqrt(np.sum((spectra - np.dot(results,
+                                               expected_matrix.T))**2,
+                             axis=1))
+    return results, residue
+
+
+def _solve_passive(AtA, AtY, passive=None):
+    """Solve the normal equations restricted to the passive variables.
+
+    Columns of ``AtY`` with the same passive set (column of ``passive``)
+    are solved together; variables outside the passive set are zero.
+    """
+    if passive is None or np.all(passive):
+        return _solve_normal(AtA, AtY)
+    K = np.zeros_like(AtY)
+    patterns, group = np.unique(passive.T, axis=0, return_inverse=True)
+    for n, pattern in enumerate(patterns):
+        if not pattern.any():
+            continue
+        cols = np.flatnonzero(group == n)
+        vars_ = np.flatnonzero(pattern)
+        K[np.ix_(vars_, cols)] = _solve_normal(AtA[np.ix_(vars_, vars_)],
+                                               AtY[np.ix_(vars_, cols)])
+    return K
+
+
+def _solve_normal(AtA, AtY):
+    try:
+        return np.linalg.solve(AtA, AtY)
+    except np.linalg.LinAlgError:
+        return np.linalg.lstsq(AtA, AtY, rcond=None)[0]
+
+
 def linear_spectrum_fitting(x, y, params,
                             elemental_lines=None,
-                            weights=None):
+                            weights=None,
+                            linear_model=None):
     """
     Fit a spectrum to a linear model.
 
@@ -1238,6 +1622,10 @@ def linear_spectrum_fitting(x, y, params,
     weights : array, optional
         for weighted nnls fitting. Setting weights as None means fitting
         without weights.
+    linear_model : tuple, optional
+        prebuilt ``(selected_elements, matv, element_area)`` as returned
+        by `construct_linear_model` or `cached_linear_model`. If None,
+        it is taken from `cached_linear_model`.
 
     Returns
     -------
@@ -1248,20 +1636,17 @@ def linear_spectrum_fitting(x, y, params,
     area_dict : dict
         the area of the first main peak, such as Ka1, of a given element
     """
-    if elemental_lines is None:
-        elemental_lines = K_LINE + L_LINE + M_LINE
-
-    # Need to use deepcopy here to avoid unexpected change on parameter dict
-    fitting_parameters = copy.deepcopy(params)
-
-    total_list, matv, element_area = construct_linear_model(x, params,
-                                                            elemental_lines)
+    if linear_model is None:
+        if elemental_lines is None:
+            elemental_lines = K_LINE + L_LINE + M_LINE
+        linear_model = cached_linear_model(x, params, elemental_lines)
+    total_list, matv, element_area = linear_model
 
     # get background
-    bg = snip_method(y, fitting_parameters['e_offset']['value'],
-                     fitting_parameters['e_linear']['value'],
-                     fitting_parameters['e_quadratic']['value'],
-                     width=fitting_parameters['non_fitting_values']['background_width'])
+    bg = snip_method(y, params['e_offset']['value'],
+                     params['e_linear']['value'],
+                     params['e_quadratic']['value'],
+                     width=params['non_fitting_values']['background_width'])
     y = y - bg
 
     out, res = nnls_fit(y, matv, weights=weights)
@@ -1328,7 +1713,7 @@ def _get_activated_line(incident_energy, elemental_line):
     line_list = []
     if elemental_line in K_LINE:
         element = elemental_line.split('_')[0]
-        e = Element(element)
+        e = _table_element(element)
         if e.cs(incident_energy)['ka1'] == 0:
             return
         for num, item in enumerate(e.emission_line.all[:4]):
@@ -1340,7 +1725,7 @@ def _get_activated_line(incident_energy, elemental_line):
 
     elif elemental_line in L_LINE:
         element = elemental_line.split('_')[0]
-        e = Element(element)
+        e = _table_element(element)
         if e.cs(incident_energy)['la1'] == 0:
             return
         for num, item in enumerate(e.emission_line.all[4:-4]):
@@ -1352,7 +1737,7 @@ def _get_activated_line(incident_energy, elemental_line):
 
     elif elemental_line in M_LINE:
         element = elemental_line.split('_')[0]
-        e = Element(element)
+        e = _table_element(element)
         if e.cs(incident_energy)['ma1'] == 0:
             return
         for num, item in enumerate(e.emission_line.all[-4:]):
@@ -1363,7 +1748,7 @@ def _get_activated_line(incident_energy, elemental_line):
         return line_list
 
 
-def fit_per_line_nnls(data, matv, param, use_snip):
+def fit_per_line_nnls(data, matv, param, use_snip, solver='nnls'):
     """Fit experiment data for a given row using nnls algorithm.
 
     Parameters
@@ -1376,6 +1761,9 @@ def fit_per_line_nnls(data, matv, param, use_snip):
         fitting parameters
     use_snip : bool
         use snip algorithm to remove background or not
+    solver : {'nnls', 'batch'}, optional
+        'nnls' fits one spectrum at a time with `nnls_fit`, 'batch' fits
+        the whole row at once with `nnls_fit_batch`
 
     Returns
     -------
@@ -1383,46 +1771,169 @@ def fit_per_line_nnls(data, matv, param, use_snip):
         fitting values for all the elements at a given row. Background is
         calculated as a summed value. Also residual is included.
     """
-    out = []
-    bg_sum = 0
-    for y in data:
-        if use_snip:
-            bg = snip_method(y,
-                             param['e_offset']['value'],
-                             param['e_linear']['value'],
-                             param['e_quadratic']['value'],
-                             width=param['non_fitting_values']['background_width'])
-            bg_sum = np.sum(bg)
-            result, res = nnls_fit(y - bg, matv, weights=None)
-        else:
-            result, res = nnls_fit(y - bg, matv, weights=None)
+    if solver not in ('nnls', 'batch'):
+        raise ValueError("solver must be 'nnls' or 'batch', "
+                         "not {!r}".format(solver))
+    data = np.asarray(data)
+    if use_snip:
+        bg = snip_method_batch(data.reshape(len(data), -1),
+                               param['e_offset']['value'],
+                               param['e_linear']['value'],
+                               param['e_quadratic']['value'],
+                               width=param['non_fitting_values']['background_width'])
+        bg_sum = np.sum(bg, axis=1)
+    else:
+        bg = 0
+        bg_sum = np.zeros(len(data))
 
-        sst = np.sum((y-np.mean(y))**2)
-        r2 = 1 - res/sst
-        result = list(result) + [bg_sum, r2]
-        out.append(result)
-    return np.array(out)
+    if solver == 'batch':
+        result, res = nnls_fit_batch(data - bg, matv)
+    else:
+        fits = [nnls_fit(y, matv, weights=None) for y in data - bg]
+        result = np.array([f[0] for f in fits]).reshape(len(data), -1)
+        res = np.array([f[1] for f in fits])
 
+    sst = np.sum((data - np.mean(data, axis=1)[:, np.newaxis])**2, axis=1)
+    r2 = 1 - res/sst
+    return np.column_stack([result, bg_sum, r2])
 
-def _log_and_fit(row_num, *args):
-    """Wrapper around fit_per_line_nnls to log the row num that is being used
 
-    Parameters
-    ----------
-    row_num : int
-        The row number that is being computed
-    args
-        The arguments to `fit_per_line_nnls`
+# Description of a C-ordered array stored in a file, enough for a worker
+# process to map it without anything but this tuple crossing the pipe.
+_MemmapSpec = namedtuple('_MemmapSpec', ['filename', 'dtype', 'shape',
+                                         'offset'])
+
+# target size of the spectra handed to a worker per task, in bytes
+_CHUNK_BYTES = 2**26
+# aim for at least this many tasks per worker so that the load balances
+_TASKS_PER_WORKER = 4
+
+_pool = None
+_pool_size = None
+
+
+def _get_pool(processes):
+    """Return the persistent worker pool, (re)starting it if necessary."""
+    global _pool, _pool_size
+    if _pool is None or _pool_size != processes:
+        _close_pool()
+        _pool = multiprocessing.Pool(processes)
+        _pool_size = processes
+    return _pool
+
+
+def _close_pool():
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+    _pool = None
+    _pool_size = None
+
+
+atexit.register(_close_pool)
+
+
+def _memmap_spec(arr):
+    """Return a _MemmapSpec for ``arr`` if it is a whole file-backed memmap.
+    """
+    if (isinstance(arr, np.memmap) and isinstance(arr.base, mmap.mmap) and
+            arr.filename is not None and arr.flags.c_contiguous):
+        return _MemmapSpec(arr.filename, arr.dtype.str, arr.shape,
+                           arr.offset)
+    return None
+
+
+def _temp_memmap(shape, dtype):
+    """Create a zero-filled temporary file of the given shape, return its
+    spec."""
+    fd, filename = tempfile.mkstemp(suffix='.dat', prefix='skbeam_')
+    os.close(fd)
+    dtype = np.dtype(dtype)
+    if np.prod(shape):
+        out = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+        del out
+    return _MemmapSpec(filename, dtype.str, tuple(shape), 0)
+
+
+def _open_memmap(spec, mode='r'):
+    if not np.prod(spec.shape):
+        return np.empty(spec.shape, dtype=spec.dtype)
+    return np.memmap(spec.filename, dtype=spec.dtype, mode=mode,
+                     shape=spec.shape, offset=spec.offset)
+
+
+def _remove_file(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        logger.warning('could not remove temporary file %s', filename)
+
+
+def _block_tasks(job, exp_data, data_spec, num_rows, chunk_rows):
+    """Tasks fitting blocks of ``chunk_rows`` rows of ``exp_data``.
+
+    Workers map file-backed data themselves from ``data_spec``; otherwise
+    the rows of each block are sent with its task. The pool draws the
+    tasks as its pipes accept them, so only a few blocks are copied at a
+    time.
+    """
+    for start in range(0, num_rows, chunk_rows):
+        stop = min(start + chunk_rows, num_rows)
+        block = None if data_spec is not None else exp_data[start:stop]
+        yield job, start, stop, block
+
+
+def _task_rows(data_spec, start, stop, block):
+    """The rows of a task, mapped from ``data_spec`` if not sent along."""
+    if block is not None:
+        return block
+    return _open_memmap(data_spec, 'r')[start:stop]
+
+
+def _adaptive_chunk_rows(shape, itemsize, num_workers):
+    """Number of rows per task for an array of the given shape.
+
+    Tasks are kept below ``_CHUNK_BYTES`` of spectra while still giving
+    every worker several tasks to balance uneven rows.
     """
-    logger.info('Row number at {}'.format(row_num))
-    return fit_per_line_nnls(*args)
+    num_rows = shape[0]
+    row_bytes = max(1, int(np.prod(shape[1:])) * itemsize)
+    by_size = max(1, _CHUNK_BYTES // row_bytes)
+    by_balance = max(1, -(-num_rows // (_TASKS_PER_WORKER * num_workers)))
+    return int(min(by_size, by_balance))
+
+
+def _fit_row_block(args):
+    """Fit rows [start, stop) of a job and write them to its output.
+
+    Runs in a pool worker. The data and the output are mapped for this
+    task only, so no map of a finished job outlives it.
+    """
+    job, start, stop, block = args
+    data_spec, matv, out_spec, param, use_snip, solver = job
+    data = _task_rows(data_spec, start, stop, block)
+    out = _open_memmap(out_spec, 'r+')
+    for n in range(start, stop):
+        logger.info('Row number at {}'.format(n))
+        out[n] = fit_per_line_nnls(data[n - start], matv, param, use_snip,
+                                   solver)
+    out.flush()
+    return start, stop
 
 
 def fit_pixel_multiprocess_nnls(exp_data, matv, param,
-                                use_snip=False):
+                                use_snip=False, num_processes=None,
+                                chunk_rows=None, out=None, solver='nnls'):
     """
     Multiprocess fit of experiment data.
 
+    ``exp_data`` is fitted by a persistent pool of worker processes, a
+    block of rows per task: an ``np.memmap`` is mapped by the workers in
+    place, from anything else the rows of each block are sent with its
+    task. Workers write their results straight into a shared output
+    memmap.
+
     Parameters
     ----------
     exp_data : array
@@ -1434,27 +1945,836 @@ def fit_pixel_multiprocess_nnls(exp_data, matv, param,
         fitting parameters
     use_snip : bool, optional
         use snip algorithm to remove background or not
+    num_processes : int, optional
+        number of worker processes, defaults to the cpu count
+    chunk_rows : int, optional
+        number of rows of ``exp_data`` sent to a worker per task. By
+        default it is chosen from the data size and the number of workers.
+    out : np.memmap, optional
+        file-backed float64 array of shape
+        ``exp_data.shape[:2] + (matv.shape[1] + 2,)`` into which the
+        workers write directly. It is returned as the result.
+    solver : {'nnls', 'batch'}, optional
+        per-row solver, see `fit_per_line_nnls`. 'batch' solves each row
+        of spectra with `nnls_fit_batch`.
 
     Returns
     -------
     array
         Fitting values for all the elements
     """
-    num_processors_to_use = multiprocessing.cpu_count()
+    if num_processes is None:
+        num_processes = multiprocessing.cpu_count()
+    logger.info('cpu count: {}'.format(num_processes))
+
+    matv = np.asarray(matv)
+    out_shape = tuple(exp_data.shape[:2]) + (matv.shape[1] + 2,)
+    if out is not None and out.shape != out_shape:
+        raise ValueError("out has shape {}, expected {}".format(out.shape,
+                                                                out_shape))
+    if chunk_rows is None:
+        chunk_rows = _adaptive_chunk_rows(exp_data.shape,
+                                          exp_data.dtype.itemsize,
+                                          num_processes)
+
+    temp_files = []
+    data_spec = _memmap_spec(exp_data)
+    out_spec = None if out is None else _memmap_spec(out)
+    if out_spec is None or np.dtype(out_spec.dtype) != np.float64:
+        out_spec = _temp_memmap(out_shape, np.float64)
+        temp_files.append(out_spec.filename)
+
+    job = (data_spec, matv, out_spec, param, use_snip, solver)
+    tasks = _block_tasks(job, exp_data, data_spec, out_shape[0], chunk_rows)
+    try:
+        pool = _get_pool(num_processes)
+        for start, stop in pool.imap_unordered(_fit_row_block, tasks):
+            logger.debug('rows {} to {} done'.format(start, stop))
+        shared = _open_memmap(out_spec, 'r')
+        if out is None:
+            results = np.array(shared)
+        else:
+            if _memmap_spec(out) != out_spec:
+                out[...] = shared
+            results = out
+        del shared
+    finally:
+        for filename in temp_files:
+            _remove_file(filename)
+    return results
+
+
+# conversion between the FWHM and the standard deviation of a gaussian
+_FWHM_TO_SIGMA = 2 * np.sqrt(2 * np.log(2))
+
+
+def _xrf_peak_jacobian(x, area, center, delta_center, delta_sigma,
+                       ratio, ratio_adjust, fwhm_offset, fwhm_fanoprime,
+                       e_offset, e_linear, e_quadratic, epsilon=2.96):
+    """Derivatives of `element_peak_xrf` with respect to its parameters.
+
+    Returns
+    -------
+    dict
+        derivative with respect to each argument but ``x``, as arrays
+        shaped like ``x``
+    """
+    energy = e_offset + x * e_linear + x**2 * e_quadratic
+    sigma0 = np.sqrt((fwhm_offset / _FWHM_TO_SIGMA)**2 +
+                     center * epsilon * fwhm_fanoprime)
+    sigma = delta_sigma + sigma0
+    dist = energy - (center + delta_center)
+    shape = np.exp(-dist**2 / (2 * sigma**2)) / (s2pi * sigma)
+    y = shape * area * ratio * ratio_adjust
+    d_energy = -y * dist / sigma**2
+    d_sigma = y * (dist**2 / sigma**3 - 1 / sigma)
+    d_sigma0 = d_sigma / (2 * sigma0)
+    return {'area': shape * ratio * ratio_adjust,
+            'ratio': shape * area * ratio_adjust,
+            'ratio_adjust': shape * area * ratio,
+            'center': -d_energy + d_sigma0 * epsilon * fwhm_fanoprime,
+            'delta_center': -d_energy,
+            'delta_sigma': d_sigma,
+            'fwhm_offset': d_sigma0 * 2 * fwhm_offset / _FWHM_TO_SIGMA**2,
+            'fwhm_fanoprime': d_sigma0 * center * epsilon,
+            'epsilon': d_sigma0 * center * fwhm_fanoprime,
+            'e_offset': d_energy,
+            'e_linear': d_energy * x,
+            'e_quadratic': d_energy * x**2}
+
+
+# arguments of `elastic` under their names in `element_peak_xrf`
+_ELASTIC_AS_PEAK = {'coherent_sct_amplitude': 'area',
+                    'coherent_sct_energy': 'center'}
+
+# relative step of the forward differences for non-gaussian components
+_DIFF_STEP = np.sqrt(np.finfo(float).eps)
+
+# power of the channel number multiplying each energy calibration term
+_CALIBRATION_POWERS = {'e_offset': 0, 'e_linear': 1, 'e_quadratic': 2}
+
+
+class _SpectrumFunction(object):
+    """Assembled XRF model flattened for repeated evaluation.
+
+    The parameters of the lmfit model are held in one vector. Parameters
+    constrained by an expression take the value of the parameter it
+    names, clipped to their own bounds as lmfit does, and the free
+    parameters form the vector seen by the optimizer. Element and elastic
+    peaks are gaussian and are differentiated analytically; other
+    components, such as the compton peak, by forward differences. For the
+    compton peak the energy calibration terms are derived from a single
+    difference, since they only shift its energy axis.
+
+    The object holds only arrays and module level functions, so it can be
+    built once and sent to worker processes.
+
+    Parameters
+    ----------
+    model : lmfit.Model
+        assembled model, see `ModelSpectrum.assemble_models`
+    """
+    def __init__(self, model):
+        params = model.make_params()
+        names = list(params.keys())
+        index = dict((name, i) for i, name in enumerate(names))
+        pars = [params[name] for name in names]
+        self.values = np.array([par.value for par in pars], dtype=float)
+        self.lower = np.array([-np.inf if par.min is None else par.min
+                               for par in pars], dtype=float)
+        self.upper = np.array([np.inf if par.max is None else par.max
+                               for par in pars], dtype=float)
+
+        sources = {}
+        for name, par in zip(names, pars):
+            if par.expr is None:
+                continue
+            if par.expr.strip() not in index:
+                raise ValueError("constraint {} = {!r} does not name a "
+                                 "parameter".format(name, par.expr))
+            sources[name] = par.expr.strip()
+        # evaluate constraints after the parameters they depend on
+        order = []
+        done = set()
+        for name in sources:
+            chain = []
+            while name in sources and name not in done:
+                if name in chain:
+                    raise ValueError("circular constraint on "
+                                     "{}".format(name))
+                chain.append(name)
+                name = sources[name]
+            order.extend(reversed(chain))
+            done.update(chain)
+        self._constraints = [(index[name], index[sources[name]])
+                             for name in order]
+
+        self.free = np.array([i for i, par in enumerate(pars)
+                              if par.vary and par.expr is None and
+                              self.lower[i] < self.upper[i]], dtype=int)
+        if not len(self.free):
+            raise ValueError("no parameter of the model is varied")
+        self.param_names = [names[i] for i in self.free]
+
+        # parameters that depend on a free one get a Jacobian column
+        active = np.zeros(len(names), dtype=bool)
+        active[self.free] = True
+        for dep, src in self._constraints:
+            active[dep] = active[src]
+        self._columns = np.cumsum(active) - 1
+        self._columns[~active] = -1
+        self._num_columns = int(active.sum())
+
+        self._components = []
+        for comp in (model.components or [model]):
+            slots = []
+            for i, name in enumerate(names):
+                arg = comp._strip_prefix(name)
+                if arg in comp._func_allargs:
+                    slots = [s for s in slots if s[0] != arg] + [(arg, i)]
+            if comp.func is element_peak_xrf:
+                kind = 'peak'
+            elif comp.func is compton:
+                kind = 'compton'
+            elif comp.func is elastic:
+                kind = 'elastic'
+                slots = [(_ELASTIC_AS_PEAK.get(arg, arg), i)
+                         for arg, i in slots]
+            else:
+                kind = 'other'
+            self._components.append((kind, comp.func, slots))
+
+    @property
+    def p0(self):
+        """Starting values of the free parameters."""
+        return self.values[self.free]
+
+    def full_values(self, p):
+        """Values of all parameters given the free ones."""
+        values = self.values.copy()
+        values[self.free] = p
+        for dep, src in self._constraints:
+            values[dep] = min(max(values[src], self.lower[dep]),
+                              self.upper[dep])
+        return values
+
+    def eval(self, x, p):
+        """Model spectrum at channels ``x`` for free parameters ``p``."""
+        values = self.full_values(p)
+        total = np.zeros(len(x))
+        for kind, func, slots in self._components:
+            kwargs = dict((arg, values[i]) for arg, i in slots)
+            if kind == 'elastic':
+                total += element_peak_xrf(
+                    x, delta_center=0, delta_sigma=0, ratio=1,
+                    ratio_adjust=1, **kwargs)
+            else:
+                total += func(x, **kwargs)
+        return total
+
+    def jacobian(self, x, p):
+        """Derivatives of `eval` with respect to the free parameters."""
+        values = self.full_values(p)
+        jac = np.zeros((len(x), self._num_columns))
+        columns = self._columns
+        for kind, func, slots in self._components:
+            kwargs = dict((arg, values[i]) for arg, i in slots)
+            if kind in ('compton', 'other'):
+                base = func(x, **kwargs)
+                for arg, i in slots:
+                    if columns[i] < 0 or (kind == 'compton' and
+                                          arg in _CALIBRATION_POWERS):
+                        continue
+                    jac[:, columns[i]] += self._difference(
+                        x, func, kwargs, arg, base)
+                if kind == 'compton':
+                    # the calibration only shifts the energy axis
+                    d_energy = self._difference(x, func, kwargs, 'e_offset',
+                                                base)
+                    for arg, i in slots:
+                        if arg in _CALIBRATION_POWERS and columns[i] >= 0:
+                            jac[:, columns[i]] += (
+                                d_energy * x**_CALIBRATION_POWERS[arg])
+                continue
+            if kind == 'elastic':
+                kwargs.update(delta_center=0, delta_sigma=0, ratio=1,
+                              ratio_adjust=1)
+            derivs = _xrf_peak_jacobian(x, **kwargs)
+            for arg, i in slots:
+                if columns[i] >= 0:
+                    jac[:, columns[i]] += derivs[arg]
+        # chain rule through the constraints, a clipped value is constant
+        for dep, src in reversed(self._constraints):
+            if (columns[dep] >= 0 and
+                    self.lower[dep] <= values[src] <= self.upper[dep]):
+                jac[:, columns[src]] += jac[:, columns[dep]]
+        return jac[:, columns[self.free]]
+
+    @staticmethod
+    def _difference(x, func, kwargs, arg, base):
+        value = kwargs[arg]
+        step = _DIFF_STEP * max(1., abs(value))
+        kwargs[arg] = value + step
+        try:
+            return (func(x, **kwargs) - base) / step
+        finally:
+            kwargs[arg] = value
+
+    def fit(self, x, y, p0=None, weights=None, max_nfev=None):
+        """Least squares fit of one spectrum.
+
+        Parameters
+        ----------
+        x : array
+            channel numbers
+        y : array
+            spectrum
+        p0 : array, optional
+            starting values of the free parameters, default `p0`
+        weights : array, optional
+            weights of the residual, as in `ModelSpectrum.model_fit`
+        max_nfev : int, optional
+            maximum number of function evaluations
+
+        Returns
+        -------
+        scipy.optimize.OptimizeResult
+            result of `scipy.optimize.least_squares`
+        """
+        lower = self.lower[self.free]
+        upper = self.upper[self.free]
+        p0 = np.clip(self.p0 if p0 is None else p0, lower, upper)
+        weights = (np.ones(len(x)) if weights is None
+                   else np.broadcast_to(weights, np.shape(x)))
+
+        def residual(p):
+            return (self.eval(x, p) - y) * weights
 
-    logger.info('cpu count: {}'.format(num_processors_to_use))
-    pool = multiprocessing.Pool(num_processors_to_use)
+        def jacobian(p):
+            return self.jacobian(x, p) * weights[:, np.newaxis]
 
-    result_pool = [
-        pool.apply_async(_log_and_fit, (n, data, matv,param, use_snip))
-        for n, data in enumerate(exp_data)]
+        return least_squares(residual, p0, jac=jacobian,
+                             bounds=(lower, upper), method='trf',
+                             x_scale='jac', max_nfev=max_nfev)
 
-    results = [r.get() for r in result_pool]
 
-    pool.terminate()
-    pool.join()
+def _fit_pixel_block(args):
+    """Fit pixels [start, stop) of a nonlinear fitting job.
+
+    Runs in a pool worker. Each fit starts from the result of the pixel
+    before it in the same row, or above it at the start of a row, when
+    that pixel belongs to the same block and its fit succeeded.
+    """
+    job, start, stop, block = args
+    data_spec, spectrum_fn, x, weights, row_len, warm_start, max_nfev = job
+    data = _task_rows(data_spec, start, stop, block)
+    num_params = len(spectrum_fn.free)
+    out = np.zeros((stop - start, num_params + 4))
+    for n in range(start, stop):
+        neighbour = n - row_len if n % row_len == 0 else n - 1
+        p0 = None
+        if warm_start and neighbour >= start and out[neighbour - start, -2]:
+            p0 = out[neighbour - start, :num_params]
+        t0 = time.time()
+        res = spectrum_fn.fit(x, np.asarray(data[n - start], dtype=float),
+                              p0=p0,
+                              weights=weights, max_nfev=max_nfev)
+        elapsed = time.time() - t0
+        success = res.success and np.all(np.isfinite(res.x))
+        out[n - start] = np.r_[res.x, 2 * res.cost, res.nfev, success,
+                               elapsed]
+    return start, stop, out
+
+
+def fit_pixel_multiprocess_nonlinear(exp_data, channel_number, param,
+                                     elemental_lines, weights=None,
+                                     warm_start=True, max_nfev=None,
+                                     num_processes=None, chunk_pixels=None):
+    """
+    Multiprocess nonlinear fit of the full model to many spectra.
+
+    The model of `ModelSpectrum` is assembled once and every spectrum is
+    fitted with `scipy.optimize.least_squares`, using analytic
+    derivatives for the gaussian peaks. Spectra are fitted in blocks of
+    consecutive pixels by a persistent pool of worker processes, which
+    map an ``np.memmap`` ``exp_data`` in place or are sent the spectra of
+    their block, as in `fit_pixel_multiprocess_nnls`. Within a block each fit starts
+    from the result of a neighbouring pixel, which usually saves most of
+    the iterations on smoothly varying maps.
+
+    Parameters
+    ----------
+    exp_data : array
+        spectra along the last axis. For 3D data the first two axes are
+        the x, y positions of a map.
+    channel_number : array
+        channel numbers of the last axis of ``exp_data``
+    param : dict
+        fitting parameters, with the bound types of the fitting strategy
+    elemental_lines : list
+        e.g., ['Na_K', Mg_K', 'Pt_M'], see `ModelSpectrum`
+    weights : array, optional
+        weight of each channel, applied to the residual
+    warm_start : bool, optional
+        start each fit from the result of a neighbouring pixel instead of
+        the values in ``param``
+    max_nfev : int, optional
+        maximum number of function evaluations per spectrum
+    num_processes : int, optional
+        number of worker processes, defaults to the cpu count
+    chunk_pixels : int, optional
+        number of spectra sent to a worker per task
+
+    Returns
+    -------
+    param_names : list
+        names of the fitted parameters
+    values : array
+        fitted values, shape ``exp_data.shape[:-1] + (len(param_names),)``
+    stats : dict
+        arrays of shape ``exp_data.shape[:-1]``: 'chisqr', 'nfev',
+        'success' and 'time', the wall time in seconds of each fit
+    """
+    if num_processes is None:
+        num_processes = multiprocessing.cpu_count()
+    channel_number = np.asarray(channel_number, dtype=float)
+    if exp_data.shape[-1] != len(channel_number):
+        raise ValueError("exp_data has {} channels, channel_number "
+                         "{}".format(exp_data.shape[-1], len(channel_number)))
+    if weights is not None:
+        weights = np.broadcast_to(np.asarray(weights, dtype=float),
+                                  channel_number.shape)
+
+    MS = ModelSpectrum(param, elemental_lines)
+    MS.assemble_models()
+    spectrum_fn = _SpectrumFunction(MS.mod)
+
+    map_shape = tuple(exp_data.shape[:-1])
+    num_pixels = int(np.prod(map_shape))
+    row_len = map_shape[-1] if len(map_shape) > 1 else max(num_pixels, 1)
+    if chunk_pixels is None:
+        chunk_pixels = max(1, -(-num_pixels //
+                                (_TASKS_PER_WORKER * num_processes)))
+
+    flat_shape = (num_pixels, exp_data.shape[-1])
+    data_spec = _memmap_spec(exp_data)
+    if data_spec is None:
+        flat_data = np.reshape(exp_data, flat_shape)
+    else:
+        flat_data = None
+        data_spec = data_spec._replace(shape=flat_shape)
+
+    job = (data_spec, spectrum_fn, channel_number, weights, row_len,
+           warm_start, max_nfev)
+    tasks = _block_tasks(job, flat_data, data_spec, num_pixels, chunk_pixels)
+    out = np.zeros((num_pixels, len(spectrum_fn.free) + 4))
+    pool = _get_pool(num_processes)
+    for start, stop, block in pool.imap_unordered(_fit_pixel_block, tasks):
+        logger.debug('pixels {} to {} done'.format(start, stop))
+        out[start:stop] = block
+
+    num_params = len(spectrum_fn.free)
+    values = out[:, :num_params].reshape(map_shape + (num_params,))
+    stats = dict(chisqr=out[:, -4].reshape(map_shape),
+                 nfev=out[:, -3].astype(int).reshape(map_shape),
+                 success=out[:, -2].astype(bool).reshape(map_shape),
+                 time=out[:, -1].reshape(map_shape))
+    if num_pixels:
+        logger.info('fitted {} spectra, time per spectrum: mean {:.3g} s, '
+                    'max {:.3g} s, {:.1f} evaluations on average'.format(
+                        num_pixels, stats['time'].mean(),
+                        stats['time'].max(), stats['nfev'].mean()))
+    return spectrum_fn.param_names, values, stats
+
+
+def _fit_stream_block(args):
+    """Fit a block of rows read by `fit_pixel_stream_nnls`."""
+    job, start, stop, block = args
+    matv, param, use_snip, solver = job
+    out = np.array([fit_per_line_nnls(row, matv, param, use_snip, solver)
+                    for row in block])
+    return start, stop, out
+
+
+def _open_stream_file(filename, dtype, shape, resume):
+    """Open an existing file of the right size, or create a new one."""
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    if resume and os.path.exists(filename):
+        if os.path.getsize(filename) != size:
+            raise ValueError("{} does not hold an array of shape "
+                             "{}".format(filename, shape))
+        return np.memmap(filename, dtype=dtype, mode='r+', shape=shape)
+    return np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+
+
+# the file recording the finished rows of fit_pixel_stream_nnls starts
+# with this tag and a digest of what is being fitted, then has one byte
+# per row
+_STREAM_TAG = b'skbeam-stream-v1'
+_STREAM_HEADER_BYTES = 64
+
+
+def _stream_digest(out_shape, matv, param, use_snip):
+    """Digest of the output shape and fitting inputs of a stream fit."""
+    digest = hashlib.sha256()
+    digest.update(repr(tuple(int(n) for n in out_shape)).encode())
+    digest.update(np.ascontiguousarray(matv, dtype=np.float64).tobytes())
+    digest.update(json.dumps(param, sort_keys=True, default=repr).encode())
+    digest.update(repr(bool(use_snip)).encode())
+    return digest.digest()
+
+
+def _open_done_file(filename, num_rows, digest, reset):
+    """Open the finished rows record of a stream fit.
+
+    A new record, with no row finished, is written if ``reset`` is true
+    or there is none yet. An existing record must have been written for
+    the same ``digest``.
+    """
+    header = (_STREAM_TAG + digest).ljust(_STREAM_HEADER_BYTES, b'\0')
+    size = _STREAM_HEADER_BYTES + num_rows
+    if reset or not os.path.exists(filename):
+        with open(filename, 'wb') as f:
+            f.write(header)
+            f.truncate(size)
+    else:
+        with open(filename, 'rb') as f:
+            found = f.read(_STREAM_HEADER_BYTES)
+        if found != header or os.path.getsize(filename) != size:
+            raise ValueError("{} records a fit of a different output shape, "
+                             "design matrix or parameters; pass "
+                             "resume=False to fit from the start".format(
+                                 filename))
+    if not num_rows:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(filename, dtype=np.uint8, mode='r+',
+                     offset=_STREAM_HEADER_BYTES, shape=(num_rows,))
+
+
+def fit_pixel_stream_nnls(exp_data, matv, param, out, shape=None,
+                          use_snip=False, num_processes=None,
+                          block_rows=None, solver='nnls', resume=True,
+                          progress=None):
+    """
+    Fit a map of spectra that does not fit in memory, a block at a time.
+
+    Blocks of rows are read from ``exp_data`` only when they are about to
+    be fitted, and a few blocks at most are held in memory. They are
+    fitted by the persistent pool of worker processes and the results
+    are written to the file-backed ``out`` as soon as a block is done.
+    Every finished row is recorded in a file next to ``out``, named
+    ``out`` + '.done', so that an interrupted fit can be resumed by
+    calling this function again with the same output. The record also
+    holds a digest of the output shape, ``matv``, ``param`` and
+    ``use_snip``, and a fit of anything else is not resumed from it.
 
-    return np.array(results)
+    Parameters
+    ----------
+    exp_data : array-like or callable
+        3D data of experiment spectrum, with x,y positions as the first
+        2-dim, and energy as the third one. Anything that can be sliced
+        along its first axis works, such as an ``np.memmap`` or an
+        ``h5py`` dataset. A callable ``exp_data(start, stop)`` returning
+        rows ``start`` to ``stop`` can be given instead, along with
+        ``shape``.
+    matv : array
+        matrix for regression analysis
+    param : dict
+        fitting parameters
+    out : str or np.memmap
+        file name of the results, or a file-backed float64 array of
+        shape ``exp_data.shape[:2] + (matv.shape[1] + 2,)``
+    shape : tuple, optional
+        shape of the data, needed when ``exp_data`` is a callable
+    use_snip : bool, optional
+        use snip algorithm to remove background or not
+    num_processes : int, optional
+        number of worker processes, defaults to the cpu count
+    block_rows : int, optional
+        number of rows read and fitted at a time. By default it is chosen
+        from the data size and the number of workers.
+    solver : {'nnls', 'batch'}, optional
+        per-row solver, see `fit_per_line_nnls`
+    resume : bool, optional
+        skip the rows recorded as finished by a previous call with the
+        same ``out``. A ValueError is raised if that call fitted with a
+        different ``matv``, ``param`` or ``use_snip``. If False, or if the
+        file ``out`` is created by this call, all rows are fitted.
+    progress : callable, optional
+        called as ``progress(rows_done, num_rows)`` after every block
+
+    Returns
+    -------
+    np.memmap
+        fitting values for all the elements, see
+        `fit_pixel_multiprocess_nnls`
+    """
+    if callable(exp_data):
+        if shape is None:
+            raise ValueError("shape is needed when exp_data is a reader "
+                             "function")
+        read_rows = exp_data
+    else:
+        shape = exp_data.shape
+
+        def read_rows(start, stop):
+            return exp_data[start:stop]
+    if num_processes is None:
+        num_processes = multiprocessing.cpu_count()
+    matv = np.asarray(matv)
+    num_rows = shape[0]
+    out_shape = tuple(shape[:2]) + (matv.shape[1] + 2,)
+
+    new_out = False
+    if isinstance(out, six.string_types):
+        new_out = not (resume and os.path.exists(out))
+        out = _open_stream_file(out, np.float64, out_shape, resume)
+    elif _memmap_spec(out) is None or out.dtype != np.float64:
+        raise ValueError("out must be a file name or a file-backed float64 "
+                         "np.memmap")
+    if out.shape != out_shape:
+        raise ValueError("out has shape {}, expected {}".format(out.shape,
+                                                                out_shape))
+    done = _open_done_file(out.filename + '.done', num_rows,
+                           _stream_digest(out_shape, matv, param, use_snip),
+                           reset=new_out or not resume)
+
+    if block_rows is None:
+        block_rows = _adaptive_chunk_rows(shape, np.dtype(
+            getattr(exp_data, 'dtype', np.float64)).itemsize, num_processes)
+    blocks = [(start, min(start + block_rows, num_rows))
+              for start in range(0, num_rows, block_rows)]
+    logger.info('{} of {} rows already fitted'.format(int(done.sum()),
+                                                      num_rows))
+
+    def collect(pending_result):
+        start, stop, result = pending_result.get()
+        out[start:stop] = result
+        out.flush()
+        done[start:stop] = 1
+        done.flush()
+        rows_done = int(done.sum())
+        logger.info('rows {} to {} fitted, {} of {} done'.format(
+            start, stop, rows_done, num_rows))
+        if progress is not None:
+            progress(rows_done, num_rows)
+
+    job = (matv, param, use_snip, solver)
+    pool = _get_pool(num_processes)
+    # blocks read ahead of the workers; this bounds the memory used
+    max_pending = 2 * num_processes
+    pending = deque()
+    try:
+        for start, stop in blocks:
+            if done[start:stop].all():
+                continue
+            block = np.asarray(read_rows(start, stop))
+            pending.append(pool.apply_async(_fit_stream_block,
+                                            ((job, start, stop, block),)))
+            del block
+            while len(pending) >= max_pending:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
+    except BaseException:
+        # keep the blocks that are already fitted for a later resume, but
+        # do not wait for the others: an interrupt should stop at once
+        for pending_result in pending:
+            if pending_result.ready():
+                try:
+                    collect(pending_result)
+                except Exception:
+                    pass
+        raise
+    return out
+
+
+def _bin_shape(bin_size):
+    """Bin size as a pair of ints, from an int or a pair."""
+    bin_size = np.broadcast_to(np.asarray(bin_size, dtype=int), (2,))
+    if np.any(bin_size < 1):
+        raise ValueError("bin_size must be positive, not "
+                         "{}".format(bin_size))
+    return int(bin_size[0]), int(bin_size[1])
+
+
+def bin_spectra(exp_data, bin_size=None, labels=None, chunk_rows=None):
+    """
+    Sum the spectra of a map over spatial bins.
+
+    ``exp_data`` is read in blocks of rows, so it can be a memory-mapped
+    array much larger than the memory. Give either `bin_size` or
+    `labels`.
+
+    Parameters
+    ----------
+    exp_data : array
+        3D data of experiment spectrum,
+        with x,y positions as the first 2-dim, and energy as the third one.
+    bin_size : int or tuple, optional
+        sum blocks of bin_size x bin_size pixels, or of (kx, ky) pixels.
+        Blocks at the far edges are smaller when the map size is not a
+        multiple of the bin size.
+    labels : array, optional
+        integer array of the map shape. Pixels with the same label are
+        summed and pixels labeled 0 are left out, as for the label arrays
+        of `skbeam.core.roi`.
+    chunk_rows : int, optional
+        number of rows of ``exp_data`` read at a time. The default reads
+        about 64 MB at a time.
+
+    Returns
+    -------
+    binned : array
+        summed spectra, of shape ``(nx, ny, num_channels)`` for the
+        blocks of `bin_size`, or ``(labels.max(), num_channels)`` with
+        row ``i`` holding label ``i + 1``
+    counts : array
+        number of pixels summed into each spectrum of `binned`
+    """
+    if (bin_size is None) == (labels is None):
+        raise ValueError("give exactly one of bin_size and labels")
+    num_rows, num_cols, num_channels = exp_data.shape
+    if labels is not None:
+        labels = np.asarray(labels)
+        if labels.shape != (num_rows, num_cols):
+            raise ValueError("labels has shape {}, the map is "
+                             "{}".format(labels.shape, (num_rows, num_cols)))
+        if labels.dtype.kind not in 'iu' or labels.min() < 0:
+            raise ValueError("labels must be non-negative integers")
+        step = 1
+    else:
+        kx, ky = _bin_shape(bin_size)
+        step = kx
+    if chunk_rows is None:
+        row_bytes = max(1, num_cols * num_channels * exp_data.dtype.itemsize)
+        chunk_rows = max(1, _CHUNK_BYTES // row_bytes)
+    # whole blocks of bin rows in every chunk
+    chunk_rows = max(step, chunk_rows // step * step)
+
+    if labels is not None:
+        num_labels = int(labels.max())
+        binned = np.zeros((num_labels, num_channels))
+        counts = np.bincount(labels.ravel(),
+                             minlength=num_labels + 1)[1:]
+    else:
+        binned = np.zeros((-(-num_rows // kx), -(-num_cols // ky),
+                           num_channels))
+        counts = np.outer(np.diff(np.r_[0:num_rows:kx, num_rows]),
+                          np.diff(np.r_[0:num_cols:ky, num_cols]))
+
+    for start in range(0, num_rows, chunk_rows):
+        stop = min(start + chunk_rows, num_rows)
+        block = np.asarray(exp_data[start:stop], dtype=float)
+        logger.debug('binning rows {} to {}'.format(start, stop))
+        if labels is None:
+            block = np.add.reduceat(block, np.arange(0, num_cols, ky),
+                                    axis=1)
+            block = np.add.reduceat(block, np.arange(0, stop - start, kx),
+                                    axis=0)
+            binned[start // kx:start // kx + len(block)] += block
+            continue
+        block_labels = labels[start:stop].ravel()
+        order = np.argsort(block_labels, kind='mergesort')
+        block_labels = block_labels[order]
+        found, first = np.unique(block_labels, return_index=True)
+        sums = np.add.reduceat(block.reshape(-1, num_channels)[order],
+                               first, axis=0)
+        keep = found > 0
+        binned[found[keep] - 1] += sums[keep]
+    return binned, counts
+
+
+def unbin_map(binned_result, map_shape, bin_size=None, labels=None,
+              fill_value=0):
+    """
+    Spread results computed on bins back over the pixels of the map.
+
+    Parameters
+    ----------
+    binned_result : array
+        one result per bin along the first axes, such as the output of
+        the fitting functions for the spectra of `bin_spectra`
+    map_shape : tuple
+        shape (nx, ny) of the full map
+    bin_size : int or tuple, optional
+        bin size given to `bin_spectra`
+    labels : array, optional
+        label array given to `bin_spectra`
+    fill_value : float, optional
+        value of the pixels labeled 0
+
+    Returns
+    -------
+    array
+        result of the bin of every pixel, of shape
+        ``map_shape + binned_result.shape[2:]`` for `bin_size` or
+        ``map_shape + binned_result.shape[1:]`` for `labels`
+    """
+    if (bin_size is None) == (labels is None):
+        raise ValueError("give exactly one of bin_size and labels")
+    binned_result = np.asarray(binned_result)
+    num_rows, num_cols = map_shape
+    if labels is None:
+        kx, ky = _bin_shape(bin_size)
+        out = np.repeat(np.repeat(binned_result, kx, axis=0), ky, axis=1)
+        return out[:num_rows, :num_cols]
+    labels = np.asarray(labels)
+    out = np.empty(tuple(map_shape) + binned_result.shape[1:],
+                   dtype=np.result_type(binned_result, fill_value))
+    out[...] = fill_value
+    labeled = labels > 0
+    out[labeled] = binned_result[labels[labeled] - 1]
+    return out
+
+
+def fit_binned_nnls(exp_data, matv, param, bin_size=None, labels=None,
+                    chunk_rows=None, **kwargs):
+    """
+    Fit the spectra of spatial bins and return per-pixel maps.
+
+    The spectra are summed with `bin_spectra`, fitted with
+    `fit_pixel_multiprocess_nnls` and spread back over the map with
+    `unbin_map`. Fitted areas and the background are divided by the
+    number of pixels in each bin, so they compare with a fit of single
+    pixels; the r-squared is that of the summed spectrum.
+
+    Parameters
+    ----------
+    exp_data : array
+        3D data of experiment spectrum,
+        with x,y positions as the first 2-dim, and energy as the third one.
+    matv : array
+        matrix for regression analysis
+    param : dict
+        fitting parameters
+    bin_size : int or tuple, optional
+        bin size, see `bin_spectra`
+    labels : array, optional
+        label array, see `bin_spectra`. Pixels labeled 0 are set to nan.
+    chunk_rows : int, optional
+        number of rows of ``exp_data`` read at a time while binning
+    kwargs
+        passed on to `fit_pixel_multiprocess_nnls`
+
+    Returns
+    -------
+    array
+        fitting values for all the elements, of shape
+        ``exp_data.shape[:2] + (matv.shape[1] + 2,)``
+    """
+    binned, counts = bin_spectra(exp_data, bin_size=bin_size, labels=labels,
+                                 chunk_rows=chunk_rows)
+    if labels is not None:
+        binned = binned[:, np.newaxis]
+    results = fit_pixel_multiprocess_nnls(binned, matv, param, **kwargs)
+    if labels is not None:
+        results = results[:, 0]
+    # areas and background scale with the number of pixels, r2 does not
+    with np.errstate(invalid='ignore', divide='ignore'):
+        results[..., :-1] /= counts[..., np.newaxis]
+    return unbin_map(results, exp_data.shape[:2], bin_size=bin_size,
+                     labels=labels, fill_value=np.nan)
 
 
 def calculate_area(e_select, matv, results,
@@ -1519,7 +2839,7 @@ def get_relative_cs_ratio(elemental_line, energy):
         calculated ratio
     """
     name, line = elemental_line.split('_')
-    e = Element(name)
+    e = _table_element(name)
     transition_lines = TRANSITIONS_LOOKUP[line.upper()]
 
     sum_v = 0
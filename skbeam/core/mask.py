@@ -42,12 +42,16 @@ basically to clean images
 """
 
 from __future__ import absolute_import, division, print_function
+from collections import namedtuple
 import numpy as np
 
 import logging
-import scipy.stats as sts
+from .accumulators.binned_statistic import BinnedStatistic1D
+from .roi import extract_label_indices
 logger = logging.getLogger(__name__)
 
+roi_frame = namedtuple('roi_frame', ['pixels', 'bad'])
+
 
 def bad_to_nan_gen(images, bad):
     """
@@ -111,6 +115,56 @@ def threshold(images, threshold, mask=None):
         yield mask
 
 
+def roi_pixel_gen(images, labels, bad=None, threshold=None):
+    """
+    Pipeline stage which flags bad images, thresholds and extracts the
+    pixels in the ROIs of every image in a single pass
+
+    This replaces `bad_to_nan_gen` in front of the correlation generators:
+    only the ROI pixels of good images are copied, and bad images are not
+    converted to np.nan arrays but passed on as an explicit flag. The
+    yielded `roi_frame` objects can be given to
+    `skbeam.core.correlation.lazy_one_time` and
+    `skbeam.core.correlation.lazy_two_time` in place of the images, as
+    long as the same `labels` are used there.
+
+    Parameters
+    ----------
+    images : iterable
+        Iterable of 2-D arrays
+    labels : array
+        labeled array of the same shape as the images; 0 is background.
+        Each ROI is represented by a distinct label (i.e., integer).
+    bad : list, optional
+        List of integer indices into the `images` parameter that mark those
+        images as "bad".
+    threshold : float, optional
+        ROI pixels whose value is greater than or equal to `threshold` are
+        set to 0 in that frame only. Unlike the `threshold` generator,
+        which yields a mask that accumulates the hot pixels of all the
+        frames seen so far, a pixel over the threshold in one frame keeps
+        its value in the others.
+
+    Yields
+    ------
+    frame : roi_frame
+        namedtuple of ``pixels``, the 1D array of the ROI pixel values in
+        the order given by `skbeam.core.roi.extract_label_indices` (None
+        for bad images), and ``bad``, True if the image is bad
+    """
+    _, pixel_list = extract_label_indices(labels)
+    bad = set() if bad is None else set(bad)
+    for n, im in enumerate(images):
+        if n in bad:
+            yield roi_frame(None, True)
+            continue
+        # fancy indexing makes a copy of the ROI pixels only
+        pixels = np.ravel(im)[pixel_list]
+        if threshold is not None:
+            pixels[pixels >= threshold] = 0
+        yield roi_frame(pixels, False)
+
+
 def margin(img_shape, edge_size):
     """
     Mask the edge of an image
@@ -132,6 +186,68 @@ def margin(img_shape, edge_size):
     return ~mask
 
 
+class BinnedOutlierMask(object):
+    """
+    Reusable plan for masking outlier pixels in radial bins
+
+    The pixel to bin assignment is computed once at construction, so that
+    calling the plan on every frame of a series only computes the binned
+    mean and standard deviation of that frame.
+
+    Parameters
+    ----------
+    r: 2darray
+        The  array which maps pixels to bins
+    alpha: float or tuple or, 1darray
+        Then number of acceptable standard deviations, if tuple then we use
+        a linear distribution of alphas from alpha[0] to alpha[1], if array
+        then we just use that as the distribution of alphas
+    bins: list
+        The bin edges
+    mask: 1darray, bool, optional
+        A starting flattened mask
+    """
+
+    def __init__(self, r, alpha, bins, mask=None):
+        r = np.asarray(r)
+        if mask is None:
+            self.mask = np.ones(r.shape, dtype=bool)
+        else:
+            self.mask = np.asarray(mask).astype(bool).reshape(r.shape)
+        self.binner = BinnedStatistic1D(r.ravel(), bins=bins,
+                                        mask=self.mask.ravel())
+        self.int_r = np.digitize(r, bins[:-1], True) - 1
+        nbins = len(self.binner.bin_centers)
+        if type(alpha) is tuple:
+            alpha = np.linspace(alpha[0], alpha[1], nbins)
+        self.alpha = alpha
+
+    def __call__(self, img):
+        """
+        Parameters
+        ----------
+        img: 2darray
+            The  image, with the same shape as `r`
+
+        Returns
+        --------
+        2darray:
+            The mask
+        """
+        values = np.ravel(img)
+        mean = self.binner(values, statistic='mean')
+        std = self.binner(values, statistic='std')
+        threshold = self.alpha * std
+        lower = mean - threshold
+        upper = mean + threshold
+
+        # single out the too low and too high pixels
+        working_mask = self.mask.copy()
+        working_mask &= img > lower[self.int_r]
+        working_mask &= img < upper[self.int_r]
+        return working_mask
+
+
 def binned_outlier(img, r, alpha, bins, mask=None):
     """
     Generates a mask by identifying outlier pixels in bins and masks any
@@ -157,31 +273,190 @@ def binned_outlier(img, r, alpha, bins, mask=None):
     --------
     2darray:
         The mask
+
+    See Also
+    --------
+    BinnedOutlierMask : reusable version for masking many frames
     """
+    return BinnedOutlierMask(r, alpha, bins, mask=mask)(img)
 
-    if mask is None:
-        working_mask = np.ones(img.shape).astype(bool)
-    else:
-        working_mask = np.copy(mask).astype(bool)
-    if working_mask.shape != img.shape:
-        working_mask = working_mask.reshape(img.shape)
-    msk_img = img[working_mask]
-    msk_r = r[working_mask]
-
-    int_r = np.digitize(r, bins[:-1], True) - 1
-    # integration
-    mean = sts.binned_statistic(msk_r, msk_img, bins=bins,
-                                statistic='mean')[0]
-    std = sts.binned_statistic(msk_r, msk_img, bins=bins,
-                               statistic=np.std)[0]
-    if type(alpha) is tuple:
-        alpha = np.linspace(alpha[0], alpha[1], len(std))
-    threshold = alpha * std
-    lower = mean - threshold
-    upper = mean + threshold
-
-    # single out the too low and too high pixels
-    working_mask *= img > lower[int_r]
-    working_mask *= img < upper[int_r]
-
-    return working_mask.astype(bool)
+
+def _binned_median(values, bins, indptr):
+    # exact median of `values` in each bin, `bins` being the bin index of
+    # each value and `indptr` the start of each bin in the sorted order
+    counts = np.diff(indptr)
+    if len(values) == 0:
+        return np.zeros(len(counts))
+    srt = values[np.lexsort((values, bins))]
+    lo = indptr[:-1] + np.maximum(counts - 1, 0) // 2
+    hi = indptr[:-1] + counts // 2
+    lo = np.minimum(lo, len(srt) - 1)
+    hi = np.minimum(hi, len(srt) - 1)
+    med = .5 * (srt[lo] + srt[hi])
+    med[counts == 0] = 0
+    return med
+
+
+class StreamingOutlierMask(object):
+    """
+    Outlier masking of a series of frames with running statistics in bins
+
+    The median and the median absolute deviation (MAD) of the pixels in
+    each bin are tracked across frames: they are initialized exactly from
+    the first frame and then nudged towards the median and MAD of every
+    new frame with an exponential forgetting factor `rate` (a stochastic
+    approximation of a running median, which only needs one bincount per
+    statistic). Pixels further than ``alpha * 1.4826 * MAD`` from the
+    running median of their bin are masked. This removes zingers and hot
+    pixels at the frame rate of the detector.
+
+    Parameters
+    ----------
+    r: 2darray
+        The  array which maps pixels to bins
+    alpha: float or tuple or, 1darray
+        Then number of acceptable standard deviations, if tuple then we use
+        a linear distribution of alphas from alpha[0] to alpha[1], if array
+        then we just use that as the distribution of alphas
+    bins: list
+        The bin edges
+    rate: float, optional
+        The forgetting factor of the running statistics, between 0 and 1.
+        Larger values follow changes of the data faster. Default is 0.05
+    min_scale: float, optional
+        Lower bound of the MAD used for the thresholds and the updates,
+        in units of the image. It keeps bins with no spread (e.g. mostly
+        zero counts) from masking every photon. Default is 1 (one count)
+    mask: 1darray, bool, optional
+        A starting flattened mask
+
+    See Also
+    --------
+    BinnedOutlierMask : masking of independent frames
+    """
+
+    def __init__(self, r, alpha, bins, rate=0.05, min_scale=1., mask=None):
+        r = np.asarray(r)
+        self.shape = r.shape
+        if mask is None:
+            self.mask = np.ones(r.shape, dtype=bool)
+        else:
+            self.mask = np.asarray(mask).astype(bool).reshape(r.shape)
+        binner = BinnedStatistic1D(r.ravel(), bins=bins,
+                                   mask=self.mask.ravel())
+        nbins = binner.nbin[0] - 2
+        # keep only the pixels which fall into a bin, grouped by bin
+        valid = (binner.xy > 0) & (binner.xy <= nbins)
+        pixels = np.flatnonzero(valid)
+        bin_index = binner.xy[valid] - 1
+        order = np.argsort(bin_index, kind='mergesort')
+        self.pixels = pixels[order]
+        self.bin_index = bin_index[order]
+        self.counts = np.bincount(self.bin_index, minlength=nbins)
+        self.indptr = np.concatenate(([0], np.cumsum(self.counts)))
+        self._nonempty = self.counts > 0
+        if type(alpha) is tuple:
+            alpha = np.linspace(alpha[0], alpha[1], nbins)
+        self.alpha = np.broadcast_to(np.asarray(alpha, dtype=float),
+                                     (nbins, ))
+        self.rate = rate
+        self.min_scale = min_scale
+        self.median = None
+        self.mad = None
+        self.nframes = 0
+
+    def reset(self):
+        """Forget the running statistics"""
+        self.median = None
+        self.mad = None
+        self.nframes = 0
+
+    def _frac_diff(self, above, below):
+        # fraction of pixels above minus fraction below, per bin
+        n_above = np.bincount(self.bin_index, above, len(self.counts))
+        n_below = np.bincount(self.bin_index, below, len(self.counts))
+        diff = np.zeros(len(self.counts))
+        diff[self._nonempty] = ((n_above - n_below)[self._nonempty] /
+                                self.counts[self._nonempty])
+        return diff
+
+    def __call__(self, img):
+        """
+        Update the running statistics with `img` and return its mask
+
+        Parameters
+        ----------
+        img: 2darray
+            The  image, with the same shape as `r`
+
+        Returns
+        --------
+        2darray:
+            The mask, bad pixels are False
+        """
+        img = np.asarray(img)
+        if img.shape != self.shape:
+            raise ValueError('"img" has incorrect shape. '
+                             ' Expected: ' + str(self.shape) +
+                             ' Received: ' + str(img.shape))
+        values = img.ravel()[self.pixels].astype(float)
+        if self.median is None:
+            self.median = _binned_median(values, self.bin_index, self.indptr)
+            dev = np.abs(values - self.median[self.bin_index])
+            self.mad = _binned_median(dev, self.bin_index, self.indptr)
+        else:
+            scale = np.maximum(self.mad, self.min_scale)
+            center = self.median[self.bin_index]
+            self.median += self.rate * scale * self._frac_diff(
+                values > center, values < center)
+            dev = np.abs(values - self.median[self.bin_index])
+            spread = self.mad[self.bin_index]
+            self.mad += self.rate * scale * self._frac_diff(dev > spread,
+                                                            dev < spread)
+            np.maximum(self.mad, 0, out=self.mad)
+        self.nframes += 1
+
+        threshold = (self.alpha * 1.4826 *
+                     np.maximum(self.mad, self.min_scale))
+        bad = dev > threshold[self.bin_index]
+        working_mask = self.mask.copy()
+        working_mask.ravel()[self.pixels[bad]] = False
+        return working_mask
+
+
+def streaming_outlier_gen(images, r, alpha, bins, rate=0.05, min_scale=1.,
+                          mask=None):
+    """
+    Generator of outlier masks for a series of images, based on running
+    per-bin median and MAD statistics
+
+    Parameters
+    ----------
+    images : iterable
+        Iterable of 2-D arrays
+    r: 2darray
+        The  array which maps pixels to bins
+    alpha: float or tuple or, 1darray
+        Then number of acceptable standard deviations
+    bins: list
+        The bin edges
+    rate: float, optional
+        The forgetting factor of the running statistics, default is 0.05
+    min_scale: float, optional
+        Lower bound of the MAD in units of the image, default is 1
+    mask: 1darray, bool, optional
+        A starting flattened mask
+
+    Yields
+    -------
+    mask : array
+        The mask of each image, bad pixels are False
+
+    See Also
+    --------
+    StreamingOutlierMask
+    """
+    masker = StreamingOutlierMask(r, alpha, bins, rate=rate,
+                                  min_scale=min_scale, mask=mask)
+    for im in images:
+        yield masker(im)
@@ -0,0 +1,244 @@
+# ######################################################################
+# Copyright (c) 2014, Brookhaven Science Associates, Brookhaven        #
+# National Laboratory. All rights reserved.                            #
+#                                                                      #
+# Redistribution and use in source and binary forms, with or without   #
+# modification, are permitted provided that the following conditions   #
+# are met:                                                             #
+#                                                                      #
+# * Redistributions of source code must retain the above copyright     #
+#   notice, this list of conditions and the following disclaimer.      #
+#                                                                      #
+# * Redistributions in binary form must reproduce the above copyright  #
+#   notice this list of conditions and the following disclaimer in     #
+#   the documentation and/or other materials provided with the         #
+#   distribution.                                                      #
+#                                                                      #
+# * Neither the name of the Brookhaven Science Associates, Brookhaven  #
+#   National Laboratory nor the names of its contributors may be used  #
+#   to endorse or promote products derived from this software without  #
+#   specific prior written permission.                                 #
+#                                                                      #
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS  #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT    #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS    #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE       #
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,           #
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES   #
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR   #
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)   #
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,  #
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OTHERWISE) ARISING   #
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE   #
+# POSSIBILITY OF SUCH DAMAGE.                                          #
+########################################################################
+"""
+This module is for running several frame-series analyses on a single read of
+the data.
+
+The generator-style analyses of this library (e.g.
+`skbeam.core.correlation.lazy_one_time`, `skbeam.core.dpc.lazy_dpc` or
+`skbeam.core.mask.threshold`) each consume an iterable of frames. `fan_out`
+reads every frame of a source iterable once and broadcasts it to several such
+consumers, each of which runs in its own thread and is fed through a bounded
+queue. Reading the data and computing the results therefore overlap, and a
+slow consumer throttles the reader instead of frames piling up in memory.
+"""
+from __future__ import absolute_import, division, print_function
+
+import sys
+import threading
+import types
+
+import six
+from six.moves import queue
+
+import logging
+logger = logging.getLogger(__name__)
+
+# marks the end of the frame stream in the queues
+_END = object()
+
+
+class _QueueIterator(object):
+    """Iterate over the items of the queue `q` until the end marker"""
+
+    def __init__(self, q):
+        self.q = q
+        self.done = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
+        item = self.q.get()
+        if item is _END:
+            self.done = True
+            raise StopIteration
+        return item
+
+    next = __next__  # python 2
+
+    def drain(self):
+        # keep consuming so that the producer never blocks on this queue
+        for _ in self:
+            pass
+
+
+def _run_consumer(consumer, q, out, key):
+    """Thread target: feed the frames in `q` to `consumer`
+
+    The result is stored in ``out[key]`` as a ``(success, value)`` tuple. If
+    `consumer` returns a generator, it is exhausted and its last yielded
+    value is the result. Once the consumer is done (or failed), the rest of
+    the queue is drained.
+    """
+    frames = _QueueIterator(q)
+    try:
+        result = consumer(frames)
+        if isinstance(result, types.GeneratorType):
+            last = None
+            for last in result:
+                pass
+            result = last
+        out[key] = (True, result)
+    except BaseException:
+        out[key] = (False, sys.exc_info())
+    finally:
+        frames.drain()
+
+
+def fan_out(source, consumers, maxsize=4):
+    """
+    Read each frame of `source` once and broadcast it to all `consumers`
+
+    Each consumer runs in its own thread and receives the frames through a
+    queue holding at most `maxsize` frames. The frames are read in the
+    calling thread, which blocks while the queue of any consumer is full.
+    The same frame objects are passed to every consumer, so consumers must
+    not modify them in place.
+
+    Parameters
+    ----------
+    source : iterable
+        Iterable of frames (e.g. 2-D arrays), read exactly once
+    consumers : list or dict of callables
+        Each callable takes an iterable of frames as its only argument, for
+        example ``lambda frames: lazy_one_time(frames, num_levels, num_bufs,
+        labels)``. If it returns a generator, the generator is exhausted and
+        its last yielded value is taken as the result
+    maxsize : int, optional
+        The maximum number of frames queued for each consumer. Default is 4
+
+    Returns
+    -------
+    results : list or dict
+        The result of each consumer, in the same order (or with the same
+        keys) as `consumers`
+
+    Raises
+    ------
+    Exception
+        The first exception raised by the source or by any consumer (in the
+        order of `consumers`) is re-raised once all threads have finished
+    """
+    if isinstance(consumers, dict):
+        keys = list(consumers)
+        funcs = [consumers[k] for k in keys]
+    else:
+        keys = None
+        funcs = list(consumers)
+
+    queues = [queue.Queue(maxsize=maxsize) for _ in funcs]
+    out = [None] * len(funcs)
+    threads = [threading.Thread(target=_run_consumer,
+                                args=(func, q, out, n))
+               for n, (func, q) in enumerate(zip(funcs, queues))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    source_error = None
+    try:
+        for frame in source:
+            for q in queues:
+                q.put(frame)
+    except BaseException:
+        source_error = sys.exc_info()
+    finally:
+        for q in queues:
+            q.put(_END)
+        for t in threads:
+            t.join()
+
+    if source_error is not None:
+        six.reraise(*source_error)
+    for success, value in out:
+        if not success:
+            six.reraise(*value)
+
+    results = [value for _, value in out]
+    if keys is not None:
+        return dict(zip(keys, results))
+    return results
+
+
+def prefetch(iterable, maxsize=4):
+    """
+    Read the items of `iterable` in a background thread
+
+    This overlaps reading the frames (e.g. from disk) with the processing
+    of the frames that were already read.
+
+    Parameters
+    ----------
+    iterable : iterable
+        Iterable of frames
+    maxsize : int, optional
+        The maximum number of frames read ahead. Default is 4
+
+    Yields
+    ------
+    frame
+        The items of `iterable`, in order
+    """
+    q = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    error = []
+
+    def reader():
+        try:
+            for item in iterable:
+                # give up if the consumer went away
+                while not stop.is_set():
+                    try:
+                        q.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except BaseException:
+            error.append(sys.exc_info())
+        finally:
+            # the end marker is always delivered unless we were stopped
+            while not stop.is_set():
+                try:
+                    q.put(_END, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    t = threading.Thread(target=reader)
+    t.daemon = True
+    t.start()
+    try:
+        for item in _QueueIterator(q):
+            yield item
+    finally:
+        stop.set()
+        t.join()
+    if error:
+        six.reraise(*error[0])
@@ -41,7 +41,8 @@ simple shapes such as rectangles and concentric circles.
 from __future__ import absolute_import, division, print_function
 
 import collections
-import scipy.ndimage.measurements as ndim
+import itertools
+from multiprocessing.pool import ThreadPool
 from skimage.draw import line
 from skimage import img_as_float, feature, color, draw
 from skimage.measure import ransac, CircleModel
@@ -52,7 +53,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def rectangles(coords, shape):
+def rectangles(coords, shape, dtype=np.int64, sparse=False):
     """
     This function wil provide the indices array for rectangle region of
     interests.
@@ -67,16 +68,28 @@ def rectangles(coords, shape):
         Image shape which is used to determine the maximum extent of output
         pixel coordinates. Order is (rr, cc).
 
+    dtype : numpy integer dtype, optional
+        dtype of the label array, defaults to int64. Use np.int16 or
+        np.int32 to reduce the memory used by large label arrays.
+
+    sparse : bool, optional
+        Return an `ROIIndex` instead of the dense labeled array, without
+        ever allocating the latter. Defaults to False.
+
     Returns
     -------
-    label_array : array
+    label_array : array or ROIIndex
         Elements not inside any ROI are zero; elements inside each
         ROI are 1, 2, 3, corresponding to the order they are specified
         in coords. Order is (rr, cc).
 
     """
 
-    labels_grid = np.zeros(shape, dtype=np.int64)
+    coords = list(coords)
+    _check_label_dtype(len(coords), dtype)
+    if sparse:
+        return _sparse_rectangles(coords, shape, dtype)
+    labels_grid = np.zeros(shape, dtype=dtype)
 
     for i, (col_coor, row_coor, col_val, row_val) in enumerate(coords):
 
@@ -97,7 +110,28 @@ def rectangles(coords, shape):
     return labels_grid
 
 
-def rings(edges, center, shape):
+def _sparse_rectangles(coords, shape, dtype):
+    """`rectangles` as an ROIIndex, without a dense label array"""
+    flat, labels = [], []
+    for i, (col_coor, row_coor, col_val, row_val) in enumerate(coords):
+        left, right = np.max([col_coor, 0]), np.min([col_coor + col_val,
+                                                     shape[0]])
+        top, bottom = np.max([row_coor, 0]), np.min([row_coor + row_val,
+                                                     shape[1]])
+        rr = np.arange(left, right)[:, np.newaxis]
+        cc = np.arange(top, bottom)
+        flat.append(np.ravel(rr * shape[1] + cc))
+        labels.append(np.full(flat[-1].shape, i + 1, dtype=dtype))
+    flat = np.concatenate(flat or [np.zeros(0, dtype=np.intp)])
+    labels = np.concatenate(labels or [np.zeros(0, dtype=dtype)])
+    order = np.argsort(flat, kind='mergesort')
+    flat, labels = flat[order], labels[order]
+    if np.any(flat[1:] == flat[:-1]):
+        raise ValueError("overlapping ROIs")
+    return ROIIndex._from_flat(flat, labels, shape, dtype, unique=True)
+
+
+def rings(edges, center, shape, dtype=np.int64, sparse=False):
     """
     Draw annual (ring-shaped) shaped regions of interest.
 
@@ -115,10 +149,16 @@ def rings(edges, center, shape):
     shape: tuple
         Image shape which is used to determine the maximum extent of output
         pixel coordinates. Order is (rr, cc).
+    dtype : numpy integer dtype, optional
+        dtype of the label array, defaults to int64. Use np.int16 or
+        np.int32 to reduce the memory used by large label arrays.
+    sparse : bool, optional
+        Return an `ROIIndex` instead of the dense labeled array, without
+        ever allocating the latter. Defaults to False.
 
     Returns
     -------
-    label_array : array
+    label_array : array or ROIIndex
         Elements not inside any ROI are zero; elements inside each
         ROI are 1, 2, 3, corresponding to the order they are specified
         in edges.
@@ -131,8 +171,12 @@ def rings(edges, center, shape):
         raise ValueError("edges are expected to be monotonically increasing, "
                          "giving inner and outer radii of each ring from "
                          "r=0 outward")
-    r_coord = utils.radial_grid(center, shape).ravel()
-    return _make_roi(r_coord, edges, shape)
+    _check_label_dtype(len(edges) // 2, dtype)
+    # sparse labels are built tile by tile, without full-frame maps
+    label_tiles = ((rows, _make_roi(r_tile, edges, r_tile.shape))
+                   for rows, r_tile, _ in _polar_tiles(center, shape,
+                                                       cache=not sparse))
+    return _assemble_labels(label_tiles, shape, dtype, sparse)
 
 
 def ring_edges(inner_radius, width, spacing=0, num_rings=None):
@@ -218,7 +262,8 @@ def ring_edges(inner_radius, width, spacing=0, num_rings=None):
     return edges
 
 
-def segmented_rings(edges, segments, center, shape, offset_angle=0):
+def segmented_rings(edges, segments, center, shape, offset_angle=0,
+                    dtype=np.int64, sparse=False):
     """
     Parameters
     ----------
@@ -241,9 +286,17 @@ def segmented_rings(edges, segments, center, shape, offset_angle=0):
     angle_offset : float or array, optional
         offset in radians from offset_angle=0 along the positive X axis
 
+    dtype : numpy integer dtype, optional
+        dtype of the label array, defaults to int64. Use np.int16 or
+        np.int32 to reduce the memory used by large label arrays.
+
+    sparse : bool, optional
+        Return an `ROIIndex` instead of the dense labeled array, without
+        ever allocating the latter. Defaults to False.
+
     Returns
     -------
-    label_array : array
+    label_array : array or ROIIndex
         Elements not inside any ROI are zero; elements inside each
         ROI are 1, 2, 3, corresponding to the order they are specified
         in edges and segments
@@ -262,10 +315,6 @@ def segmented_rings(edges, segments, center, shape, offset_angle=0):
                          "giving inner and outer radii of each ring from "
                          "r=0 outward")
 
-    agrid = utils.angle_grid(center, shape)
-
-    agrid[agrid < 0] = 2*np.pi + agrid[agrid < 0]
-
     segments_is_list = isinstance(segments, collections.Iterable)
     if segments_is_list:
         segments = np.asarray(segments) + offset_angle
@@ -274,48 +323,101 @@ def segmented_rings(edges, segments, center, shape, offset_angle=0):
         segments = np.linspace(0, 2*np.pi, num=1+segments, endpoint=True)
         segments += offset_angle
 
-    # the indices of the bins(angles) to which each value in input
-    #  array(angle_grid) belongs.
-    ind_grid = (np.digitize(np.ravel(agrid), segments,
-                            right=False)).reshape(shape)
+    len_segments = len(segments)
+    _check_label_dtype(len_segments * (len(edges) // 2), dtype)
+    return _assemble_labels(
+        _segmented_ring_tiles(edges, segments, center, shape,
+                              cache=not sparse),
+        shape, dtype, sparse)
 
-    label_array = np.zeros(shape, dtype=np.int64)
-    # radius grid for the image_shape
-    rgrid = utils.radial_grid(center, shape)
 
-    # assign indices value according to angles then rings
+def _segmented_ring_tiles(edges, segments, center, shape, cache=True):
+    """Generate the labels of `segmented_rings` in row tiles"""
     len_segments = len(segments)
-    for i in range(len(edges) // 2):
-        indices = (edges[2*i] <= rgrid) & (rgrid < edges[2*i + 1])
+    for rows, rgrid, agrid in _polar_tiles(center, shape, angle=True,
+                                           cache=cache):
+        # the indices of the bins(angles) to which each value in input
+        #  array(angle_grid) belongs.
+        ind_grid = np.digitize(agrid, segments, right=False)
+        # ring number (counted from 1) of each pixel, even values fall
+        # between rings
+        ring = np.digitize(rgrid, edges, right=False)
+        inside = ring % 2 != 0
         # Combine "segment #" and "ring #" to get unique label for each.
-        label_array[indices] = ind_grid[indices] + (len_segments - 1) * i
-
-    return label_array
+        yield rows, np.where(
+            inside, ind_grid + (len_segments - 1) * (ring // 2), 0)
 
 
-def roi_max_counts(images_sets, label_array):
+def roi_max_counts(images_sets, label_array, cap=None, sample=1,
+                   num_threads=None, max_memory=2**28):
     """
     Return the brightest pixel in any ROI in any image in the image set.
 
+    Only the ROI pixels are read from the images, through an `ROIIndex`.
+    Image stacks given as 3D arrays (including np.memmap) are scanned in
+    chunks of frames.
+
     Parameters
     ----------
     images_sets : array
         iterable of 4D arrays
         shapes is: (len(images_sets), )
 
-    label_array : array
+    label_array : array or ROIIndex
         labeled array; 0 is background.
         Each ROI is represented by a distinct label (i.e., integer).
+    cap : number, optional
+        Stop scanning as soon as a pixel of at least this value is found,
+        e.g. the largest count the XSVS histograms should cover. The
+        returned value is then larger than or equal to `cap`
+    sample : int, optional
+        Only scan every `sample`-th image of each set. This gives a fast,
+        approximate (lower bound) maximum for sizing histograms. Default
+        is 1, scan every image
+    num_threads : int, optional
+        Scan the chunks in a pool of this many threads. Default is to scan
+        in the calling thread
+    max_memory : int, optional
+        The maximum number of bytes of ROI pixels gathered per chunk.
+        Default is 256 MiB
 
     Returns
     -------
     max_counts : int
         maximum pixel counts
     """
+    roi_index = ROIIndex.from_labels(label_array)
+    indices = roi_index.indices
+    if len(indices) == 0:
+        return 0
+
+    def chunk_max(chunk):
+        return chunk.reshape(len(chunk), -1)[:, indices].max()
+
+    chunks = (chunk for img_set in images_sets
+              for _, _, chunk in _frame_chunks(img_set, len(indices),
+                                               max_memory, sample))
     max_cts = 0
-    for img_set in images_sets:
-        for img in img_set:
-            max_cts = max(max_cts, ndim.maximum(img, label_array))
+    if num_threads is None or num_threads <= 1:
+        for chunk in chunks:
+            max_cts = max(max_cts, chunk_max(chunk))
+            if cap is not None and max_cts >= cap:
+                break
+        return max_cts
+
+    pool = ThreadPool(num_threads)
+    try:
+        # hand out a few chunks per thread at a time, so that the images are
+        # streamed and the scan can stop early
+        while True:
+            batch = list(itertools.islice(chunks, 2 * num_threads))
+            if not batch:
+                break
+            max_cts = max([max_cts] + pool.map(chunk_max, batch))
+            if cap is not None and max_cts >= cap:
+                break
+    finally:
+        pool.terminate()
     return max_cts
 
 
@@ -330,7 +432,7 @@ def roi_pixel_values(image, labels, index=None):
     image : array
         image data dimensions are: (rr, cc)
 
-    labels : array
+    labels : array or ROIIndex
         labeled array; 0 is background.
         Each ROI is represented by a distinct label (i.e., integer).
 
@@ -349,29 +451,86 @@ def roi_pixel_values(image, labels, index=None):
     if labels.shape != image.shape:
         raise ValueError("Shape of the image data should be equal to"
                          " shape of the labeled array")
+    roi_index = ROIIndex.from_labels(labels)
     if index is None:
-        index = np.arange(1, np.max(labels) + 1)
+        max_label = roi_index.labels.max() if len(roi_index) else 0
+        index = np.arange(1, max_label + 1)
 
+    flat_image = np.ravel(image)
     roi_pix = []
     for n in index:
-        roi_pix.append(image[labels == n])
+        roi_pix.append(flat_image[roi_index.label_indices(n)])
     return roi_pix, index
 
 
-def mean_intensity(images, labeled_array, index=None):
+def _frame_chunks(images, num_pixels, max_memory, sample=1):
+    """
+    Split `images` into chunks of frames
+
+    A 3D array (including a np.memmap) is sliced into chunks of frames such
+    that `num_pixels` float64 values per frame take at most `max_memory`
+    bytes. Any other iterable of images gives one image per chunk. Only
+    every `sample`-th image is used.
+
+    Yields
+    ------
+    start, stop : int
+        The range of the chunk in the sampled images
+    chunk : array
+        The images in the chunk, shape (stop - start, num_rows, num_cols)
+    """
+    if isinstance(images, np.ndarray) and images.ndim == 3:
+        if sample > 1:
+            images = images[::sample]
+        frame_bytes = max(num_pixels * np.dtype(np.float64).itemsize, 1)
+        step = max(1, int(max_memory // frame_bytes))
+        for start in range(0, len(images), step):
+            chunk = images[start:start + step]
+            yield start, start + len(chunk), chunk
+    else:
+        for n, img in enumerate(itertools.islice(images, 0, None, sample)):
+            yield n, n + 1, np.asarray(img)[np.newaxis]
+
+
+def _gather_stack(images, indices, max_memory):
+    """
+    Gather the pixels at the flat `indices` from every image of `images`
+
+    A 3D array (including a np.memmap) is processed in chunks of frames,
+    so that each gathered chunk of float64 values takes at most
+    `max_memory` bytes. Any other iterable of images is processed one image
+    at a time.
+
+    Yields
+    ------
+    start, stop : int
+        The range of images in the chunk
+    values : array
+        The gathered pixels, shape (stop - start, len(indices))
+    """
+    for start, stop, chunk in _frame_chunks(images, len(indices),
+                                            max_memory):
+        yield start, stop, chunk.reshape(len(chunk), -1)[:, indices]
+
+
+def mean_intensity(images, labeled_array, index=None, max_memory=2**28):
     """Compute the mean intensity for each ROI in the image list
 
     Parameters
     ----------
-    images : list
-        List of images
-    labeled_array : array
+    images : list or array
+        List of images, or an image stack (which may be a np.memmap) with
+        dimensions (num_img, num_rows, num_cols)
+    labeled_array : array or ROIIndex
         labeled array; 0 is background.
         Each ROI is represented by a nonzero integer. It is not required that
         the ROI labels are contiguous
     index : int, list, optional
         The ROI's to use. If None, this function will extract averages for all
         ROIs
+    max_memory : int, optional
+        The ROI pixels of an image stack are gathered and reduced in chunks
+        of frames taking at most this many bytes. Default is 256 MiB
 
     Returns
     -------
@@ -388,20 +547,29 @@ def mean_intensity(images, labeled_array, index=None):
         raise ValueError(
             "`images` shape (%s) needs to be equal to the labeled_array shape"
             "(%s)" % (images[0].shape, labeled_array.shape))
+    roi_index = ROIIndex.from_labels(labeled_array)
     # handle various input for `index`
     if index is None:
-        index = list(np.unique(labeled_array))
-        index.remove(0)
+        index = list(roi_index.labels)
     try:
         len(index)
     except TypeError:
         index = [index]
+    positions, found = roi_index.positions(index)
     # pre-allocate an array for performance
-    # might be able to use list comprehension to make this faster
-    mean_intensity = np.zeros((images.shape[0], len(index)))
-    for n, img in enumerate(images):
-        # use a mean that is mask-aware
-        mean_intensity[n] = ndim.mean(img, labeled_array, index=index)
+    mean_intensity = np.zeros((len(images), len(index)))
+    # labels without any pixels have no mean
+    mean_intensity[:, ~found] = np.nan
+    if not found.any():
+        return mean_intensity, index
+    # gather the ROI pixels of many frames at once and reduce each ROI with
+    # a single reduceat over the frames of the chunk
+    for start, stop, values in _gather_stack(images, roi_index.indices,
+                                             max_memory):
+        sums = np.add.reduceat(values.astype(np.float64),
+                               roi_index.indptr[:-1], axis=1)
+        means = sums / roi_index.num_pixels
+        mean_intensity[start:stop, found] = means[:, positions[found]]
     return mean_intensity, index
 
 
@@ -466,7 +634,7 @@ def circular_average(image, calibrated_center, threshold=0, nx=100,
     return bin_centers, ring_averages
 
 
-def kymograph(images, labels, num):
+def kymograph(images, labels, num, max_memory=2**28):
     """
     This function will provide data for graphical representation of pixels
     variation over time for required ROI.
@@ -474,11 +642,15 @@ def kymograph(images, labels, num):
     Parameters
     ----------
     images : array
-        Image stack. dimensions are: (num_img, num_rows, num_cols)
-    labels : array
+        Image stack. dimensions are: (num_img, num_rows, num_cols). It may
+        be a np.memmap, or any iterable of images
+    labels : array or ROIIndex
         labeled array; 0 is background. Each ROI is represented by an integer
     num : int
         The ROI to turn into a kymograph
+    max_memory : int, optional
+        The ROI pixels of an image stack are gathered in chunks of frames
+        taking at most this many bytes. Default is 256 MiB
 
     Returns
     -------
@@ -487,9 +659,9 @@ def kymograph(images, labels, num):
         for required ROI
 
     """
-    kymo = []
-    for n, img in enumerate(images):
-        kymo.append((roi_pixel_values(img, labels == num)[0]))
+    indices = ROIIndex.from_labels(labels).label_indices(num)
+    kymo = [values for _, _, values in _gather_stack(images, indices,
+                                                     max_memory)]
 
     return np.vstack(kymo)
 
@@ -502,7 +674,7 @@ def extract_label_indices(labels):
 
     Parameters
     ----------
-    labels : array
+    labels : array or ROIIndex
         labeled array; 0 is background.
         Each ROI is represented by a distinct label (i.e., integer).
 
@@ -517,19 +689,348 @@ def extract_label_indices(labels):
         foreground pixels (labeled nonzero)
         e.g., [5, 6, 7, 8, 14, 15, 21, 22]
     """
-    img_dim = labels.shape
+    if isinstance(labels, ROIIndex):
+        return labels.label_mask, labels.pixel_list
 
-    # TODO Make this tighter.
-    w = np.where(np.ravel(labels) > 0)
-    grid = np.indices((img_dim[0], img_dim[1]))
-    pixel_list = np.ravel((grid[0] * img_dim[1] + grid[1]))[w]
+    flat_labels = np.ravel(labels)
+    pixel_list = np.flatnonzero(flat_labels > 0)
 
     # discard the zeros
-    label_mask = labels[labels > 0]
+    label_mask = flat_labels[pixel_list]
 
     return label_mask, pixel_list
 
 
+class ROIIndex(object):
+    """
+    Compact index of the pixels of every ROI in a labeled array
+
+    The labeled array is scanned once. The flat indices of the pixels of
+    each ROI are stored contiguously, sorted by label (and in raster order
+    within each label), together with an `indptr` array of the start of
+    each label, like the rows of a CSR sparse matrix. Extracting the pixels
+    of one or all ROIs from an image then costs O(pixels in the ROIs)
+    instead of a pass over the full image per label.
+
+    The functions of this module which take a labeled array also accept an
+    `ROIIndex` in its place, as do the one-time and two-time correlation
+    functions and `skbeam.core.speckle.xsvs`. For ROIs covering a small part
+    of a large detector, build it with `from_coords` or with ``sparse=True``
+    in the ROI constructors (`rectangles`, `box`, `rings`,
+    `segmented_rings`, `lines`), which never allocate the dense labeled
+    array.
+
+    Parameters
+    ----------
+    labels : array
+        labeled array; 0 is background.
+        Each ROI is represented by a distinct label (i.e., integer).
+
+    Attributes
+    ----------
+    shape : tuple
+        The shape of the labeled array
+    labels : array
+        The sorted, distinct labels of the ROIs
+    indices : array
+        Flat indices into the raveled image of the pixels of all ROIs,
+        grouped by label. int32 unless the image is too large for it
+    indptr : array
+        The pixels of ``labels[i]`` are ``indices[indptr[i]:indptr[i+1]]``
+    """
+
+    def __init__(self, labels):
+        labels = np.asarray(labels)
+        flat_labels = np.ravel(labels)
+        pixel_list = np.flatnonzero(flat_labels > 0)
+        self._index(labels.shape, labels.dtype, pixel_list,
+                    flat_labels[pixel_list])
+
+    def _index(self, shape, dtype, pixel_list, label_mask):
+        # pixel_list must be sorted (raster order)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.labels, inverse, counts = np.unique(label_mask,
+                                                 return_inverse=True,
+                                                 return_counts=True)
+        self.labels = self.labels.astype(self.dtype)
+        size = int(np.prod(self.shape))
+        index_dtype = (np.int32 if size < np.iinfo(np.int32).max
+                       else np.int64)
+        # a stable sort keeps the raster order within each label
+        order = np.argsort(inverse, kind='mergesort')
+        self.indices = pixel_list[order].astype(index_dtype)
+        self.indptr = np.zeros(len(self.labels) + 1, dtype=index_dtype)
+        np.cumsum(counts, out=self.indptr[1:])
+
+    @classmethod
+    def from_labels(cls, labels):
+        """Return `labels` if it is already an ROIIndex, else index it"""
+        if isinstance(labels, cls):
+            return labels
+        return cls(labels)
+
+    @classmethod
+    def from_coords(cls, coords, labels, shape, dtype=np.int64):
+        """
+        Index ROIs given in coordinate (COO) form, without a dense array
+
+        Parameters
+        ----------
+        coords : tuple of arrays
+            The coordinates of the ROI pixels, one array per dimension, as
+            returned by ``np.nonzero``. Order is (rr, cc).
+        labels : int or array
+            The label of each pixel; 0 is background and is dropped. Where
+            a pixel is given more than once the last label wins, as it
+            would when assigning ``label_array[coords] = labels``
+        shape : tuple
+            The shape of the (virtual) labeled array
+        dtype : numpy integer dtype, optional
+            dtype of the labels, defaults to int64
+
+        Returns
+        -------
+        roi_index : ROIIndex
+        """
+        shape = tuple(shape)
+        flat = np.ravel_multi_index(tuple(np.asarray(c, dtype=np.intp)
+                                          for c in coords), shape)
+        labels = np.broadcast_to(np.asarray(labels, dtype=dtype),
+                                 flat.shape)
+        return cls._from_flat(flat, labels, shape, dtype)
+
+    @classmethod
+    def _from_flat(cls, flat, labels, shape, dtype, unique=False):
+        """ROIIndex from flat pixel indices and their labels
+
+        With ``unique=True`` the caller guarantees `flat` is sorted and free
+        of duplicates, and the labels nonzero.
+        """
+        if not unique:
+            # keep the last occurrence of each pixel
+            flat_rev = flat[::-1]
+            flat, first = np.unique(flat_rev, return_index=True)
+            labels = labels[::-1][first]
+            nonzero = labels != 0
+            flat, labels = flat[nonzero], labels[nonzero]
+        roi_index = cls.__new__(cls)
+        roi_index._index(shape, dtype, flat, labels)
+        return roi_index
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def num_pixels(self):
+        """The number of pixels in each ROI"""
+        return np.diff(self.indptr)
+
+    @property
+    def pixel_list(self):
+        """Flat indices of all ROI pixels, in raster order"""
+        return np.sort(self.indices)
+
+    @property
+    def label_mask(self):
+        """The label of each pixel in `pixel_list`"""
+        per_pixel = np.repeat(self.labels, self.num_pixels)
+        return per_pixel[np.argsort(self.indices, kind='mergesort')]
+
+    def to_labels(self):
+        """Rebuild the dense labeled array"""
+        labels = np.zeros(int(np.prod(self.shape)), dtype=self.dtype)
+        labels[self.indices] = np.repeat(self.labels, self.num_pixels)
+        return labels.reshape(self.shape)
+
+    def to_coords(self):
+        """
+        The ROI pixels in coordinate (COO) form, grouped by label
+
+        Returns
+        -------
+        coords : tuple of arrays
+            The coordinates of the ROI pixels, one array per dimension
+        labels : array
+            The label of each pixel
+        """
+        coords = np.unravel_index(self.indices, self.shape)
+        return coords, np.repeat(self.labels, self.num_pixels)
+
+    def positions(self, index):
+        """
+        Positions of the labels in `index` in ``self.labels``
+
+        Returns
+        -------
+        positions : array
+            position of each label of `index`
+        found : array
+            boolean array, False for labels which have no pixels
+        """
+        index = np.atleast_1d(index)
+        positions = np.searchsorted(self.labels, index)
+        positions = np.minimum(positions, max(len(self.labels) - 1, 0))
+        found = np.zeros(len(index), dtype=bool)
+        if len(self.labels):
+            found = self.labels[positions] == index
+        return positions, found
+
+    def label_indices(self, label):
+        """Flat indices of the pixels with the given label"""
+        (pos, ), (found, ) = self.positions(label)
+        if not found:
+            return self.indices[:0]
+        return self.indices[self.indptr[pos]:self.indptr[pos + 1]]
+
+    def gather(self, image):
+        """
+        The values of the ROI pixels of `image`, grouped by label
+
+        The values of ``labels[i]`` are
+        ``gather(image)[indptr[i]:indptr[i + 1]]``
+        """
+        image = np.asarray(image)
+        if image.shape != self.shape:
+            raise ValueError("Shape of the image data should be equal to"
+                             " shape of the labeled array")
+        return np.ravel(image)[self.indices]
+
+    def sum(self, image):
+        """The sum of the pixels of each ROI of `image`"""
+        values = self.gather(image)
+        if len(values) == 0:
+            return np.zeros(0)
+        return np.add.reduceat(values.astype(np.float64), self.indptr[:-1])
+
+    def mean(self, image):
+        """The mean of the pixels of each ROI of `image`"""
+        return self.sum(image) / self.num_pixels
+
+
+def _check_label_dtype(num_labels, dtype):
+    """Raise if labels up to `num_labels` do not fit in the integer dtype"""
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'iu':
+        raise ValueError("dtype must be an integer type, not "
+                         "{}".format(dtype))
+    if num_labels > np.iinfo(dtype).max:
+        raise ValueError("{} labels do not fit in "
+                         "{}".format(num_labels, dtype))
+
+
+# radius and angle maps of the most recently used (center, shape) pairs,
+# kept in float64 so the labels match `utils.radial_grid` exactly. The
+# cache holds at most _POLAR_CACHE_SIZE entries and POLAR_CACHE_MAX_BYTES
+# in total, 64 MB by default: the radius and angle maps of a 4 Mpx
+# detector. Assign to ``roi.POLAR_CACHE_MAX_BYTES`` to change it, or set
+# it to 0 to disable the cache; maps of frames that do not fit are
+# generated tile by tile on every call instead.
+_polar_cache = collections.OrderedDict()
+_POLAR_CACHE_SIZE = 2
+POLAR_CACHE_MAX_BYTES = 2**26
+_TILE_PIXELS = 2**16
+
+
+def _polar_tile(x, y, angle):
+    """Radius and angle (wrapped to [0, 2pi)) of a tile of pixels
+
+    ``x`` is the row vector of column offsets and ``y`` the column vector
+    of row offsets from the center. The arithmetic is the one used by
+    `utils.radial_grid` and `utils.angle_grid`, so the maps are identical.
+    """
+    r = np.sqrt(x * x + y * y)
+    if not angle:
+        return r, None
+    a = np.arctan2(y, x)
+    a[a < 0] = 2*np.pi + a[a < 0]
+    return r, a
+
+
+def _polar_tiles(center, shape, angle=False, tile_pixels=_TILE_PIXELS,
+                 cache=True):
+    """Generate the radius (and angle) maps of an image in row tiles
+
+    Parameters
+    ----------
+    center : tuple
+        point in image where r=0. Order is (rr, cc).
+    shape : tuple
+        Image shape. Order is (rr, cc).
+    angle : bool, optional
+        Also generate the angle map, wrapped to [0, 2pi). Defaults to False.
+    tile_pixels : int, optional
+        Approximate number of pixels in each tile.
+    cache : bool, optional
+        Keep full-frame maps in the cache, or use them from it. With False
+        only one tile is in memory at a time. Defaults to True.
+
+    Yields
+    ------
+    rows : slice
+        The rows of the image covered by the tile
+    r : array
+        radius of each pixel in the tile
+    a : array or None
+        angle of each pixel in the tile, None when `angle` is False
+    """
+    shape = tuple(int(n) for n in shape)
+    x = np.arange(shape[1]) - center[1]
+    y = (np.arange(shape[0]) - center[0])[:, np.newaxis]
+    step = max(1, tile_pixels // max(1, shape[1]))
+    tiles = [slice(start, start + step)
+             for start in range(0, shape[0], step)]
+
+    nbytes = shape[0] * shape[1] * np.dtype(float).itemsize * (1 + angle)
+    if not cache or nbytes > POLAR_CACHE_MAX_BYTES:
+        for rows in tiles:
+            r, a = _polar_tile(x, y[rows], angle)
+            yield rows, r, a
+        return
+
+    key = (tuple(np.ravel(center).tolist()), shape)
+    maps = _polar_cache.pop(key, {})
+    if 'r' not in maps or (angle and 'a' not in maps):
+        maps['r'] = np.empty(shape)
+        if angle:
+            maps['a'] = np.empty(shape)
+        for rows in tiles:
+            r, a = _polar_tile(x, y[rows], angle)
+            maps['r'][rows] = r
+            if angle:
+                maps['a'][rows] = a
+        for m in maps.values():
+            m.flags.writeable = False
+    _polar_cache[key] = maps
+    while (len(_polar_cache) > _POLAR_CACHE_SIZE or
+           sum(m.nbytes for cached in _polar_cache.values()
+               for m in cached.values()) > POLAR_CACHE_MAX_BYTES):
+        _polar_cache.popitem(last=False)
+
+    for rows in tiles:
+        yield rows, maps['r'][rows], maps['a'][rows] if angle else None
+
+
+def _assemble_labels(label_tiles, shape, dtype, sparse):
+    """Build a labeled array, or an ROIIndex, from row tiles of labels
+
+    `label_tiles` yields ``(rows, labels)`` with `rows` a slice of the
+    image rows in increasing order.
+    """
+    if not sparse:
+        label_array = np.empty(shape, dtype=dtype)
+        for rows, tile in label_tiles:
+            label_array[rows] = tile
+        return label_array
+    flat, labels = [np.zeros(0, dtype=np.intp)], [np.zeros(0, dtype=dtype)]
+    for rows, tile in label_tiles:
+        nonzero = np.flatnonzero(tile)
+        labels.append(np.ravel(tile)[nonzero].astype(dtype))
+        flat.append(nonzero + rows.start * shape[1])
+    return ROIIndex._from_flat(np.concatenate(flat), np.concatenate(labels),
+                               shape, dtype, unique=True)
+
+
 def _make_roi(coords, edges, shape):
     """ Helper function to create ring rois and bar rois
 
@@ -559,7 +1060,7 @@ def _make_roi(coords, edges, shape):
     return label_array.reshape(shape)
 
 
-def bar(edges, shape, horizontal=True, values=None):
+def bar(edges, shape, horizontal=True, values=None, dtype=np.int64):
     """Draw bars defined by `edges` from one edge to the other of `image_shape`
 
     Bars will be horizontal or vertical depending on the value of `horizontal`
@@ -579,6 +1080,9 @@ def bar(edges, shape, horizontal=True, values=None):
         Defaults to True
     values : array, optional
         image pixels co-ordinates
+    dtype : numpy integer dtype, optional
+        dtype of the label array, defaults to int64. Use np.int16 or
+        np.int32 to reduce the memory used by large label arrays.
 
     Returns
     -------
@@ -600,15 +1104,27 @@ def bar(edges, shape, horizontal=True, values=None):
         raise ValueError("edges are expected to be monotonically increasing, "
                          "giving inner and outer radii of each bar from "
                          "r=0 outward")
-    if values is None:
-        values = np.repeat(range(shape[0]), shape[1])
+    _check_label_dtype(len(edges) // 2, dtype)
+    label_array = np.empty(shape, dtype=dtype)
     if not horizontal:
-        values = np.tile(range(shape[1]), shape[0])
-
-    return _make_roi(values, edges, shape)
+        # vertical bars depend on the column only
+        label_array[...] = _make_roi(np.arange(shape[1]), edges, shape[1])
+    elif values is None:
+        # horizontal bars depend on the row only
+        label_array[...] = _make_roi(np.arange(shape[0]), edges,
+                                     (shape[0], 1))
+    else:
+        values = np.reshape(values, shape)
+        step = max(1, _TILE_PIXELS // max(1, shape[1]))
+        for start in range(0, shape[0], step):
+            rows = slice(start, start + step)
+            label_array[rows] = _make_roi(values[rows], edges,
+                                          values[rows].shape)
+    return label_array
 
 
-def box(shape, v_edges, h_edges=None, h_values=None, v_values=None):
+def box(shape, v_edges, h_edges=None, h_values=None, v_values=None,
+        dtype=np.int64, sparse=False):
     """Draw box shaped rois when the horizontal and vertical edges
      are provided.
 
@@ -629,10 +1145,16 @@ def box(shape, v_edges, h_edges=None, h_values=None, v_values=None):
     v_values : array, optional
         image pixels co-ordinates in vertical direction
         shape has to be image shape
+    dtype : numpy integer dtype, optional
+        dtype of the label array, defaults to int64. Use np.int16 or
+        np.int32 to reduce the memory used by large label arrays.
+    sparse : bool, optional
+        Return an `ROIIndex` instead of the dense labeled array, without
+        ever allocating the latter. Defaults to False.
 
     Returns
     -------
-    label_array : array
+    label_array : array or ROIIndex
         Elements not inside any ROI are zero; elements inside each
         ROI are 1, 2, 3, corresponding to the order they are specified
         in edges.
@@ -648,10 +1170,13 @@ def box(shape, v_edges, h_edges=None, h_values=None, v_values=None):
         h_edges = v_edges
 
     if h_values is None and v_values is None:
-        v_values, h_values = np.mgrid[:shape[0], :shape[1]]
+        # only the shape of the coordinate grids is needed
+        values_shape = tuple(shape)
     elif h_values.shape != v_values.shape:
         raise ValueError("Shape of the h_values array should be equal to"
                          " shape of the v_values array")
+    else:
+        values_shape = v_values.shape
     for edges in (h_edges, v_edges):
         edges = np.atleast_2d(np.asarray(edges)).ravel()
         if not 0 == len(edges) % 2:
@@ -662,10 +1187,10 @@ def box(shape, v_edges, h_edges=None, h_values=None, v_values=None):
         for v in v_edges:
             coords.append((h[0], v[0], h[1]-h[0], v[1] - v[0]))
 
-    return rectangles(coords, v_values.shape)
+    return rectangles(coords, values_shape, dtype=dtype, sparse=sparse)
 
 
-def lines(end_points, shape):
+def lines(end_points, shape, sparse=False):
     """
     Parameters
     ----------
@@ -675,16 +1200,20 @@ def lines(end_points, shape):
     shape : tuple
         Image shape which is used to determine the maximum extent of output
         pixel coordinates. Order is (rr, cc).
+    sparse : bool, optional
+        Return an `ROIIndex` instead of the dense labeled array, without
+        ever allocating the latter. Defaults to False.
 
     Returns
     -------
-    label_array : array
+    label_array : array or ROIIndex
         Elements not inside any ROI are zero; elements inside each
         ROI are 1, 2, 3, corresponding to the order they are specified
         in coords. Order is (rr, cc).
 
     """
-    label_array = np.zeros(shape, dtype=np.int64)
+    label_array = None if sparse else np.zeros(shape, dtype=np.int64)
+    all_rr, all_cc, all_labels = [], [], []
     label = 0
     for points in end_points:
         if len(points) != 4:
@@ -695,15 +1224,35 @@ def lines(end_points, shape):
                       np.min([points[2], shape[0]-1]),
                       np.min([points[3], shape[1]-1]))
         label += 1
-        label_array[rr, cc] = label
+        if sparse:
+            all_rr.append(rr)
+            all_cc.append(cc)
+            all_labels.append(np.full(len(rr), label, dtype=np.int64))
+        else:
+            label_array[rr, cc] = label
+    if sparse:
+        coords = (np.concatenate(all_rr or [[]]),
+                  np.concatenate(all_cc or [[]]))
+        return ROIIndex.from_coords(coords, np.concatenate(all_labels or [[]]),
+                                    shape)
     return label_array
 
 
 def auto_find_center_rings(avg_img, sigma=1, no_rings=4, min_samples=3,
-                           residual_threshold=1, max_trials=1000):
+                           residual_threshold=1, max_trials=1000,
+                           bin_factor=1, center_guess=None,
+                           annulus_width=None):
     """This will find the center of the speckle pattern and the radii of the
     most intense rings.
 
+    By default RANSAC is run on all the edge points of the full resolution
+    image. For large images, a coarse-to-fine search is much faster: with
+    `bin_factor` the rings are first found on the image binned by that
+    factor, and with `center_guess` they are found from the distances of
+    the edge points to a known (e.g. the previous scan's) center. In both
+    cases each ring is then refined with RANSAC on the full resolution edge
+    points within `annulus_width` of its coarse circle only.
+
     Parameters
     ----------
     avg_img : 2D array
@@ -718,6 +1267,17 @@ def auto_find_center_rings(avg_img, sigma=1, no_rings=4, min_samples=3,
         Maximum distance for a data point to be classified as an inlier.
     max_trials : int, optional
         Maximum number of iterations for random sample selection.
+    bin_factor : int, optional
+        Find the coarse rings on the image binned by this factor in both
+        directions. Defaults to 1, no binning.
+    center_guess : tuple, optional
+        Approximate center, in the order of the returned `center`. The
+        coarse rings are centered on it and only their radii are searched.
+    annulus_width : float, optional
+        Half width of the annuli around the coarse circles in which the
+        rings are refined. Defaults to ``2 * (bin_factor + 1) *
+        residual_threshold``; with `center_guess` it must also cover the
+        shift of the center.
 
     Returns
     -------
@@ -736,24 +1296,167 @@ def auto_find_center_rings(avg_img, sigma=1, no_rings=4, min_samples=3,
     automatically find the center and the most intense rings.
     """
 
-    image = img_as_float(color.rgb2gray(avg_img))
-    edges = feature.canny(image, sigma)
-    coords = np.column_stack(np.nonzero(edges))
-    edge_pts_xy = coords[:, ::-1]
-    radii = []
+    image = img_as_float(avg_img)
+    if image.ndim == 3:
+        image = color.rgb2gray(image)
+    bin_factor = int(bin_factor)
+
+    if bin_factor > 1:
+        # find the coarse circles on the binned image and only look for the
+        # full resolution edges in the annuli around them
+        edge_pts_xy = _binned_edges(image, bin_factor, sigma)
+        if annulus_width is None:
+            annulus_width = 2 * (bin_factor + 1) * residual_threshold
+        if center_guess is not None:
+            coarse = _circles_about_center(edge_pts_xy, center_guess,
+                                           no_rings, annulus_width)
+        else:
+            # the coarse circles only need to be within the annuli, so the
+            # search may stop at the first good enough consensus
+            coarse = _ransac_circles(edge_pts_xy, no_rings, min_samples,
+                                     residual_threshold * bin_factor,
+                                     max_trials, stop_probability=0.999)
+        edge_pts_xy = _annuli_edges(image, sigma, coarse, annulus_width)
+    else:
+        edges = feature.canny(image, sigma)
+        coords = np.column_stack(np.nonzero(edges))
+        edge_pts_xy = coords[:, ::-1]
+        if center_guess is None:
+            coarse = None
+        else:
+            if annulus_width is None:
+                annulus_width = 4 * residual_threshold
+            coarse = _circles_about_center(edge_pts_xy, center_guess,
+                                           no_rings, annulus_width)
+
+    if coarse is None:
+        circles = _ransac_circles(edge_pts_xy, no_rings, min_samples,
+                                  residual_threshold, max_trials)
+    else:
+        circles = []
+        for circle in coarse:
+            params, edge_pts_xy = _refine_circle(
+                edge_pts_xy, circle, annulus_width, min_samples,
+                residual_threshold, max_trials)
+            circles.append(params)
 
-    for i in range(no_rings):
-        model_robust, inliers = ransac(edge_pts_xy, CircleModel, min_samples,
-                                       residual_threshold,
-                                       max_trials=max_trials)
+    radii = []
+    for i, params in enumerate(circles):
         if i == 0:
-            center = int(model_robust.params[0]), int(model_robust.params[1])
-        radii.append(model_robust.params[2])
+            center = int(params[0]), int(params[1])
+        radii.append(params[2])
 
         rr, cc = draw.circle_perimeter(center[1], center[0],
-                                       int(model_robust.params[2]),
+                                       int(params[2]),
                                        shape=image.shape)
         image[rr, cc] = i + 1
-        edge_pts_xy = edge_pts_xy[~inliers]
 
     return center, image, radii
+
+
+def _ransac_circles(edge_pts_xy, no_rings, min_samples, residual_threshold,
+                    max_trials, stop_probability=1):
+    """Fit `no_rings` circles one after the other, removing the inliers"""
+    circles = []
+    for i in range(no_rings):
+        model_robust, inliers = ransac(edge_pts_xy, CircleModel, min_samples,
+                                       residual_threshold,
+                                       max_trials=max_trials,
+                                       stop_probability=stop_probability)
+        circles.append(model_robust.params)
+        edge_pts_xy = edge_pts_xy[~inliers]
+    return circles
+
+
+def _binned_edges(image, bin_factor, sigma):
+    """Canny edges of `image` binned by `bin_factor`
+
+    The edge points are returned as (x, y) in the pixel coordinates of
+    `image`.
+    """
+    b = bin_factor
+    rows, cols = image.shape[0] // b, image.shape[1] // b
+    binned = image[:rows * b, :cols * b].reshape(rows, b, cols, b)
+    binned = binned.mean(axis=3).mean(axis=1)
+    edges = feature.canny(binned, max(sigma / b, 1.))
+    # binned pixel i covers pixels i*b ... i*b + b - 1
+    return np.column_stack(np.nonzero(edges))[:, ::-1] * b + (b - 1) / 2
+
+
+def _annuli_edges(image, sigma, circles, width, tile=128):
+    """Canny edges of `image`, computed only in tiles touching the annuli
+
+    Each tile is padded by the reach of the Gaussian filter, so away from
+    the image borders the edges are those of the full image.
+    """
+    pad = int(4 * sigma) + 2
+    points = []
+    for r0 in range(0, image.shape[0], tile):
+        for c0 in range(0, image.shape[1], tile):
+            r1 = min(r0 + tile, image.shape[0])
+            c1 = min(c0 + tile, image.shape[1])
+            if not any(_tile_meets_annulus((c0, c1 - 1), (r0, r1 - 1),
+                                           circle, width)
+                       for circle in circles):
+                continue
+            pr0, pc0 = max(r0 - pad, 0), max(c0 - pad, 0)
+            edges = feature.canny(image[pr0:r1 + pad, pc0:c1 + pad], sigma)
+            edges = edges[r0 - pr0:r1 - pr0, c0 - pc0:c1 - pc0]
+            rr, cc = np.nonzero(edges)
+            points.append(np.column_stack((cc + c0, rr + r0)))
+    if not points:
+        return np.zeros((0, 2), dtype=np.intp)
+    return np.concatenate(points)
+
+
+def _tile_meets_annulus(x_range, y_range, circle, width):
+    """Whether a rectangle of pixels overlaps the annulus about `circle`"""
+    xc, yc, r = circle
+    # nearest and farthest points of the rectangle from the center
+    dx = max(x_range[0] - xc, 0, xc - x_range[1])
+    dy = max(y_range[0] - yc, 0, yc - y_range[1])
+    far_x = max(abs(x_range[0] - xc), abs(x_range[1] - xc))
+    far_y = max(abs(y_range[0] - yc), abs(y_range[1] - yc))
+    return (np.hypot(dx, dy) <= r + width and
+            np.hypot(far_x, far_y) >= r - width)
+
+
+def _circles_about_center(edge_pts_xy, center, no_rings, width):
+    """Coarse circles about `center` at the most populated edge radii"""
+    xc, yc = center
+    dist = np.hypot(edge_pts_xy[:, 0] - xc, edge_pts_xy[:, 1] - yc)
+    hist = np.bincount(np.round(dist).astype(int)).astype(float)
+    # count the edge points within `width` of each radius
+    half = int(np.ceil(width))
+    hist = np.convolve(hist, np.ones(2 * half + 1), mode='same')
+    circles = []
+    for i in range(no_rings):
+        r = int(np.argmax(hist))
+        circles.append((xc, yc, float(r)))
+        hist[max(r - 2 * half, 0):r + 2 * half + 1] = -1
+    return circles
+
+
+def _refine_circle(edge_pts_xy, circle, width, min_samples,
+                   residual_threshold, max_trials):
+    """RANSAC fit of the edge points within `width` of a coarse circle
+
+    Returns the circle parameters and the edge points which are not inliers
+    of the circle, for the next ring.
+    """
+    params = np.array(circle, dtype=float)
+    xc, yc, r = params
+    dist = np.hypot(edge_pts_xy[:, 0] - xc, edge_pts_xy[:, 1] - yc)
+    points = edge_pts_xy[np.abs(dist - r) <= width]
+    if len(points) >= min_samples:
+        # most points of an annulus are inliers, so here too the search
+        # can stop early
+        model_robust, _ = ransac(points, CircleModel, min_samples,
+                                 residual_threshold, max_trials=max_trials,
+                                 stop_probability=0.999)
+        if model_robust is not None:
+            params = model_robust.params
+    model = CircleModel()
+    model.params = params
+    outliers = np.abs(model.residuals(edge_pts_xy)) >= residual_threshold
+    return params, edge_pts_xy[outliers]
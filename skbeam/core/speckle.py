@@ -74,7 +74,7 @@ def xsvs(image_sets, label_array, number_of_img, timebin_num=2,
     ----------
     image_sets : array
         sets of images
-    label_array : array
+    label_array : array or skbeam.core.roi.ROIIndex
         labeled array; 0 is background.
         Each ROI is represented by a distinct label (i.e., integer).
     number_of_img : int
@@ -113,15 +113,14 @@ def xsvs(image_sets, label_array, number_of_img, timebin_num=2,
     experimental data.
 
     """
-    if max_cts is None:
-        max_cts = roi.roi_max_counts(image_sets, label_array)
+    # find the pixel indices for ROI's, grouped by label
+    roi_index = roi.ROIIndex.from_labels(label_array)
 
-    # find the label's and pixel indices for ROI's
-    labels, indices = roi.extract_label_indices(label_array)
+    if max_cts is None:
+        max_cts = roi.roi_max_counts(image_sets, roi_index)
 
     # number of ROI's
-    u_labels = list(np.unique(labels))
-    num_roi = len(u_labels)
+    num_roi = len(roi_index)
 
     # create integration times
     time_bin = geometric_series(timebin_num, number_of_img)
@@ -173,10 +172,11 @@ def xsvs(image_sets, label_array, number_of_img, timebin_num=2,
             cur[0] = (1 + cur[0]) % timebin_num
             # read each frame
             # Put the image into the ring buffer.
-            buf[0, cur[0] - 1] = (np.ravel(img))[indices]
+            buf[0, cur[0] - 1] = (np.ravel(img))[roi_index.indices]
 
-            _process(num_roi, 0, cur[0] - 1, buf, img_per_level, labels,
-                     max_cts, bin_edges[0], prob_k, prob_k_pow, track_bad)
+            _process(num_roi, 0, cur[0] - 1, buf, img_per_level,
+                     roi_index.indptr, max_cts, bin_edges[0], prob_k,
+                     prob_k_pow, track_bad)
 
             # check whether the number of levels is one, otherwise
             # continue processing the next level
@@ -196,8 +196,8 @@ def xsvs(image_sets, label_array, number_of_img, timebin_num=2,
                     track_level[level] = 0
 
                     _process(num_roi, level, cur[level]-1, buf, img_per_level,
-                             labels, max_cts, bin_edges[level], prob_k,
-                             prob_k_pow, track_bad)
+                             roi_index.indptr, max_cts, bin_edges[level],
+                             prob_k, prob_k_pow, track_bad)
                     level += 1
 
             prob_k_all += (prob_k - prob_k_all)/(i + 1)
@@ -211,7 +211,7 @@ def xsvs(image_sets, label_array, number_of_img, timebin_num=2,
     return prob_k_all, prob_k_std_dev
 
 
-def _process(num_roi, level, buf_no, buf, img_per_level, labels,
+def _process(num_roi, level, buf_no, buf, img_per_level, indptr,
              max_cts, bin_edges, prob_k, prob_k_pow, track_bad):
     """
     Internal helper function. This modifies inputs in place.
@@ -233,8 +233,9 @@ def _process(num_roi, level, buf_no, buf, img_per_level, labels,
         image data array to use for XSVS
     img_per_level : int
         to track how many images processed in each level
-    labels : array
-        labels of the required region of interests(ROI's)
+    indptr : array
+        the pixels of the j-th ROI are ``buf[level, buf_no][indptr[j]:
+        indptr[j + 1]]`` (see skbeam.core.roi.ROIIndex)
     max_cts: int
         maximum pixel count
     bin_edges : array
@@ -247,7 +248,6 @@ def _process(num_roi, level, buf_no, buf, img_per_level, labels,
         to track bad images in each level
     """
     img_per_level[level] += 1
-    u_labels = list(np.unique(labels))
 
     #  Check if there are any bad images, represented as an array filled
     #  with np.nan (using bad_to_nan function in mask.py all the bad
@@ -256,8 +256,8 @@ def _process(num_roi, level, buf_no, buf, img_per_level, labels,
         track_bad[level] += 1
         return
 
-    for j, label in enumerate(u_labels):
-        roi_data = buf[level, buf_no][labels == label]
+    for j in range(num_roi):
+        roi_data = buf[level, buf_no][indptr[j]:indptr[j + 1]]
         spe_hist, bin_edges = np.histogram(roi_data, bins=bin_edges,
                                            density=True)
         spe_hist = np.nan_to_num(spe_hist)
@@ -37,14 +37,17 @@
 ########################################################################
 from __future__ import absolute_import, division, print_function
 import numpy as np
+import scipy.signal
+from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 import skbeam.core.calibration as calibration
-import skbeam.core.calibration as core
+from skbeam.core import feature
+from skbeam.core import utils
 from .utils import gauss_gen
 
 
 def _draw_gaussian_rings(shape, calibrated_center, r_list, r_width):
-    R = core.radial_grid(calibrated_center, shape)
+    R = utils.radial_grid(calibrated_center, shape)
     I = np.zeros_like(R)
 
     for r in r_list:
@@ -69,6 +72,66 @@ def test_refine_center():
         assert np.all(np.abs(center - out) < .1)
 
 
+def _wedge_ring_trace(image, center, phi_steps, max_peaks, thresh,
+                      window_size, nx, min_x, max_x):
+    # the wedge by wedge formulation refine_center used to be written with
+    phi = utils.angle_grid(center, image.shape).ravel()
+    r = utils.radial_grid(center, image.shape).ravel()
+    phi_edges = np.linspace(-np.pi, np.pi, phi_steps)
+    ring_trace = []
+    for phi_start, phi_end in zip(phi_edges[:-1], phi_edges[1:]):
+        mask = (phi <= phi_end) & (phi > phi_start)
+        bins, b_sum, b_count = utils.bin_1D(r[mask], image.ravel()[mask],
+                                            nx=nx, min_x=min_x, max_x=max_x)
+        mask = b_sum > 10
+        avg = b_sum[mask] / b_count[mask]
+        cands = scipy.signal.argrelmax(avg, order=window_size)[0]
+        cands = feature.filter_peak_height(avg, cands, thresh*np.max(avg),
+                                           window=window_size)
+        cands = np.asarray(cands, dtype=int)[:max_peaks]
+        ring_trace.append(utils.bin_edges_to_centers(bins)[mask][cands])
+    num_rings = min(len(rt) for rt in ring_trace)
+    return np.vstack([rt[:num_rings] for rt in ring_trace]).T
+
+
+def test_center_refiner():
+    center = np.array((200, 230))
+    shape = (400, 451)
+    I = _draw_gaussian_rings(shape, center, [40, 75, 100, 150], 4)
+    I += np.random.RandomState(0).poisson(3, shape)
+
+    refiner = calibration.CenterRefiner(shape, (1, 1), phi_steps=16, nx=150,
+                                        min_x=10, max_x=180)
+    for thresh in (0, .2):
+        expected = _wedge_ring_trace(I, center + 1.5, 16, 4, thresh, 4,
+                                     150, 10, 180)
+        ring_trace = refiner.ring_trace(I, center + 1.5, 4, thresh, 4)
+        assert_array_equal(ring_trace, expected)
+    # the pixels are only assigned to bins again for a new center
+    bins = refiner._pixel_bins(center + 1.5)
+    assert refiner._pixel_bins((201.5, 231.5)) is bins
+
+    # with 17 steps the wedge edges include 0 and +-pi / 2, which whole
+    # pixels around an integer center lie on; wedges are (start, end]
+    refiner = calibration.CenterRefiner(shape, (1, 1), phi_steps=17, nx=150,
+                                        min_x=10, max_x=180)
+    expected = _wedge_ring_trace(I, center, 17, 4, 0, 4, 150, 10, 180)
+    assert_array_equal(refiner.ring_trace(I, center, 4, 0, 4), expected)
+    index, bins, count, _ = refiner._pixel_bins(center)
+    wedge = dict(zip(index, bins // 150))
+    # phi == 0 goes in the wedge ending at 0, phi == pi / 2 in the one
+    # ending at pi / 2
+    assert wedge[np.ravel_multi_index((200, 250), shape)] == 7
+    assert wedge[np.ravel_multi_index((220, 230), shape)] == 11
+
+    # iterate to convergence
+    I = _draw_gaussian_rings(shape, center, [40, 75, 100, 150], 4)
+    guess = center + 1
+    for i in range(3):
+        guess = refiner(I, guess, max_peaks=4, thresh=0, window_size=4)
+    assert np.all(np.abs(center - guess) < .2)
+
+
 def test_blind_d():
     name = 'Si'
     wavelength = .18
@@ -91,6 +154,46 @@ def test_blind_d():
     assert np.abs(d - D) < 1e-6
 
 
+def test_blind_d_batch():
+    window_size = 5
+    threshold = .1
+    bin_centers = np.linspace(0, 50, 2000)
+    rs = np.random.RandomState(0)
+    names = ['Si', 'Si', 'CeO2', 'Si']
+    wavelengths = [.18, .18, .2, .15]
+    distances = [200, 180, 150, 230]
+    patterns = []
+    for name, wavelength, D in zip(names, wavelengths, distances):
+        cal = calibration.calibration_standards[name]
+        I = rs.uniform(.01, 1, bin_centers.shape)
+        for r in D * np.tan(cal.convert_2theta(wavelength)):
+            I += gauss_gen(bin_centers, r, 100, .2)
+        patterns.append(I)
+    patterns = np.array(patterns)
+
+    for max_peak_count in (3, 20):
+        d, dstd = calibration.estimate_d_blind_batch(
+            names, wavelengths, bin_centers, patterns, window_size,
+            max_peak_count, threshold)
+        for j, (name, wavelength, I) in enumerate(zip(names, wavelengths,
+                                                      patterns)):
+            expected = calibration.estimate_d_blind(
+                name, wavelength, bin_centers, I, window_size,
+                max_peak_count, threshold)
+            assert_array_almost_equal((d[j], dstd[j]), expected, decimal=8)
+        assert np.all(np.abs(d - distances) < .05)
+
+    # a single standard and wavelength for all the patterns
+    d, dstd = calibration.estimate_d_blind_batch(
+        'Si', .18, bin_centers, patterns[:2], window_size, 20, threshold)
+    assert np.all(np.abs(d - distances[:2]) < .05)
+    # patterns without peaks give nan
+    d, dstd = calibration.estimate_d_blind_batch(
+        'Si', .18, bin_centers[:50], np.ones((2, 50)), window_size, 20,
+        threshold)
+    assert np.all(np.isnan(d))
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=['-s', '--with-doctest'], exit=False)
@@ -36,7 +36,7 @@ from __future__ import absolute_import, division, print_function
 import logging
 
 import numpy as np
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import assert_array_almost_equal, assert_array_equal
 from nose.tools import assert_raises, assert_equal
 
 import skbeam.core.utils as utils
@@ -47,8 +47,8 @@ from skbeam.core.correlation import (multi_tau_auto_corr,
                                      two_time_state_to_results,
                                      one_time_from_two_time,
                                      CrossCorrelator)
-from skbeam.core.mask import bad_to_nan_gen
-from skbeam.core.roi import ring_edges, segmented_rings
+from skbeam.core.mask import bad_to_nan_gen, roi_pixel_gen
+from skbeam.core.roi import ring_edges, segmented_rings, ROIIndex
 
 
 logger = logging.getLogger(__name__)
@@ -201,6 +201,39 @@ def test_bad_images():
     assert_array_almost_equal(g2[:, 0], g2_n[:, 0], decimal=3)
     assert_array_almost_equal(g2[:, 1], g2_n[:, 1], decimal=3)
 
+    # flagging the bad images explicitly gives the same result
+    frames = roi_pixel_gen(img_stack, rois, bad=bad_img_list)
+    g2_f, lag_steps_f = multi_tau_auto_corr(4, num_bufs, rois, frames)
+    assert_array_equal(g2_n, g2_f)
+    assert_array_equal(lag_steps_n, lag_steps_f)
+
+
+def test_roi_frames():
+    setup()
+    g2, lag_steps = multi_tau_auto_corr(num_levels, num_bufs, rois,
+                                        img_stack)
+    frames = roi_pixel_gen(img_stack, rois)
+    g2_f, lag_steps_f = multi_tau_auto_corr(num_levels, num_bufs, rois,
+                                            frames)
+    assert_array_equal(g2, g2_f)
+    assert_array_equal(lag_steps, lag_steps_f)
+
+    two_time = two_time_corr(rois, img_stack, stack_size, num_bufs,
+                             num_levels)
+    two_time_f = two_time_corr(rois, roi_pixel_gen(img_stack, rois),
+                               stack_size, num_bufs, num_levels)
+    assert_array_equal(two_time[0], two_time_f[0])
+
+    # the ROIs may also be given in sparse form
+    sparse_rois = ROIIndex.from_coords(np.nonzero(rois), rois[rois > 0],
+                                       rois.shape)
+    g2_s, lag_steps_s = multi_tau_auto_corr(num_levels, num_bufs,
+                                            sparse_rois, img_stack)
+    assert_array_equal(g2, g2_s)
+    two_time_s = two_time_corr(sparse_rois, img_stack, stack_size, num_bufs,
+                               num_levels)
+    assert_array_equal(two_time[0], two_time_s[0])
+
 
 def test_one_time_from_two_time():
     num_lev = 1
@@ -37,7 +37,8 @@
 ########################################################################
 from __future__ import absolute_import, division, print_function
 import numpy as np
-from numpy.testing import assert_array_almost_equal
+import scipy.signal
+from numpy.testing import assert_array_almost_equal, assert_array_equal
 from nose.tools import assert_raises
 from .utils import gauss_gen, parabola_gen
 import skbeam.core.feature as feature
@@ -98,6 +99,75 @@ def test_filter_peak_height():
         assert(len(out) == len(heights) - j - 1)
 
 
+def _loop_filter_peak_height(y, cands, thresh, window):
+    # the per candidate formulation filter_peak_height used to be written
+    # with
+    out = []
+    for ind in cands:
+        slc = slice(max(0, ind - window), min(len(y), ind + window + 1))
+        if np.ptp(y[slc]) > thresh:
+            out.append(ind)
+    return np.array(out, dtype=int)
+
+
+def test_batch_filters():
+    rs = np.random.RandomState(1)
+    y = rs.uniform(0, 10, (5, 60))
+    y[3] = 0
+    rows, cands = scipy.signal.argrelmax(y, axis=1)
+    # add candidates near the ends, and a row without any
+    extra = np.array([[0, 0], [0, 59], [1, 1], [2, 58]])
+    rows = np.concatenate([rows, extra[:, 0]])
+    cands = np.concatenate([cands, extra[:, 1]])
+    keep = rows != 4
+    rows, cands = rows[keep], cands[keep]
+    order = np.lexsort((cands, rows))
+    rows, cands = rows[order], cands[order]
+    indptr = np.searchsorted(rows, np.arange(len(y) + 1))
+
+    thresh = np.array([4., 7., 8., 0., 3.])
+    for window in (1, 5, 40):
+        # both the sliding window and the gathered window paths
+        for sub in (slice(None), slice(0, 4)):
+            sub_cands = (indptr, cands) if sub == slice(None) else (
+                [0, 4, 4, 4, 4, 4], cands[:4])
+            out_indptr, out = feature.batch_filter_peak_height(
+                y, sub_cands, thresh, window=window)
+            for j in range(len(y)):
+                row_cands = sub_cands[1][sub_cands[0][j]:sub_cands[0][j+1]]
+                expected = _loop_filter_peak_height(y[j], row_cands,
+                                                    thresh[j], window)
+                assert_array_equal(out[out_indptr[j]:out_indptr[j+1]],
+                                   expected)
+                assert_array_equal(
+                    feature.filter_peak_height(y[j], row_cands, thresh[j],
+                                               window=window), expected)
+
+    # a NaN in the window fails the candidate in both paths, as with np.ptp
+    y_nan = np.array([1, 5, 1, np.nan, 1, 6, 1, 2, 8, 1, 1, 7, 1])
+    nan_cands = np.array([1, 5, 8, 11])
+    for window in (1, 2, 5):
+        expected = _loop_filter_peak_height(y_nan, nan_cands, 0, window)
+        _, out = feature.batch_filter_peak_height(
+            y_nan, ([0, 4], nan_cands), 0, window=window)
+        assert_array_equal(out, expected)
+    assert_array_equal(
+        feature.filter_peak_height(y_nan, nan_cands, 0, window=2), [8, 11])
+
+    for N in (1, 3, 100):
+        out_indptr, out = feature.batch_filter_n_largest(y, (indptr, cands),
+                                                         N)
+        for j in range(len(y)):
+            row_cands = cands[indptr[j]:indptr[j+1]]
+            expected = feature.filter_n_largest(y[j], row_cands, N)
+            result = out[out_indptr[j]:out_indptr[j+1]]
+            assert_array_equal(np.sort(result), np.sort(expected))
+            # in descending order
+            assert np.all(np.diff(y[j][result]) <= 0)
+    assert_raises(ValueError, feature.batch_filter_n_largest, y,
+                  (indptr, cands), 0)
+
+
 def test_peak_refinement():
 
     cands = np.array((10, 25, 50, 75, 100))
@@ -113,6 +183,57 @@ def test_peak_refinement():
     assert_array_almost_equal(ht, heights, decimal=3)
 
 
+def test_batch_peak_refinement():
+    rs = np.random.RandomState(0)
+    x = np.arange(128, dtype=float)
+    y = np.zeros((3, 128))
+    for row in y:
+        for c in rs.uniform(0, 128, 8):
+            row += gauss_gen(x, c, rs.uniform(5, 50), 3)
+        row += rs.uniform(.1, 2, 128)
+    rows, cands = scipy.signal.argrelmax(y, axis=1, order=2)
+
+    for refine_function in (feature.refine_quadratic,
+                            feature.refine_log_quadratic):
+        # the same function, without its batch version
+        def looped(x, y, **kwargs):
+            return refine_function(x, y, **kwargs)
+
+        for refine_args in ({}, {'Rval_thresh': .9}):
+            expected = feature.batch_peak_refinement(
+                x, y, (rows, cands), 4, looped, refine_args)
+            result = feature.batch_peak_refinement(
+                x, y, (rows, cands), 4, refine_function, refine_args)
+            for a, b in zip(result, expected):
+                assert_array_almost_equal(a, b)
+
+            # and the 1D interface
+            for row in range(len(y)):
+                loc, ht = feature.peak_refinement(
+                    x, y[row], cands[rows == row], 4, refine_function,
+                    refine_args)
+                loc_exp, ht_exp = feature.peak_refinement(
+                    x, y[row], cands[rows == row], 4, looped, refine_args)
+                assert_array_almost_equal(loc, loc_exp)
+                assert_array_almost_equal(ht, ht_exp)
+        # some peaks are rejected
+        assert len(feature.batch_peak_refinement(
+            x, y, (rows, cands), 4, refine_function,
+            {'Rval_thresh': .9})[0]) < len(rows)
+
+    # x may be given per curve
+    result = feature.batch_peak_refinement(
+        np.tile(x, (3, 1)), y, (rows, cands), 4, feature.refine_quadratic)
+    expected = feature.batch_peak_refinement(
+        x, y, (rows, cands), 4, feature.refine_quadratic)
+    for a, b in zip(result, expected):
+        assert_array_almost_equal(a, b)
+    # no candidates
+    rows, loc, ht = feature.batch_peak_refinement(
+        x, y, ([], []), 4, feature.refine_quadratic)
+    assert len(rows) == len(loc) == len(ht) == 0
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=['-s', '--with-doctest'], exit=False)
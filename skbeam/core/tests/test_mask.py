@@ -86,6 +86,21 @@ def test_bad_to_nan_gen():
     assert not np.isnan(np.asarray(y)[4]).all()
 
 
+def test_roi_pixel_gen():
+    images = np.arange(5 * 4 * 3).reshape(5, 4, 3)
+    labels = np.zeros((4, 3), dtype=int)
+    labels[1:3, 1:] = 2
+    labels[0, 0] = 7
+    frames = list(mask.roi_pixel_gen(images, labels, bad=[1, 3],
+                                     threshold=40))
+    assert [f.bad for f in frames] == [False, True, False, True, False]
+    assert frames[1].pixels is None
+    assert_array_equal(frames[0].pixels, [0, 4, 5, 7, 8])
+    assert_array_equal(frames[2].pixels, [24, 28, 29, 31, 32])
+    # thresholded pixels are set to 0
+    assert_array_equal(frames[4].pixels, [0, 0, 0, 0, 0])
+
+
 def test_margin():
     size = (10, 10)
     edge = 1
@@ -138,6 +153,84 @@ def test_ring_blur_mask():
     # Make certain that we have masked over 90% of the bad pixels
     assert len(b_not_in_a) / len(b) < .1
 
+
+def _reference_binned_outlier(img, r, alpha, bins):
+    import scipy.stats as sts
+    int_r = np.digitize(r, bins[:-1], True) - 1
+    mean = sts.binned_statistic(r.ravel(), img.ravel(), bins=bins,
+                                statistic='mean')[0]
+    std = sts.binned_statistic(r.ravel(), img.ravel(), bins=bins,
+                               statistic=np.std)[0]
+    threshold = alpha * std
+    lower = (mean - threshold)[int_r]
+    upper = (mean + threshold)[int_r]
+    return (img > lower) & (img < upper)
+
+
+def test_binned_outlier_plan():
+    from skbeam.core.utils import radial_grid
+    shape = (60, 70)
+    r = radial_grid((30, 35), shape)
+    bins = np.arange(0, 47, 1.5)
+    rs = np.random.RandomState(3)
+    plan = mask.BinnedOutlierMask(r, 2., bins)
+    for _ in range(3):
+        img = rs.normal(100, 5, size=shape)
+        img[rs.randint(0, 60, 20), rs.randint(0, 70, 20)] = 1000
+        msk = plan(img)
+        assert msk.dtype == bool
+        assert_array_equal(msk, _reference_binned_outlier(img, r, 2., bins))
+        assert_array_equal(msk, mask.binned_outlier(img, r, 2., bins))
+
+    # starting mask is carried over
+    start = np.ones(shape, dtype=bool)
+    start[:5] = False
+    msk = mask.binned_outlier(img, r, (3., 3), bins, mask=start.ravel())
+    assert not msk[:5].any()
+
+
+def test_streaming_outlier_mask():
+    from skbeam.core.utils import radial_grid
+    shape = (64, 64)
+    r = radial_grid((32, 32), shape)
+    bins = np.arange(0, 46, 3.)
+    rs = np.random.RandomState(5)
+    profile = 200 + 100 * np.cos(r / 4.)
+
+    def frames(n, scale=1.):
+        for _ in range(n):
+            img = rs.poisson(profile * scale).astype(float)
+            hot = rs.randint(0, 64, size=(2, 10))
+            img[hot[0], hot[1]] += 5000
+            yield img, hot
+
+    masker = mask.StreamingOutlierMask(r, 6., bins, rate=0.2)
+    for img, hot in frames(10):
+        msk = masker(img)
+        assert msk.shape == shape
+        # all zingers are masked, hardly anything else
+        assert not msk[hot[0], hot[1]].any()
+        assert (~msk).sum() < 10 + 0.01 * msk.size
+    assert masker.nframes == 10
+
+    # the running statistics follow a change in intensity
+    for img, hot in frames(40, scale=1.5):
+        msk = masker(img)
+    assert not msk[hot[0], hot[1]].any()
+    assert (~msk).sum() < 10 + 0.01 * msk.size
+
+    # the starting mask is kept and the generator gives the same result
+    start = np.ones(shape, dtype=bool)
+    start[:, :3] = False
+    imgs = [img for img, _ in frames(3)]
+    gen_masks = list(mask.streaming_outlier_gen(imgs, r, 6., bins,
+                                                mask=start))
+    masker = mask.StreamingOutlierMask(r, 6., bins, mask=start)
+    for img, gen_mask in zip(imgs, gen_masks):
+        assert_array_equal(masker(img), gen_mask)
+        assert not gen_mask[:, :3].any()
+
+
 if __name__ == '__main__':
     import nose
     nose.runmodule(argv=['-s', '--with-doctest', '-x'], exit=False)
@@ -0,0 +1,79 @@
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+from numpy.testing import assert_array_equal
+from nose.tools import assert_raises
+
+from skbeam.core.pipeline import fan_out, prefetch
+from skbeam.core.correlation import lazy_one_time
+from skbeam.core.roi import kymograph
+
+
+def _frames(n, counter=None):
+    rs = np.random.RandomState(0)
+    for _ in range(n):
+        if counter is not None:
+            counter.append(1)
+        yield rs.randint(1, 3, (20, 30))
+
+
+def test_fan_out():
+    labels = np.zeros((20, 30), dtype=int)
+    labels[2:8, 3:9] = 1
+    labels[10:15, 5:25] = 2
+    stack = np.asarray(list(_frames(30)))
+
+    read = []
+    res = fan_out(_frames(30, read),
+                  [lambda frames: lazy_one_time(frames, 3, 4, labels),
+                   lambda frames: sum(f.sum() for f in frames),
+                   lambda frames: kymograph(list(frames), labels, 2)],
+                  maxsize=2)
+    # the source is read only once
+    assert len(read) == 30
+    for g2_result in lazy_one_time(stack, 3, 4, labels):
+        pass
+    assert_array_equal(res[0].g2, g2_result.g2)
+    assert res[1] == stack.sum()
+    assert_array_equal(res[2], kymograph(stack, labels, 2))
+
+    res = fan_out(_frames(5), {'count': lambda frames: len(list(frames)),
+                               'first': lambda frames: next(iter(frames))})
+    assert res['count'] == 5
+    assert_array_equal(res['first'], stack[0])
+
+
+def test_fan_out_errors():
+    def bad_consumer(frames):
+        for n, f in enumerate(frames):
+            if n == 3:
+                raise RuntimeError('consumer')
+
+    def bad_source():
+        for n, f in enumerate(_frames(10)):
+            if n == 3:
+                raise KeyError('source')
+            yield f
+
+    with assert_raises(RuntimeError):
+        fan_out(_frames(10), [lambda frames: len(list(frames)),
+                              bad_consumer])
+    with assert_raises(KeyError):
+        fan_out(bad_source(), [lambda frames: list(frames)])
+
+
+def test_prefetch():
+    stack = list(_frames(10))
+    assert_array_equal(list(prefetch(_frames(10), maxsize=2)), stack)
+
+    # stopping early does not hang the reader
+    gen = prefetch(_frames(100), maxsize=1)
+    assert_array_equal(next(gen), stack[0])
+    gen.close()
+
+    def bad_source():
+        yield stack[0]
+        raise ValueError('source')
+
+    with assert_raises(ValueError):
+        list(prefetch(bad_source()))
@@ -217,6 +217,101 @@ def test_segmented_rings():
     assert_array_equal(num_pixels, expected_num_pixels)
 
 
+def _reference_segmented_rings(edges, segments, center, shape,
+                               offset_angle=0):
+    # the full-frame formulation segmented_rings used to be written with
+    agrid = utils.angle_grid(center, shape)
+    agrid[agrid < 0] = 2*np.pi + agrid[agrid < 0]
+    if np.iterable(segments):
+        segments = np.asarray(segments) + offset_angle
+    else:
+        segments = np.linspace(0, 2*np.pi, num=1+segments) + offset_angle
+    ind_grid = np.digitize(np.ravel(agrid), segments).reshape(shape)
+    label_array = np.zeros(shape, dtype=np.int64)
+    rgrid = utils.radial_grid(center, shape)
+    for i in range(len(edges) // 2):
+        indices = (edges[2*i] <= rgrid) & (rgrid < edges[2*i + 1])
+        label_array[indices] = ind_grid[indices] + (len(segments) - 1) * i
+    return label_array
+
+
+def test_label_generation_matches_full_frame():
+    edges = np.ravel(roi.ring_edges(2.5, width=[3, 4, 4, 6], spacing=1.5))
+    shapes = [(150, 140), (300, 1000)]
+    centers = [(75, 75), (74.3, 70.6), (-10.5, 400.25)]
+    old_tile = roi._TILE_PIXELS
+    old_cache = roi.POLAR_CACHE_MAX_BYTES
+    try:
+        # small tiles, with and without the radius/angle cache
+        roi._TILE_PIXELS = 997
+        for max_bytes in (0, old_cache):
+            roi.POLAR_CACHE_MAX_BYTES = max_bytes
+            roi._polar_cache.clear()
+            for shape, center in itertools.product(shapes, centers):
+                r_coord = utils.radial_grid(center, shape).ravel()
+                expected = roi._make_roi(r_coord, edges, shape)
+                # the second call is served from the cache
+                for _ in range(2):
+                    label_array = roi.rings(edges, center, shape)
+                    assert_equal(label_array.dtype, np.int64)
+                    assert_array_equal(label_array, expected)
+                label_array = roi.rings(edges, center, shape,
+                                        dtype=np.int16)
+                assert_equal(label_array.dtype, np.int16)
+                assert_array_equal(label_array, expected)
+
+                for segments, offset in [(8, 0), (5, 0.3),
+                                         ([0, 1, 2.5, 2*np.pi], 0.1)]:
+                    expected = _reference_segmented_rings(
+                        edges, segments, center, shape, offset)
+                    label_array = roi.segmented_rings(
+                        edges, segments, center, shape, offset_angle=offset,
+                        dtype=np.int32)
+                    assert_equal(label_array.dtype, np.int32)
+                    assert_array_equal(label_array, expected)
+    finally:
+        roi._TILE_PIXELS = old_tile
+        roi.POLAR_CACHE_MAX_BYTES = old_cache
+        roi._polar_cache.clear()
+    assert_true(len(roi._polar_cache) <= roi._POLAR_CACHE_SIZE)
+
+    # the cache is bounded by its size in bytes, not by the frame size
+    try:
+        roi.POLAR_CACHE_MAX_BYTES = 300 * 1000 * 8 + 1
+        roi.rings(edges, (75, 75), (300, 1000))
+        assert_equal(len(roi._polar_cache), 1)
+        roi.rings(edges, (74, 75), (300, 1000))
+        assert_equal(list(roi._polar_cache),
+                     [((74, 75), (300, 1000))])
+        # radius and angle of this frame do not fit
+        roi.segmented_rings(edges, 8, (73, 75), (300, 1000))
+        assert_equal(len(roi._polar_cache), 1)
+    finally:
+        roi.POLAR_CACHE_MAX_BYTES = old_cache
+        roi._polar_cache.clear()
+
+    shape = (40, 30)
+    bar_edges = np.array([[3, 4], [5, 7], [10, 21]]).ravel()
+    assert_array_equal(
+        roi.bar(bar_edges, shape, dtype=np.int16),
+        roi._make_roi(np.repeat(range(shape[0]), shape[1]), bar_edges,
+                      shape))
+    assert_array_equal(
+        roi.bar(bar_edges, shape, horizontal=False),
+        roi._make_roi(np.tile(range(shape[1]), shape[0]), bar_edges,
+                      shape))
+    values = np.random.RandomState(0).uniform(0, 25, shape)
+    assert_array_equal(roi.bar(bar_edges, shape, values=values),
+                       roi._make_roi(values.ravel(), bar_edges, shape))
+    assert_array_equal(roi.box(shape, [[3, 4], [5, 7]], dtype=np.int16),
+                       roi.box(shape, [[3, 4], [5, 7]]))
+
+    assert_raises(ValueError, roi.rings, edges, (5, 5), shape,
+                  dtype=np.float64)
+    assert_raises(ValueError, roi.segmented_rings, edges, 64, (5, 5), shape,
+                  dtype=np.int8)
+
+
 def test_roi_pixel_values():
     images = morphology.diamond(8)
     # width incompatible with num_rings
@@ -240,6 +335,162 @@ def test_roi_pixel_values():
     assert_array_equal([1, 2, 3, 4, 5], index)
 
 
+def test_roi_index():
+    labels = np.zeros((20, 25), dtype=int)
+    labels[2:5, 3:9] = 7
+    labels[10:18, 1:4] = 2
+    labels[15, 20:24] = 7
+    labels[0, 0] = 3
+    rs = np.random.RandomState(0)
+    images = rs.poisson(10, size=(6, 20, 25))
+
+    roi_index = roi.ROIIndex(labels)
+    assert_array_equal(roi_index.labels, [2, 3, 7])
+    assert_array_equal(roi_index.num_pixels, [24, 1, 22])
+    assert roi_index.indices.dtype == np.int32
+    assert roi_index.indptr.dtype == np.int32
+    assert_array_equal(roi_index.to_labels(), labels)
+    assert roi.ROIIndex.from_labels(roi_index) is roi_index
+
+    for a, b in zip(roi.extract_label_indices(roi_index),
+                    roi.extract_label_indices(labels)):
+        assert_array_equal(a, b)
+    # the dense path still matches the definition
+    label_mask, pixel_list = roi.extract_label_indices(labels)
+    assert_array_equal(pixel_list, np.flatnonzero(labels))
+    assert_array_equal(label_mask, labels[labels > 0])
+
+    values, index = roi.roi_pixel_values(images[0], roi_index)
+    assert_array_equal(index, np.arange(1, 8))
+    for n, v in zip(index, values):
+        assert_array_equal(v, images[0][labels == n])
+    values, index = roi.roi_pixel_values(images[0], labels, index=[7, 2])
+    assert_array_equal(values[0], images[0][labels == 7])
+
+    intensity, index = roi.mean_intensity(images, roi_index)
+    assert_array_equal(index, [2, 3, 7])
+    for n, img in enumerate(images):
+        for j, label in enumerate(index):
+            assert_almost_equal(intensity[n, j], img[labels == label].mean())
+    dense_intensity, _ = roi.mean_intensity(images, labels)
+    assert_array_almost_equal(intensity, dense_intensity)
+    # labels without pixels give nan
+    intensity, index = roi.mean_intensity(images, roi_index, index=[7, 5])
+    assert np.all(np.isnan(intensity[:, 1]))
+    assert_array_almost_equal(intensity[:, 0], dense_intensity[:, 2])
+
+    kymo = roi.kymograph(images, roi_index, 7)
+    assert_array_equal(kymo, [img[labels == 7] for img in images])
+    assert_array_equal(kymo, roi.kymograph(images, labels, 7))
+
+    assert_equal(roi.roi_max_counts([images], roi_index),
+                 images[:, labels > 0].max())
+
+
+def test_sparse_rois():
+    shape = (60, 70)
+    # COO round trip, repeated pixels keep the last label, zeros are dropped
+    rr = np.array([5, 1, 5, 7, 2, 9])
+    cc = np.array([4, 3, 4, 0, 2, 9])
+    labels = np.array([3, 2, 6, 6, 0, 3])
+    roi_index = roi.ROIIndex.from_coords((rr, cc), labels, shape)
+    dense = np.zeros(shape, dtype=np.int64)
+    dense[rr, cc] = labels
+    assert_array_equal(roi_index.to_labels(), dense)
+    ref = roi.ROIIndex(dense)
+    assert_array_equal(roi_index.indices, ref.indices)
+    assert_array_equal(roi_index.indptr, ref.indptr)
+    coords, coo_labels = roi_index.to_coords()
+    assert_array_equal(roi.ROIIndex.from_coords(coords, coo_labels,
+                                                shape).to_labels(), dense)
+
+    edges = roi.ring_edges(3, width=4, spacing=2, num_rings=5)
+    center = (27.5, 40.2)
+    cases = [
+        (roi.rings, (edges, center, shape), {}),
+        (roi.segmented_rings, (edges, 6, center, shape),
+         {'offset_angle': 0.2}),
+        (roi.rectangles, ([(2, 3, 5, 7), (20, 30, 8, 2), (50, 60, 20, 20)],
+                          shape), {'dtype': np.int16}),
+        (roi.lines, ([(3, 4, 40, 60), (50, 2, 10, 65), (0, 0, 59, 0)],
+                     shape), {}),
+    ]
+    for func, args, kwargs in cases:
+        expected = func(*args, **kwargs)
+        # the sparse labels neither use nor fill the full-frame map cache
+        roi._polar_cache.clear()
+        roi_index = func(*args, sparse=True, **kwargs)
+        assert_equal(len(roi._polar_cache), 0)
+        assert_true(isinstance(roi_index, roi.ROIIndex))
+        assert_equal(roi_index.dtype, expected.dtype)
+        assert_array_equal(roi_index.to_labels(), expected)
+        ref = roi.ROIIndex(expected)
+        assert_array_equal(roi_index.labels, ref.labels)
+        assert_array_equal(roi_index.indices, ref.indices)
+        assert_array_equal(roi_index.indptr, ref.indptr)
+
+    assert_raises(ValueError, roi.rectangles, [(2, 3, 5, 7), (4, 5, 5, 5)],
+                  shape, sparse=True)
+
+    # frames without pixels give empty indices
+    for empty_shape in [(0, 70), (60, 0)]:
+        for roi_index in [roi.rings(edges, center, empty_shape, sparse=True),
+                          roi.segmented_rings(edges, 6, center, empty_shape,
+                                              sparse=True)]:
+            assert_equal(roi_index.shape, empty_shape)
+            assert_equal(len(roi_index.indices), 0)
+            assert_equal(roi_index.to_labels().shape, empty_shape)
+
+    # consumers take the sparse form in place of the dense array
+    images = np.random.RandomState(3).poisson(5, size=(4, ) + shape)
+    sparse_rings = roi.rings(edges, center, shape, sparse=True)
+    dense_rings = roi.rings(edges, center, shape)
+    assert_array_equal(roi.mean_intensity(images, sparse_rings)[0],
+                       roi.mean_intensity(images, dense_rings)[0])
+    for a, b in zip(roi.extract_label_indices(sparse_rings),
+                    roi.extract_label_indices(dense_rings)):
+        assert_array_equal(a, b)
+
+
+def test_mean_intensity_kymograph_stack():
+    import os
+    import tempfile
+    labels = np.zeros((30, 40), dtype=int)
+    labels[2:9, 5:30] = 4
+    labels[12:25, 1:7] = 1
+    labels[20:28, 30:38] = 9
+    rs = np.random.RandomState(1)
+    stack = rs.randint(0, 100, size=(23, 30, 40)).astype(np.uint16)
+
+    ref = np.array([[img[labels == n].mean() for n in (1, 4, 9)]
+                    for img in stack])
+    ref_kymo = np.vstack([img[labels == 9] for img in stack])
+
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        mmap = np.memmap(fname, dtype=stack.dtype, mode='w+',
+                         shape=stack.shape)
+        mmap[:] = stack
+        mmap.flush()
+        mmap = np.memmap(fname, dtype=stack.dtype, mode='r',
+                         shape=stack.shape)
+        # in one chunk, in chunks of a few frames, frame by frame and
+        # from a list of images
+        for images, max_memory in [(stack, 2**28), (mmap, 5000),
+                                   (mmap, 1), (list(stack), 2**28)]:
+            intensity, index = roi.mean_intensity(images, labels,
+                                                  max_memory=max_memory)
+            assert_array_equal(index, [1, 4, 9])
+            assert_array_almost_equal(intensity, ref)
+            kymo = roi.kymograph(images, labels, 9, max_memory=max_memory)
+            assert_array_equal(kymo, ref_kymo)
+            assert kymo.dtype == stack.dtype
+        del mmap
+    finally:
+        os.remove(fname)
+
+
 def test_roi_max_counts():
     img_stack1 = np.random.randint(0, 60, size=(50, ) + (50, 50))
     img_stack2 = np.random.randint(0, 60, size=(100, ) + (50, 50))
@@ -255,6 +506,20 @@ def test_roi_max_counts():
 
     assert_array_equal(60, roi.roi_max_counts(samples, label_array))
 
+    roi_index = roi.ROIIndex(label_array)
+    # threaded scan in small chunks, of arrays and of lists of images
+    for sets in [samples, (list(img_stack1), img_stack2)]:
+        assert_equal(60, roi.roi_max_counts(sets, roi_index, num_threads=3,
+                                            max_memory=8 * 5000))
+    # stop early once the cap is reached
+    assert roi.roi_max_counts(samples, roi_index, cap=50) >= 50
+    assert roi.roi_max_counts(samples, roi_index, cap=50,
+                              num_threads=2) >= 50
+    # sampling frames gives a lower bound
+    approx = roi.roi_max_counts(samples, roi_index, sample=7)
+    assert 40 < approx <= 60
+    assert_equal(60, roi.roi_max_counts(([img_stack1[0]], ), label_array))
+
 
 def test_static_test_sets():
     images1 = []
@@ -410,3 +675,25 @@ def test_auto_find_center_rings():
 
     assert_equal((99, 99), center)
     assert_array_equal(41., np.round(radii[0]))
+
+
+def test_auto_find_center_rings_coarse_to_fine():
+    shape = (400, 420)
+    yc, xc = 190.4, 211.7
+    r = utils.radial_grid((yc, xc), shape)
+    # two thin rings; canny finds an edge on either side of each
+    image = (50 + 100 * np.exp(-(r - 80)**2 / 8) +
+             80 * np.exp(-(r - 150)**2 / 8))
+
+    for kwargs in [dict(bin_factor=4),
+                   dict(center_guess=(205, 196), annulus_width=12),
+                   dict(bin_factor=4, center_guess=(205, 196),
+                        annulus_width=12)]:
+        center, ring_image, radii = roi.auto_find_center_rings(
+            image, sigma=2, no_rings=2, **kwargs)
+        assert_equal(center, (int(xc), int(yc)))
+        assert_equal(len(radii), 2)
+        # each radius is one of the edges of a ring
+        for radius in radii:
+            assert_true(min(abs(radius - 80), abs(radius - 150)) < 8)
+        assert_equal(ring_image.shape, shape)
@@ -64,6 +64,20 @@ def test_xsvs():
     assert_array_almost_equal(prob_k_all[0, 1],
                               np.array([0., 0.2, 0.2, 0.2, 0.4]))
 
+    # a precomputed ROI index gives the same result
+    roi_index = roi.ROIIndex(label_array)
+    prob_k_idx, std_idx = xsvs.xsvs(images_sets, roi_index, timebin_num=2,
+                                    number_of_img=5)
+    for a, b in zip(prob_k_idx.ravel(), prob_k_all.ravel()):
+        assert_array_almost_equal(a, b)
+    # as do sparse ROIs, which never build the dense label array
+    sparse_labels = roi.rectangles(roi_data, shape=images[0].shape,
+                                   sparse=True)
+    prob_k_sp, std_sp = xsvs.xsvs(images_sets, sparse_labels, timebin_num=2,
+                                  number_of_img=5, max_cts=6)
+    for a, b in zip(prob_k_sp.ravel(), prob_k_all.ravel()):
+        assert_array_almost_equal(a, b)
+
     imgs = []
     for i in range(6):
         int_array = np.tril((i + 2) * np.ones(10))
@@ -568,6 +568,22 @@ def test_bin_grid():
     assert_array_almost_equal(y, x, decimal=2)
 
 
+def test_bin_grid_matches_scipy():
+    import scipy.stats
+    r_array = core.radial_grid((20.3, 31.7), (50, 60))
+    img = np.cos(r_array / 3.) + 2
+    mask = np.ones(img.shape, dtype=bool)
+    mask[10:20, 5:40] = False
+    bins = np.arange(0, 50, 2.)
+    for statistic in ['mean', 'sum', 'count', np.median]:
+        x, y = core.bin_grid(img, r_array, (1, 1), statistic=statistic,
+                             mask=mask, bins=bins)
+        ref, edges, _ = scipy.stats.binned_statistic(
+            r_array[mask], img[mask], statistic=statistic, bins=bins)
+        assert_array_almost_equal(x, core.bin_edges_to_centers(edges))
+        assert_array_almost_equal(y, ref)
+
+
 if __name__ == '__main__':
     import nose
 
@@ -50,7 +50,6 @@ import numpy as np
 from itertools import tee
 
 import logging
-import scipy.stats as sts
 
 logger = logging.getLogger(__name__)
 
@@ -1257,18 +1256,18 @@ def bin_grid(image, r_array, pixel_sizes, statistic='mean', mask=None,
         spacing (less general)
 
     """
-    if mask is None:
-        mask = np.ones(image.shape, dtype=int).astype(bool)
+    # imported here to avoid a circular import, the accumulators use utils
+    from .accumulators.binned_statistic import BinnedStatistic1D
+
     if bins is None:
         res = np.hypot(*pixel_sizes)
         bins = np.arange(np.min(r_array) - res * .5,
                          np.max(r_array) + res * .5, res)
+    if mask is not None:
+        mask = np.ravel(mask)
 
-    int_stat, bin_edge, bin_num = sts.binned_statistic(r_array[mask],
-                                                       image[mask],
-                                                       statistic=statistic,
-                                                       bins=bins)
-
-    bin_centers = bin_edges_to_centers(bin_edge)
+    binner = BinnedStatistic1D(np.ravel(r_array), statistic=statistic,
+                               bins=bins, mask=mask)
+    int_stat = binner(np.ravel(image))
 
-    return bin_centers, int_stat
+    return binner.bin_centers, int_stat